@@ -0,0 +1,93 @@
+"""
+Benchmark the compressed vector tiers against the hnswlib cosine index.
+
+Usage:
+    python bench_quantization.py [--vectors vectors.npy] [--n 20000] [--queries 200] [--k 10]
+                                 [--m 64] [--ef-construction 400] [--ef 100] [--rerank-factor 10]
+
+Without --vectors a synthetic clustered corpus is used; queries are perturbed
+corpus vectors. Recall@k is measured against exact brute-force cosine search.
+Memory is the resident cost per vector: the HNSW slot for hnswlib, the code
+plus label for the tiers (their full-precision vectors stay on disk).
+"""
+import argparse
+import os
+import tempfile
+import time
+from typing import Callable, List, Tuple
+
+import hnswlib
+import numpy as np
+
+from quantization import VectorTier, normalize
+
+
+def synthetic_vectors(n: int, dimension: int = 768, clusters: int = 256, seed: int = 0) -> np.ndarray:
+    """Generate normalized vectors around random cluster centers, like topic-grouped chunk embeddings."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, n)] + 0.6 * rng.standard_normal((n, dimension)).astype(np.float32)
+    return normalize(vectors)
+
+
+def measure(search: Callable[[np.ndarray], np.ndarray], queries: np.ndarray,
+            truth: np.ndarray) -> Tuple[float, float, float]:
+    """Return recall@k, p50 and p95 latency in milliseconds."""
+    latencies: List[float] = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        labels = search(query)
+        latencies.append(1000 * (time.perf_counter() - start))
+        hits += len(set(np.asarray(labels).tolist()) & set(expected.tolist()))
+    latencies.sort()
+    return hits / truth.size, latencies[len(latencies) // 2], latencies[int(0.95 * (len(latencies) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", help=".npy file of corpus vectors")
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--m", type=int, default=64)
+    parser.add_argument("--ef-construction", type=int, default=400)
+    parser.add_argument("--ef", type=int, default=100)
+    parser.add_argument("--rerank-factor", type=int, default=10)
+    args = parser.parse_args()
+
+    corpus = normalize(np.load(args.vectors)) if args.vectors else synthetic_vectors(args.n)
+    n, dimension = corpus.shape
+    rng = np.random.default_rng(1)
+    queries = normalize(corpus[rng.integers(0, n, args.queries)]
+                        + 0.05 * rng.standard_normal((args.queries, dimension)).astype(np.float32))
+    truth = np.argsort(-(queries @ corpus.T), axis=1)[:, :args.k]
+    labels = np.arange(n)
+    print(f"Corpus: {n} vectors x {dimension} dims, {args.queries} queries, recall@{args.k}")
+    print(f"{'method':<14}{'build s':>9}{'B/vector':>10}{'recall':>8}{'p50 ms':>9}{'p95 ms':>9}")
+
+    start = time.perf_counter()
+    index = hnswlib.Index(space="cosine", dim=dimension)
+    index.init_index(max_elements=n, ef_construction=args.ef_construction, M=args.m)
+    index.add_items(corpus, labels)
+    index.set_ef(max(args.ef, args.k))
+    build = time.perf_counter() - start
+    slot = dimension * 4 + (2 * args.m + 1) * 4 + 8 + 8 + 4 + 40
+    recall, p50, p95 = measure(lambda q: index.knn_query(q, k=args.k)[0][0], queries, truth)
+    print(f"{'hnswlib':<14}{build:>9.1f}{slot:>10}{recall:>8.3f}{p50:>9.2f}{p95:>9.2f}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        for kind in ("sq8", "pq"):
+            start = time.perf_counter()
+            tier = VectorTier(os.path.join(directory, kind), dimension, kind)
+            tier.train(corpus[rng.choice(n, min(n, 20000), replace=False)])
+            tier.add(labels, corpus)
+            build = time.perf_counter() - start
+            per_vector = tier.stats()["bytes_per_vector"]
+            for name, rerank in ((kind, args.k * args.rerank_factor), (f"{kind} no-rerank", 0)):
+                recall, p50, p95 = measure(lambda q: tier.search(q, args.k, rerank=rerank)[0], queries, truth)
+                print(f"{name:<14}{build:>9.1f}{per_vector:>10}{recall:>8.3f}{p50:>9.2f}{p95:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,806 @@
+"""
+Compact columnar storage for indexed chunks.
+
+Replaces the label -> dict mapping of the index. Each chunk is one row of
+fixed-width numpy columns; chunk texts live in one contiguous UTF-8 blob
+addressed by offset arrays, and of the contextual text only the generated
+context prefix is stored (the chunk text follows it). File paths, file hashes
+and the metadata shared by a file's chunks are interned, and per-chunk
+metadata (position, page range, hashes) is kept in typed columns.
+
+Lookups by label go through a dense ``row_of_label`` array, so reading k
+search hits costs O(k). A saved store is a directory of .npy columns and raw
+blobs that can be memory-mapped instead of read into memory.
+
+Rows are never modified once written: an update appends a changed copy of
+the row and kills the old one. ``snapshot`` relies on this to hand out a
+read-only view of the store that later writes do not show through. A view's
+label index is split into pages, and a new snapshot copies only the pages
+written since the previous one, so publishing a view costs O(labels changed).
+"""
+import base64
+import io
+import json
+import os
+import shutil
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+STORE_FORMAT = "chunk_store"
+STORE_VERSION = 1
+
+# Row flags
+_ALIVE = 1
+_HAS_CONTEXT = 2          # the entry has contextual_content
+_CONTEXT_FULL = 4         # context blob holds the whole contextual text, not just a prefix
+_HAS_IS_CONTEXTUAL = 8
+_IS_CONTEXTUAL = 16
+_HAS_CHUNK_HASH = 32
+_ENTRY_FLAGS = _ALIVE | _HAS_CONTEXT | _CONTEXT_FULL
+
+_ABSENT = np.iinfo(np.int32).min  # int column value for a missing metadata key
+_NONE = -1                        # file_hash column value for an explicit None
+
+# Labels per page of a snapshot's label index
+_PAGE_BITS = 12
+_PAGE = 1 << _PAGE_BITS
+
+# Metadata keys stored in typed columns, in the order they are materialized
+_INT_FIELDS = ("chunk_index", "total_chunks", "page_start", "page_end")
+_METADATA_ORDER = ("chunk_index", "total_chunks", "is_contextual", "chunk_hash", "file_hash", "page_start", "page_end")
+
+_COLUMNS = {
+    "label": np.int64,
+    "flags": np.uint8,
+    "file_id": np.int32,
+    "content_off": np.int64,
+    "content_len": np.int32,
+    "context_off": np.int64,
+    "context_len": np.int32,
+    "duplicate_of": np.int64,
+    "meta": np.int32,
+    "file_hash": np.int32,
+    "chunk_index": np.int32,
+    "total_chunks": np.int32,
+    "page_start": np.int32,
+    "page_end": np.int32,
+}
+
+
+class _Interner:
+    """Append-only table of distinct strings."""
+
+    def __init__(self, values: Optional[List[str]] = None):
+        self.values = list(values or [])
+        self.ids = {v: i for i, v in enumerate(self.values)}
+
+    def intern(self, value: str) -> int:
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
+
+
+class _Blob:
+    """Byte buffer made of a read-only (possibly memory-mapped) base and an appendable tail."""
+
+    def __init__(self, base=b""):
+        self.base = base
+        self.tail = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.tail)
+
+    def append(self, data: bytes) -> int:
+        offset = len(self)
+        self.tail += data
+        return offset
+
+    def read(self, offset: int, length: int) -> str:
+        base_len = len(self.base)
+        if offset >= base_len:
+            offset -= base_len
+            return bytes(self.tail[offset:offset + length]).decode("utf-8")
+        return bytes(self.base[offset:offset + length]).decode("utf-8")
+
+    def tobytes(self) -> bytes:
+        return bytes(self.base) + bytes(self.tail)
+
+
+def _is_sha256(value: Any) -> bool:
+    if not isinstance(value, str) or len(value) != 64:
+        return False
+    try:
+        bytes.fromhex(value)
+        return True
+    except ValueError:
+        return False
+
+
+class ChunkStore:
+    def __init__(self):
+        """Create an empty store."""
+        self._n = 0            # rows in use, including dead ones
+        self._count = 0        # live rows
+        self._dead_bytes = 0
+        self._cols = {name: np.empty(0, dtype=dtype) for name, dtype in _COLUMNS.items()}
+        self._chunk_hash = np.empty((0, 32), dtype=np.uint8)
+        self._row_of_label = np.empty(0, dtype=np.int64)
+        self._content = _Blob()
+        self._context = _Blob()
+        self._files = _Interner()
+        self._hashes = _Interner()
+        self._metas = _Interner()
+        self._meta_dicts: List[Dict[str, Any]] = []
+        self._changed = set()  # labels put, updated or removed since the last take_changes()
+        self._pages = None     # label index pages of the last snapshot, with their live and owner counts
+        self._dirty_pages = set()  # pages of labels remapped since the last snapshot
+        self.version = 0       # bumped on every change; keys caches derived from the store
+        self.frozen = False    # set on snapshots, which reject writes
+
+    # Row bookkeeping
+
+    def _grow_rows(self, needed: int):
+        capacity = len(self._cols["label"])
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+        for name, column in self._cols.items():
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self._n] = column[:self._n]
+            self._cols[name] = grown
+        grown = np.zeros((capacity, 32), dtype=np.uint8)
+        grown[:self._n] = self._chunk_hash[:self._n]
+        self._chunk_hash = grown
+
+    def _map_label(self, label: int, row: int):
+        if label >= len(self._row_of_label):
+            grown = np.full(max(label + 1, len(self._row_of_label) * 2, 1024), -1, dtype=np.int64)
+            grown[:len(self._row_of_label)] = self._row_of_label
+            self._row_of_label = grown
+        self._row_of_label[label] = row
+        self._dirty_pages.add(label >> _PAGE_BITS)
+
+    def _row(self, label) -> int:
+        try:
+            label = int(label)
+        except (TypeError, ValueError):
+            return -1
+        if 0 <= label < len(self._row_of_label):
+            return int(self._row_of_label[label])
+        return -1
+
+    def _rows(self, labels: np.ndarray) -> np.ndarray:
+        """Rows of labels; -1 for unknown ones."""
+        rows = np.full(len(labels), -1, dtype=np.int64)
+        known = (labels >= 0) & (labels < len(self._row_of_label))
+        rows[known] = self._row_of_label[labels[known]]
+        return rows
+
+    def _alive_rows(self) -> np.ndarray:
+        """Rows of all chunks, ascending."""
+        return np.flatnonzero(self._cols["flags"][:self._n] & _ALIVE)
+
+    def _require(self, label) -> int:
+        row = self._row(label)
+        if row < 0:
+            raise KeyError(label)
+        return row
+
+    def _kill(self, row: int):
+        cols = self._cols
+        cols["flags"][row] &= ~np.uint8(_ALIVE)
+        self._row_of_label[cols["label"][row]] = -1
+        self._dirty_pages.add(int(cols["label"][row]) >> _PAGE_BITS)
+        self._changed.add(int(cols["label"][row]))
+        self.version += 1
+        self._dead_bytes += int(cols["content_len"][row]) + int(cols["context_len"][row])
+        self._count -= 1
+
+    def _writable(self):
+        if self.frozen:
+            raise RuntimeError("Chunk store snapshots are read-only")
+
+    def _rewrite(self, label: int) -> int:
+        """
+        Copy a chunk's row to a new row that can be changed, and kill the old one.
+
+        The copy shares the old row's text, so no text bytes become dead.
+        """
+        self._writable()
+        old = self._require(label)
+        row = self._n
+        self._grow_rows(row + 1)
+        self._n += 1
+        for column in self._cols.values():
+            column[row] = column[old]
+        self._chunk_hash[row] = self._chunk_hash[old]
+        cols = self._cols
+        cols["flags"][old] &= ~np.uint8(_ALIVE)
+        self._row_of_label[int(label)] = row
+        self._dirty_pages.add(int(label) >> _PAGE_BITS)
+        self._changed.add(int(label))
+        self.version += 1
+        return row
+
+    def _maybe_compact(self):
+        dead = self._n - self._count
+        if dead > 1024 and dead > self._count:
+            self.compact()
+
+    # Field encoding
+
+    def _intern_meta(self, residual: Dict[str, Any]) -> int:
+        key = json.dumps(residual, sort_keys=True, default=str)
+        meta_id = self._metas.intern(key)
+        if meta_id == len(self._meta_dicts):
+            self._meta_dicts.append(json.loads(key))
+        return meta_id
+
+    def _write_metadata(self, row: int, metadata: Dict[str, Any]) -> int:
+        """Store metadata in columns plus an interned residual dict; returns the metadata flags."""
+        cols = self._cols
+        flags = 0
+        residual = {}
+        for name in _INT_FIELDS:
+            cols[name][row] = _ABSENT
+        cols["file_hash"][row] = _ABSENT
+        for key, value in metadata.items():
+            if key in _INT_FIELDS and type(value) is int and _ABSENT < value <= np.iinfo(np.int32).max:
+                cols[key][row] = value
+            elif key == "is_contextual" and type(value) is bool:
+                flags |= _HAS_IS_CONTEXTUAL | (_IS_CONTEXTUAL if value else 0)
+            elif key == "chunk_hash" and _is_sha256(value):
+                self._chunk_hash[row] = np.frombuffer(bytes.fromhex(value), dtype=np.uint8)
+                flags |= _HAS_CHUNK_HASH
+            elif key == "file_hash" and (value is None or isinstance(value, str)):
+                cols["file_hash"][row] = _NONE if value is None else self._hashes.intern(value)
+            else:
+                residual[key] = value
+        cols["meta"][row] = self._intern_meta(residual)
+        return flags
+
+    def _write_context(self, row: int, content: str, contextual: Optional[str]) -> int:
+        """Store the contextual text as a prefix of the content when possible; returns the context flags."""
+        cols = self._cols
+        if contextual is None:
+            cols["context_off"][row] = 0
+            cols["context_len"][row] = 0
+            return 0
+        flags = _HAS_CONTEXT
+        if contextual.endswith(content):
+            data = contextual[:len(contextual) - len(content)].encode("utf-8")
+        else:
+            data = contextual.encode("utf-8")
+            flags |= _CONTEXT_FULL
+        cols["context_off"][row] = self._context.append(data)
+        cols["context_len"][row] = len(data)
+        return flags
+
+    def _field(self, row: int, name: str):
+        cols = self._cols
+        if name == "label":
+            return int(cols["label"][row])
+        if name == "file_path":
+            return self._files.values[cols["file_id"][row]]
+        if name == "content":
+            return self._content.read(int(cols["content_off"][row]), int(cols["content_len"][row]))
+        if name == "contextual_content":
+            flags = int(cols["flags"][row])
+            if not flags & _HAS_CONTEXT:
+                return None
+            context = self._context.read(int(cols["context_off"][row]), int(cols["context_len"][row]))
+            return context if flags & _CONTEXT_FULL else context + self._field(row, "content")
+        if name == "duplicate_of":
+            target = int(cols["duplicate_of"][row])
+            return target if target >= 0 else None
+        if name == "chunk_hash":
+            return self._chunk_hash[row].tobytes().hex() if cols["flags"][row] & _HAS_CHUNK_HASH else None
+        if name == "file_hash":
+            value = int(cols["file_hash"][row])
+            return self._hashes.values[value] if value >= 0 else None
+        if name in _INT_FIELDS:
+            value = int(cols[name][row])
+            return value if value != _ABSENT else None
+        if name == "metadata":
+            return self._metadata(row)
+        raise KeyError(name)
+
+    def _metadata(self, row: int) -> Dict[str, Any]:
+        cols = self._cols
+        metadata = dict(self._meta_dicts[cols["meta"][row]])
+        flags = int(cols["flags"][row])
+        for key in _METADATA_ORDER:
+            if key in _INT_FIELDS:
+                value = int(cols[key][row])
+                if value != _ABSENT:
+                    metadata[key] = value
+            elif key == "is_contextual":
+                if flags & _HAS_IS_CONTEXTUAL:
+                    metadata[key] = bool(flags & _IS_CONTEXTUAL)
+            elif key == "chunk_hash":
+                if flags & _HAS_CHUNK_HASH:
+                    metadata[key] = self._chunk_hash[row].tobytes().hex()
+            elif key == "file_hash":
+                value = int(cols["file_hash"][row])
+                if value != _ABSENT:
+                    metadata[key] = self._hashes.values[value] if value >= 0 else None
+        return metadata
+
+    def _materialize(self, row: int) -> Dict[str, Any]:
+        entry = {"content": self._field(row, "content")}
+        contextual = self._field(row, "contextual_content")
+        if contextual is not None:
+            entry["contextual_content"] = contextual
+        entry["file_path"] = self._field(row, "file_path")
+        entry["metadata"] = self._metadata(row)
+        target = self._field(row, "duplicate_of")
+        if target is not None:
+            entry["duplicate_of"] = str(target)
+        return entry
+
+    # Mapping interface (labels may be given as int or str)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, label) -> bool:
+        return self._row(label) >= 0
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.labels().tolist())
+
+    def __getitem__(self, label) -> Dict[str, Any]:
+        """Return a chunk as an entry dict; modifying the dict does not modify the store."""
+        return self._materialize(self._require(label))
+
+    def __setitem__(self, label, entry: Dict[str, Any]):
+        self.put(label, entry)
+
+    def __delitem__(self, label):
+        self._kill(self._require(label))
+        self._maybe_compact()
+
+    def get(self, label, default=None):
+        row = self._row(label)
+        return self._materialize(row) if row >= 0 else default
+
+    def pop(self, label, default=None):
+        self._writable()
+        row = self._row(label)
+        if row < 0:
+            return default
+        entry = self._materialize(row)
+        self._kill(row)
+        self._maybe_compact()
+        return entry
+
+    def labels(self) -> np.ndarray:
+        """Labels of all chunks, in insertion order."""
+        return self._cols["label"][self._alive_rows()]
+
+    def max_label(self) -> int:
+        """Largest label in the store, or -1."""
+        live = np.flatnonzero(self._row_of_label >= 0)
+        return int(live[-1]) if live.size else -1
+
+    def items(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        for label in self.labels().tolist():
+            yield label, self._materialize(self._row(label))
+
+    def values(self) -> Iterator[Dict[str, Any]]:
+        for _, entry in self.items():
+            yield entry
+
+    def put(self, label, entry: Dict[str, Any]):
+        """
+        Insert or replace a chunk.
+
+        Args:
+            label: Index label of the chunk
+            entry: Dict with "content", "file_path", "metadata" and optionally
+                "contextual_content" and "duplicate_of"
+        """
+        self._writable()
+        label = int(label)
+        old = self._row(label)
+        if old >= 0:
+            self._kill(old)
+        row = self._n
+        self._grow_rows(row + 1)
+        self._n += 1
+        cols = self._cols
+        content = entry["content"]
+        data = content.encode("utf-8")
+        cols["label"][row] = label
+        cols["file_id"][row] = self._files.intern(str(entry["file_path"]))
+        cols["content_off"][row] = self._content.append(data)
+        cols["content_len"][row] = len(data)
+        duplicate_of = entry.get("duplicate_of")
+        cols["duplicate_of"][row] = int(duplicate_of) if duplicate_of is not None else -1
+        flags = _ALIVE | self._write_context(row, content, entry.get("contextual_content"))
+        self._chunk_hash[row] = 0
+        flags |= self._write_metadata(row, entry.get("metadata") or {})
+        cols["flags"][row] = flags
+        self._map_label(label, row)
+        self._changed.add(label)
+        self.version += 1
+        self._count += 1
+        self._maybe_compact()
+
+    # Column access without building entry dicts
+
+    def field(self, label, name: str):
+        """
+        Read one field of a chunk.
+
+        Names: "label", "file_path", "content", "contextual_content",
+        "duplicate_of" (int or None), "metadata" and the column-backed metadata
+        keys "chunk_hash", "file_hash", "chunk_index", "total_chunks",
+        "page_start", "page_end".
+        """
+        return self._field(self._require(label), name)
+
+    def iter_columns(self, *names: str) -> Iterator[Tuple]:
+        """Yield a tuple of the named fields (see ``field``) for every chunk."""
+        for row in self._alive_rows().tolist():
+            yield tuple(self._field(row, name) for name in names)
+
+    def select(self, name: str, predicate: Callable[[Any], bool]) -> np.ndarray:
+        """
+        Labels of the chunks whose field ``name`` satisfies ``predicate``.
+
+        ``name`` is "file_path" or a metadata key; chunks without the key never
+        match. Interned fields (file paths, file hashes, residual metadata) and
+        the typed columns evaluate the predicate once per distinct value and
+        select the rows holding a matching value in one vectorized pass.
+        """
+        cols = self._cols
+        alive = self._alive_rows()
+        if name == "file_path":
+            ids = [i for i, value in enumerate(self._files.values) if predicate(value)]
+            return cols["label"][alive[np.isin(cols["file_id"][alive], ids)]]
+        # Keys are stored in the residual dict when their value does not fit a column
+        ids = [i for i, meta in enumerate(self._meta_dicts) if name in meta and predicate(meta[name])]
+        mask = np.isin(cols["meta"][alive], ids)
+        if name in _INT_FIELDS or name == "file_hash":
+            values = cols[name][alive]
+            distinct = np.unique(values).tolist()
+            if name == "file_hash":
+                decode = lambda v: None if v == _NONE else self._hashes.values[v]
+            else:
+                decode = lambda v: v
+            mask |= np.isin(values, [v for v in distinct if v != _ABSENT and predicate(decode(v))])
+        elif name == "is_contextual":
+            flags = cols["flags"][alive]
+            has = (flags & _HAS_IS_CONTEXTUAL).astype(bool)
+            value = (flags & _IS_CONTEXTUAL).astype(bool)
+            mask |= has & np.where(value, bool(predicate(True)), bool(predicate(False)))
+        elif name == "chunk_hash":
+            mask |= np.array([self._field(row, name) is not None and bool(predicate(self._field(row, name)))
+                              for row in alive.tolist()], dtype=bool)
+        return cols["label"][alive[mask]]
+
+    def owners(self, labels) -> np.ndarray:
+        """Map each label to the label owning its vector (itself unless it is a duplicate)."""
+        labels = np.asarray(labels, dtype=np.int64)
+        targets = self._cols["duplicate_of"][self._rows(labels)]
+        return np.where(targets >= 0, targets, labels)
+
+    def update_metadata(self, label, updates: Dict[str, Any]):
+        """Merge keys into a chunk's metadata."""
+        metadata = self._metadata(self._require(label))
+        metadata.update(updates)
+        row = self._rewrite(label)
+        flags = self._cols["flags"]
+        flags[row] = (int(flags[row]) & _ENTRY_FLAGS) | self._write_metadata(row, metadata)
+        self._maybe_compact()
+
+    def set_duplicate_of(self, label, target: Optional[int], contextual_content: Optional[str] = None):
+        """
+        Point a chunk at the label owning its vector, or make it own its vector.
+
+        Args:
+            label: Chunk to update
+            target: Label of the chunk whose vector it shares, or None
+            contextual_content: Contextual text to record when the chunk becomes
+                the owner of a vector
+        """
+        row = self._rewrite(label)
+        cols = self._cols
+        cols["duplicate_of"][row] = int(target) if target is not None else -1
+        if target is None and contextual_content is not None:
+            self._dead_bytes += int(cols["context_len"][row])
+            context_flags = self._write_context(row, self._field(row, "content"), contextual_content)
+            cols["flags"][row] = (int(cols["flags"][row]) & ~(_HAS_CONTEXT | _CONTEXT_FULL)) | context_flags
+        self._maybe_compact()
+
+    def take_changes(self) -> List[int]:
+        """Return the labels changed since the last call, in ascending order, and forget them."""
+        changed, self._changed = self._changed, set()
+        return sorted(changed)
+
+    def mark_changed(self, labels: List[int]):
+        """Report labels as changed again, e.g. after a failed save."""
+        self._changed.update(int(label) for label in labels)
+
+    # Maintenance
+
+    def _live_arrays(self) -> Dict[str, np.ndarray]:
+        """Copy the live rows into fresh, densely packed arrays and blobs."""
+        cols = self._cols
+        alive = self._alive_rows()
+        arrays = {name: column[alive].copy() for name, column in cols.items()}
+        arrays["chunk_hash"] = self._chunk_hash[alive].copy()
+        packed_already = self._dead_bytes == 0 and self._count == self._n
+        for blob_name, blob in (("content", self._content), ("context", self._context)):
+            data = blob.tobytes()
+            if packed_already:
+                arrays[blob_name] = np.frombuffer(data, dtype=np.uint8)
+                continue
+            offsets = arrays[f"{blob_name}_off"]
+            lengths = arrays[f"{blob_name}_len"]
+            packed = bytearray()
+            for i in range(len(alive)):
+                start = int(offsets[i])
+                offsets[i] = len(packed)
+                packed += data[start:start + int(lengths[i])]
+            arrays[blob_name] = np.frombuffer(bytes(packed), dtype=np.uint8)
+        return arrays
+
+    def _tables(self) -> Dict[str, Any]:
+        return {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "files": self._files.values,
+            "hashes": self._hashes.values,
+            "metas": self._metas.values
+        }
+
+    def _load_arrays(self, arrays: Dict[str, np.ndarray], tables: Dict[str, Any]):
+        if tables.get("format") != STORE_FORMAT or tables.get("version") != STORE_VERSION:
+            raise ValueError(f"Unsupported chunk store format: {tables.get('format')} v{tables.get('version')}")
+        self._cols = {name: arrays[name] for name in _COLUMNS}
+        self._chunk_hash = arrays["chunk_hash"]
+        self._n = self._count = len(self._cols["label"])
+        self._dead_bytes = 0
+        self._content = _Blob(arrays["content"])
+        self._context = _Blob(arrays["context"])
+        self._files = _Interner(tables["files"])
+        self._hashes = _Interner(tables["hashes"])
+        self._metas = _Interner(tables["metas"])
+        self._meta_dicts = [json.loads(m) for m in self._metas.values]
+        labels = self._cols["label"]
+        self._row_of_label = np.full(int(labels.max()) + 1 if len(labels) else 0, -1, dtype=np.int64)
+        self._row_of_label[labels] = np.arange(len(labels))
+        self._pages = None  # rows moved: the next snapshot starts over
+
+    def compact(self):
+        """Drop dead rows and the text bytes they occupied."""
+        self._writable()
+        self._load_arrays(self._live_arrays(), self._tables())
+
+    def snapshot(self, exclude=()) -> "ChunkStore":
+        """
+        Read-only view of the store as it is now, for readers that must not see later writes.
+
+        The view shares the columns and text blobs with the store and has a
+        paged copy of the label index. Pages no label of which was remapped
+        since the previous snapshot (and which hold no excluded label) are
+        shared with it; the others are copied. Writes append rows and
+        compactions build new arrays, so neither shows through.
+
+        Args:
+            exclude: Labels to leave out of the view
+        """
+        excluded: Dict[int, np.ndarray] = {}
+        if len(exclude):
+            labels = np.fromiter(exclude, dtype=np.int64, count=len(exclude))
+            labels = labels[labels < len(self._row_of_label)]
+            pages = labels >> _PAGE_BITS
+            excluded = {int(p): labels[pages == p] & (_PAGE - 1) for p in np.unique(pages).tolist()}
+        count = -(-len(self._row_of_label) // _PAGE)
+        if self._pages is None:
+            pages, live, owners = [None] * count, np.zeros(count, dtype=np.int64), np.zeros(count, dtype=np.int64)
+            redo = range(count)
+        else:
+            pages, live, owners, was_excluded = self._pages
+            known = len(pages)
+            pages = pages + [None] * (count - known)
+            live = np.concatenate([live, np.zeros(count - known, dtype=np.int64)])
+            owners = np.concatenate([owners, np.zeros(count - known, dtype=np.int64)])
+            # Pages that hid labels last time may show them now
+            redo = sorted(self._dirty_pages | was_excluded | set(excluded) | set(range(known, count)))
+        duplicate_of = self._cols["duplicate_of"]
+        for p in redo:
+            page = np.full(_PAGE, -1, dtype=np.int64)
+            chunk = self._row_of_label[p * _PAGE:(p + 1) * _PAGE]
+            page[:len(chunk)] = chunk
+            if p in excluded:
+                page[excluded[p]] = -1
+            page.flags.writeable = False
+            rows = page[page >= 0]
+            pages[p], live[p], owners[p] = page, len(rows), int((duplicate_of[rows] < 0).sum())
+        self._pages = (pages, live, owners, set(excluded))
+        self._dirty_pages = set()
+        return ChunkStoreView(self, list(pages), live.copy(), owners.copy())
+
+    def is_owner(self, labels) -> np.ndarray:
+        """Whether each label is a chunk of the store that owns its vector; unknown labels give False."""
+        rows = self._rows(np.asarray(labels, dtype=np.int64))
+        owner = rows >= 0
+        owner[owner] = self._cols["duplicate_of"][rows[owner]] < 0
+        return owner
+
+    def owner_count(self) -> int:
+        """Number of chunks that own their vector."""
+        rows = self._alive_rows()
+        return int((self._cols["duplicate_of"][rows] < 0).sum())
+
+    def _label_index_bytes(self) -> int:
+        return self._row_of_label.nbytes
+
+    def stats(self) -> Dict[str, Any]:
+        """Row counts and memory footprint."""
+        column_bytes = sum(c.nbytes for c in self._cols.values()) + self._chunk_hash.nbytes
+        return {
+            "chunks": self._count,
+            "dead_rows": self._n - self._count,
+            "files": len(self._files.values),
+            "content_bytes": len(self._content),
+            "context_bytes": len(self._context),
+            "dead_bytes": self._dead_bytes,
+            "column_bytes": column_bytes + self._label_index_bytes(),
+            "metadata_groups": len(self._metas.values)
+        }
+
+    # Persistence
+
+    def to_bytes(self) -> bytes:
+        """Serialize the live rows to a compressed archive."""
+        buffer = io.BytesIO()
+        arrays = self._live_arrays()
+        arrays["tables"] = np.frombuffer(json.dumps(self._tables()).encode("utf-8"), dtype=np.uint8)
+        np.savez_compressed(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ChunkStore":
+        with np.load(io.BytesIO(data)) as archive:
+            arrays = {name: archive[name] for name in archive.files}
+        tables = json.loads(arrays.pop("tables").tobytes().decode("utf-8"))
+        store = cls()
+        store._load_arrays(arrays, tables)
+        return store
+
+    def to_payload(self) -> Dict[str, Any]:
+        """JSON-compatible form for the ``mapping_data`` column."""
+        return {
+            "format": STORE_FORMAT,
+            "version": STORE_VERSION,
+            "data": base64.b64encode(self.to_bytes()).decode("utf-8")
+        }
+
+    @classmethod
+    def from_payload(cls, payload: Optional[Dict[str, Any]]) -> "ChunkStore":
+        """Load ``mapping_data``: either a serialized store or a legacy label -> entry dict."""
+        if payload and payload.get("format") == STORE_FORMAT and "data" in payload:
+            return cls.from_bytes(base64.b64decode(payload["data"]))
+        return cls.from_mapping(payload or {})
+
+    @classmethod
+    def from_mapping(cls, mapping: Dict[str, Dict[str, Any]]) -> "ChunkStore":
+        """Build a store from a label -> entry dict."""
+        store = cls()
+        for label, entry in mapping.items():
+            store.put(int(label), entry)
+        return store
+
+    def save(self, directory: str):
+        """Write the live rows as a directory of .npy columns and raw blobs."""
+        arrays = self._live_arrays()
+        tmp = directory.rstrip(os.sep) + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, array in arrays.items():
+            if name in ("content", "context"):
+                array.tofile(os.path.join(tmp, f"{name}.bin"))
+            else:
+                np.save(os.path.join(tmp, f"{name}.npy"), array)
+        with open(os.path.join(tmp, "tables.json"), "w", encoding="utf-8") as f:
+            json.dump(self._tables(), f)
+        old = directory.rstrip(os.sep) + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(directory):
+            os.rename(directory, old)
+        os.rename(tmp, directory)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "ChunkStore":
+        """
+        Open a saved store.
+
+        With ``mmap`` the columns and text blobs are memory-mapped; columns are
+        copy-on-write, so the store stays modifiable without touching the files.
+        """
+        with open(os.path.join(directory, "tables.json"), encoding="utf-8") as f:
+            tables = json.load(f)
+        arrays = {}
+        for name in list(_COLUMNS) + ["chunk_hash"]:
+            arrays[name] = np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="c" if mmap else None)
+        for name in ("content", "context"):
+            path = os.path.join(directory, f"{name}.bin")
+            if mmap and os.path.getsize(path):
+                arrays[name] = np.memmap(path, dtype=np.uint8, mode="r")
+            else:
+                arrays[name] = np.fromfile(path, dtype=np.uint8)
+        store = cls()
+        store._load_arrays(arrays, tables)
+        return store
+
+
+class ChunkStoreView(ChunkStore):
+    """Read-only snapshot of a ChunkStore (see ``ChunkStore.snapshot``)."""
+
+    def __init__(self, store: ChunkStore, pages: List[np.ndarray], live: np.ndarray, owners: np.ndarray):
+        """
+        Args:
+            store: Store the view is taken from
+            pages: Label index pages; row of each label of the page, or -1
+            live: Chunks per page
+            owners: Chunks owning their vector per page
+        """
+        self.__dict__.update(store.__dict__)
+        self._cols = dict(store._cols)
+        self._row_of_label = None
+        self._label_pages = pages
+        self._page_live = live
+        self._page_owners = owners
+        self._count = int(live.sum())
+        self._changed = set()
+        self._pages = None
+        self._dirty_pages = set()
+        self.frozen = True
+
+    def _row(self, label) -> int:
+        try:
+            label = int(label)
+        except (TypeError, ValueError):
+            return -1
+        if 0 <= label < len(self._label_pages) * _PAGE:
+            return int(self._label_pages[label >> _PAGE_BITS][label & (_PAGE - 1)])
+        return -1
+
+    def _rows(self, labels: np.ndarray) -> np.ndarray:
+        rows = np.full(len(labels), -1, dtype=np.int64)
+        known = np.flatnonzero((labels >= 0) & (labels < len(self._label_pages) * _PAGE))
+        pages = labels[known] >> _PAGE_BITS
+        for p in np.unique(pages).tolist():
+            on_page = known[pages == p]
+            rows[on_page] = self._label_pages[p][labels[on_page] & (_PAGE - 1)]
+        return rows
+
+    def _alive_rows(self) -> np.ndarray:
+        # Killed rows keep their place in the shared flags; the pages say what the view holds
+        rows = [page[page >= 0] for p, page in enumerate(self._label_pages) if self._page_live[p]]
+        return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+    def _live_arrays(self) -> Dict[str, np.ndarray]:
+        arrays = super()._live_arrays()
+        arrays["flags"] = arrays["flags"] | np.uint8(_ALIVE)
+        return arrays
+
+    def _label_index_bytes(self) -> int:
+        return sum(page.nbytes for page in self._label_pages)
+
+    def max_label(self) -> int:
+        for p in range(len(self._label_pages) - 1, -1, -1):
+            if self._page_live[p]:
+                return p * _PAGE + int(np.flatnonzero(self._label_pages[p] >= 0)[-1])
+        return -1
+
+    def owner_count(self) -> int:
+        return int(self._page_owners.sum())
@@ -0,0 +1,147 @@
+"""
+Single-pass recursive text chunker.
+
+Follows the separator-priority semantics of LangChain's
+RecursiveCharacterTextSplitter (with keep_separator=True and whitespace
+stripping) but works on (start, end) offsets into the original string instead
+of building intermediate strings and Document objects.
+"""
+import re
+from collections import deque
+from typing import List, NamedTuple, Optional, Callable
+
+DEFAULT_SEPARATORS = ["\n## ", "\n### ", "\n#### ", "\n\n", "\n", ". ", " ", ""]
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+class Chunk(NamedTuple):
+    text: str
+    start: int  # offset of the (stripped) chunk in the source text
+    end: int
+
+
+def count_tokens(text: str) -> int:
+    """Approximate token count: words and punctuation marks."""
+    return sum(1 for _ in _TOKEN_RE.finditer(text))
+
+
+def chunk_text(
+    text: str,
+    chunk_size: int = 4000,
+    chunk_overlap: int = 400,
+    separators: Optional[List[str]] = None,
+    length_unit: str = "chars"
+) -> List[Chunk]:
+    """
+    Split text into overlapping chunks, preferring the earliest separator.
+
+    Args:
+        text: Text to split
+        chunk_size: Maximum chunk size in ``length_unit``
+        chunk_overlap: Overlap between consecutive chunks in ``length_unit``
+        separators: Separators in priority order (default: markdown headings,
+            paragraphs, lines, sentences, words, characters)
+        length_unit: "chars" or "tokens" (approximate, see count_tokens)
+
+    Returns:
+        List[Chunk]: Chunks with their character offsets in ``text``
+    """
+    if chunk_overlap > chunk_size:
+        raise ValueError(f"chunk_overlap ({chunk_overlap}) is larger than chunk_size ({chunk_size})")
+    if length_unit not in ("chars", "tokens"):
+        raise ValueError(f"Unknown length_unit: {length_unit}")
+    separators = DEFAULT_SEPARATORS if separators is None else separators
+
+    if length_unit == "chars":
+        length: Callable[[int, int], int] = lambda a, b: b - a
+    else:
+        length = lambda a, b: count_tokens(text[a:b])
+
+    chunks: List[Chunk] = []
+
+    def emit(a: int, b: int):
+        piece = text[a:b]
+        stripped = piece.strip()
+        if stripped:
+            lead = len(piece) - len(piece.lstrip())
+            chunks.append(Chunk(stripped, a + lead, a + lead + len(stripped)))
+
+    def merge(spans: List[tuple]):
+        # spans are consecutive, so a merged chunk is always one contiguous slice
+        current = deque()
+        total = 0
+        for a, b, n in spans:
+            if total + n > chunk_size and current:
+                emit(current[0][0], current[-1][1])
+                while total > chunk_overlap or (total + n > chunk_size and total > 0):
+                    total -= current.popleft()[2]
+            current.append((a, b, n))
+            total += n
+        if current:
+            emit(current[0][0], current[-1][1])
+
+    def window(lo: int, hi: int):
+        # Character-level fallback: fixed windows with the configured overlap
+        start = lo
+        step = max(chunk_size - chunk_overlap, 1)
+        while True:
+            end = min(start + chunk_size, hi)
+            emit(start, end)
+            if end >= hi:
+                break
+            start += step
+
+    def split(lo: int, hi: int, seps: List[str]):
+        separator = seps[-1] if seps else ""
+        remaining: List[str] = []
+        for i, sep in enumerate(seps):
+            if not sep:
+                separator = sep
+                break
+            if text.find(sep, lo, hi) != -1:
+                separator = sep
+                remaining = seps[i + 1:]
+                break
+
+        if not separator:
+            if length_unit == "chars":
+                window(lo, hi)
+            else:
+                merge([(i, i + 1, length(i, i + 1)) for i in range(lo, hi)])
+            return
+
+        # Each piece starts with the separator that preceded it
+        bounds = [lo]
+        pos = text.find(separator, lo, hi)
+        while pos != -1:
+            if pos > bounds[-1]:
+                bounds.append(pos)
+            pos = text.find(separator, pos + len(separator), hi)
+        bounds.append(hi)
+
+        good = []
+        for a, b in zip(bounds, bounds[1:]):
+            n = length(a, b)
+            if n < chunk_size:
+                good.append((a, b, n))
+                continue
+            if good:
+                merge(good)
+                good = []
+            if remaining:
+                split(a, b, remaining)
+            else:
+                emit(a, b)
+        if good:
+            merge(good)
+
+    if text:
+        split(0, len(text), separators)
+    return chunks
+
+
+def split_text(text: str, chunk_size: int = 4000, chunk_overlap: int = 400,
+               separators: Optional[List[str]] = None, length_unit: str = "chars") -> List[str]:
+    """Split text into chunk strings; see chunk_text."""
+    return [c.text for c in chunk_text(text, chunk_size, chunk_overlap, separators, length_unit)]
@@ -0,0 +1,233 @@
+"""
+Named collections served from one process.
+
+Each collection is a DocumentIndexer with its own ``index_name``, so its
+snapshot, delta log and caches are isolated from the others. The manager
+loads a collection on first use and keeps recently used ones resident while
+their estimated memory stays under COLLECTION_MEMORY_BUDGET; beyond that the
+least recently used idle collection is flushed (its pending changes are
+appended to the delta log) and dropped. It is loaded again on next use.
+"""
+import contextlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional
+
+from indexing import DocumentIndexer
+from scheduler import WorkScheduler
+
+DEFAULT_COLLECTION = os.getenv("KB_DEFAULT_COLLECTION", "kb")
+COLLECTION_MEMORY_BUDGET = int(float(os.getenv("KB_COLLECTION_MEMORY_MB", "2048")) * 1024 * 1024)
+MAX_COLLECTIONS = int(os.getenv("KB_MAX_COLLECTIONS", "32"))  # resident at once
+# "#" is reserved for shard rows in hnsw_indices
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class _Resident:
+    def __init__(self, indexer: DocumentIndexer, load_seconds: float):
+        self.indexer = indexer
+        self.loaded_at = time.time()
+        self.load_seconds = load_seconds
+        self.last_used = self.loaded_at
+        self.uses = 0
+        self.active = 0  # requests currently using the collection
+
+
+class CollectionManager:
+    def __init__(self, client, scheduler: Optional[WorkScheduler] = None,
+                 memory_budget: int = COLLECTION_MEMORY_BUDGET, max_resident: int = MAX_COLLECTIONS):
+        """
+        Initialize the manager; collections load on first use.
+
+        Args:
+            client: Supabase client shared by all collections
+            scheduler: Scheduler for upstream API calls
+            memory_budget: Bytes the resident collections may use together
+            max_resident: Maximum number of resident collections
+        """
+        self.client = client
+        self.scheduler = scheduler
+        self.memory_budget = memory_budget
+        self.max_resident = max_resident
+        self._resident: "OrderedDict[str, _Resident]" = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+        self._loading: Dict[str, threading.Lock] = {}
+        self._pinned = set()
+        self._history: Dict[str, Dict[str, Any]] = {}  # loads and evictions per collection
+
+    @staticmethod
+    def validate(name: str) -> str:
+        if not COLLECTION_NAME.match(name or ""):
+            raise ValueError(f"Invalid collection name '{name}': use 1-64 letters, digits, '-' or '_'")
+        return name
+
+    def load(self, name: str, pin: bool = False, background_load: bool = False, hold: bool = False) -> DocumentIndexer:
+        """
+        Return the collection's indexer, loading it if it is not resident.
+
+        Args:
+            name: Collection name
+            pin: Never evict the collection (used for the default collection)
+            background_load: Return before a stale or missing snapshot is downloaded
+            hold: Count the caller as active until ``release`` (see ``acquire``)
+        """
+        self.validate(name)
+        with self._lock:
+            if pin:
+                self._pinned.add(name)
+            resident = self._touch(name, hold)
+            if resident is not None:
+                return resident.indexer
+            loading = self._loading.setdefault(name, threading.Lock())
+
+        with loading:  # one load per collection; concurrent callers wait for it
+            with self._lock:
+                resident = self._touch(name, hold)
+                if resident is not None:
+                    return resident.indexer
+            started = time.time()
+            print(f"📂 Loading collection '{name}'")
+            indexer = DocumentIndexer(self.client, index_name=name, scheduler=self.scheduler,
+                                      background_load=background_load)
+            resident = _Resident(indexer, round(time.time() - started, 3))
+            resident.active = int(hold)
+            with self._lock:
+                self._resident[name] = resident
+                history = self._history.setdefault(name, {"loads": 0, "evictions": 0, "last_evicted_at": None})
+                history["loads"] += 1
+        self._evict_over_budget(keep=name)
+        return indexer
+
+    def _touch(self, name: str, hold: bool = False) -> Optional[_Resident]:
+        """Mark a resident collection as most recently used; the caller holds the lock."""
+        resident = self._resident.get(name)
+        if resident is not None:
+            self._resident.move_to_end(name)
+            resident.last_used = time.time()
+            resident.uses += 1
+            resident.active += int(hold)
+        return resident
+
+    def acquire(self, name: str) -> DocumentIndexer:
+        """Load a collection and hold it until ``release``, so it is not evicted while a request uses it."""
+        return self.load(name, hold=True)
+
+    def release(self, name: str):
+        with self._lock:
+            resident = self._resident.get(name)
+            if resident is not None and resident.active > 0:
+                resident.active -= 1
+        self._evict_over_budget()
+
+    @contextlib.contextmanager
+    def use(self, name: str) -> Iterator[DocumentIndexer]:
+        indexer = self.acquire(name)
+        try:
+            yield indexer
+        finally:
+            self.release(name)
+
+    def _memory(self, resident: _Resident) -> int:
+        try:
+            return resident.indexer.memory_report()["total_bytes"]
+        except Exception:
+            return 0
+
+    def _evict_over_budget(self, keep: Optional[str] = None):
+        """Evict least recently used idle collections while over the memory or count budget."""
+        while True:
+            with self._lock:
+                residents = list(self._resident.items())
+                total = sum(self._memory(r) for _, r in residents)
+                if total <= self.memory_budget and len(residents) <= self.max_resident:
+                    return
+                victim = next((name for name, r in residents
+                               if name != keep and name not in self._pinned and not r.active
+                               and r.indexer.store is not None and self._lock_loading(name)), None)
+                if victim is None:
+                    return  # everything left is pinned, busy or has nowhere to flush to
+                resident = self._resident.pop(victim)
+            self._flush(victim, resident, total)
+
+    def _lock_loading(self, name: str) -> bool:
+        """
+        Take a collection's load lock without waiting; the caller holds ``_lock``.
+
+        An evicted collection keeps it until its flush is done, so a reload
+        waits for the final log append instead of reading around it.
+        """
+        return self._loading.setdefault(name, threading.Lock()).acquire(blocking=False)
+
+    def _flush(self, name: str, resident: _Resident, total: int):
+        """Close an evicted collection and release the load lock taken by ``_lock_loading``."""
+        print(f"⏏️ Evicting collection '{name}' ({total / 1e6:.0f} MB resident, budget {self.memory_budget / 1e6:.0f} MB)")
+        try:
+            resident.indexer.close()
+        except Exception as e:
+            print(f"Error flushing collection '{name}' before eviction: {e}")
+        finally:
+            self._loading[name].release()
+        with self._lock:
+            history = self._history[name]
+            history["evictions"] += 1
+            history["last_evicted_at"] = time.time()
+
+    def evict(self, name: str) -> bool:
+        """Flush and drop a resident collection; returns False if it is not resident, pinned or in use."""
+        with self._lock:
+            resident = self._resident.get(name)
+            if resident is None or name in self._pinned or resident.active or not self._lock_loading(name):
+                return False
+            del self._resident[name]
+            residents = list(self._resident.values())
+        self._flush(name, resident, sum(self._memory(r) for r in residents))
+        return True
+
+    def names(self) -> List[str]:
+        """Resident collections plus those stored in the persistence backend."""
+        with self._lock:
+            names = set(self._resident)
+            residents = list(self._resident.values())
+        for resident in residents:
+            store = resident.indexer.store
+            if store is not None:
+                try:
+                    names.update(store.list_indexes())
+                except Exception as e:
+                    print(f"Could not list stored collections: {e}")
+                break
+        return sorted(names)
+
+    def stats(self) -> Dict[str, Any]:
+        """Residency, load times, memory and eviction history per collection."""
+        with self._lock:
+            residents = list(self._resident.items())
+            history = {name: dict(h) for name, h in self._history.items()}
+        collections = {}
+        for name, r in residents:
+            collections[name] = {
+                "resident": True,
+                "ready": r.indexer.ready.is_set(),
+                "pinned": name in self._pinned,
+                "active_requests": r.active,
+                "loaded_at": r.loaded_at,
+                "load_seconds": r.load_seconds,
+                "load": r.indexer.load_status,
+                "last_used": r.last_used,
+                "uses": r.uses,
+                "chunks": len(r.indexer.mapping),
+                "memory_bytes": self._memory(r),
+                **history.get(name, {})
+            }
+        for name, h in history.items():
+            collections.setdefault(name, {"resident": False, **h})
+        return {
+            "resident": len(residents),
+            "memory_bytes": sum(c.get("memory_bytes", 0) for c in collections.values()),
+            "memory_budget_bytes": self.memory_budget,
+            "max_resident": self.max_resident,
+            "collections": collections
+        }
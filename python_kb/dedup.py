@@ -0,0 +1,130 @@
+"""
+Exact and near-duplicate chunk detection with MinHash and LSH banding.
+
+Chunks are shingled into overlapping word n-grams. Exact duplicates are found
+by content hash. Near duplicates are found by MinHash signatures bucketed per
+LSH band and confirmed with the estimated Jaccard similarity.
+"""
+import hashlib
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+SHINGLE_SIZE = 5          # words per shingle
+NUM_PERM = 128            # MinHash permutations
+NUM_BANDS = 16            # LSH bands (NUM_PERM / NUM_BANDS rows each)
+DEFAULT_THRESHOLD = 0.85  # Minimum estimated Jaccard similarity for a near duplicate
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _shingle_hashes(text: str, size: int) -> np.ndarray:
+    """Hash the word n-grams of a text to 64-bit integers."""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles),
+        dtype=np.uint64,
+        count=len(shingles)
+    )
+
+
+class ChunkDeduplicator:
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = NUM_PERM,
+                 num_bands: int = NUM_BANDS, shingle_size: int = SHINGLE_SIZE, seed: int = 1):
+        """
+        Initialize an empty deduplicator.
+
+        Args:
+            threshold: Minimum estimated Jaccard similarity to treat chunks as duplicates
+            num_perm: Number of MinHash permutations
+            num_bands: Number of LSH bands; num_perm must be divisible by it
+            shingle_size: Words per shingle
+            seed: Seed for the permutation parameters
+        """
+        if num_perm % num_bands:
+            raise ValueError("num_perm must be divisible by num_bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.rows = num_perm // num_bands
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, int(_MERSENNE_PRIME), size=num_perm, dtype=np.uint64)
+        self.exact: Dict[str, int] = {}                       # chunk hash -> label
+        self.signatures: Dict[int, np.ndarray] = {}           # label -> uint32 signature
+        self.chunk_hashes: Dict[int, str] = {}                # label -> chunk hash
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(num_bands)]
+
+    def signature(self, text: str) -> np.ndarray:
+        """Compute the MinHash signature of a text."""
+        hashes = _shingle_hashes(text, self.shingle_size)
+        if hashes.size == 0:
+            return np.full(self.num_perm, np.uint32(0xFFFFFFFF), dtype=np.uint32)
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self._a) + self._b) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=0).astype(np.uint32)
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.num_bands)]
+
+    def find(self, text: str, chunk_hash: str, signature: Optional[np.ndarray] = None) -> Tuple[Optional[int], np.ndarray]:
+        """
+        Look for an indexed chunk that duplicates this one.
+
+        Returns:
+            Tuple containing:
+            - The label of the duplicate, or None
+            - The chunk's signature (reusable for add)
+        """
+        if signature is None:
+            signature = self.signature(text)
+        label = self.exact.get(chunk_hash)
+        if label is not None:
+            return label, signature
+        best, best_score = None, self.threshold
+        seen = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            for candidate in self.buckets[band].get(key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                score = float(np.mean(self.signatures[candidate] == signature))
+                if score >= best_score:
+                    best, best_score = candidate, score
+        return best, signature
+
+    def add(self, label: int, text: str, chunk_hash: str, signature: Optional[np.ndarray] = None):
+        """Register a chunk that owns a vector so later chunks can match it."""
+        if signature is None:
+            signature = self.signature(text)
+        self.exact.setdefault(chunk_hash, label)
+        self.signatures[label] = signature
+        self.chunk_hashes[label] = chunk_hash
+        for band, key in enumerate(self._band_keys(signature)):
+            self.buckets[band].setdefault(key, []).append(label)
+
+    def remove(self, label: int):
+        """Forget a chunk, e.g. when its vector is retired."""
+        signature = self.signatures.pop(label, None)
+        chunk_hash = self.chunk_hashes.pop(label, None)
+        if chunk_hash is not None and self.exact.get(chunk_hash) == label:
+            del self.exact[chunk_hash]
+        if signature is None:
+            return
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self.buckets[band].get(key)
+            if bucket and label in bucket:
+                bucket.remove(label)
+                if not bucket:
+                    del self.buckets[band][key]
+
+    def __len__(self) -> int:
+        return len(self.signatures)
@@ -0,0 +1,131 @@
+"""
+Size-bounded LRU key/value cache persisted in SQLite.
+
+Safe to share between threads and between the processes of an extraction
+pool: every process opens its own connection and SQLite serializes writers.
+Hit/miss counters are stored in the database so they aggregate across processes.
+"""
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Dict, Any, Optional
+
+DEFAULT_CACHE_DIR = os.getenv("KB_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+
+
+class SQLiteLRUCache:
+    def __init__(self, path: str, max_bytes: int, compress: bool = True):
+        """
+        Initialize the cache.
+
+        Args:
+            path: SQLite database file
+            max_bytes: Maximum total size of stored values before LRU eviction
+            compress: Whether to zlib-compress stored values
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _connection(self) -> sqlite3.Connection:
+        """Return this process's connection, creating the schema on first use."""
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _bump(self, conn: sqlite3.Connection, name: str, amount: int = 1):
+        conn.execute(
+            "INSERT INTO counters(name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Return the cached value for a key, or None on a miss."""
+        try:
+            with self._lock:
+                conn = self._connection()
+                row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self._bump(conn, "misses")
+                    conn.commit()
+                    return None
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._bump(conn, "hits")
+                conn.commit()
+            value = row[0]
+            return zlib.decompress(value) if self.compress else value
+        except sqlite3.Error as e:
+            print(f"⚠️ Cache read failed ({self.path}): {e}")
+            return None
+
+    def put(self, key: str, value: bytes):
+        """Store a value and evict least recently used entries past the size cap."""
+        stored = zlib.compress(value, 3) if self.compress else value
+        if len(stored) > self.max_bytes:
+            return
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries(key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, stored, len(stored), time.time())
+                )
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                evicted = 0
+                while total > self.max_bytes:
+                    row = conn.execute("SELECT key, size FROM entries ORDER BY last_access LIMIT 1").fetchone()
+                    if row is None:
+                        break
+                    conn.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+                    total -= row[1]
+                    evicted += 1
+                if evicted:
+                    self._bump(conn, "evictions", evicted)
+                conn.commit()
+        except sqlite3.Error as e:
+            print(f"⚠️ Cache write failed ({self.path}): {e}")
+
+    def clear(self):
+        """Remove every entry and reset the counters."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM entries")
+            conn.execute("DELETE FROM counters")
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss/eviction counters and current size."""
+        with self._lock:
+            conn = self._connection()
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "path": self.path,
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "evictions": counters.get("evictions", 0),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+        }
@@ -1,8 +1,162 @@
+import pymupdf
 import pymupdf4llm
-from langchain.text_splitter import MarkdownTextSplitter, RecursiveCharacterTextSplitter
-from typing import List
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 from pathlib import Path
+import bisect
+import json
+import multiprocessing
+import queue
+import time
 import os
+from chunking import Chunk, chunk_text
+from disk_cache import SQLiteLRUCache, DEFAULT_CACHE_DIR
+from manifest import file_sha256
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt')
+
+# Pages converted per pymupdf4llm call on the streaming PDF path
+PAGES_PER_WINDOW = 20
+
+# Extracted markdown cache; bump EXTRACTOR_VERSION when extraction output changes
+EXTRACT_CACHE_ENABLED = os.getenv("KB_EXTRACT_CACHE", "1") != "0"
+EXTRACT_CACHE_MAX_BYTES = int(os.getenv("KB_EXTRACT_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+EXTRACTOR_VERSION = f"pymupdf4llm-{getattr(pymupdf4llm, '__version__', 'unknown')}/md-pages-1"
+
+_extraction_cache = None
+
+# Per-file extraction timeout for the parallel path (seconds)
+FILE_TIMEOUT = 600
+
+# Recycle pool workers periodically so pymupdf memory growth stays bounded
+MAX_TASKS_PER_WORKER = 50
+
+# Chunk records per message when a file's records are streamed from the pool
+RECORDS_PER_PART = 32
+
+# Extraction workers are started fresh rather than forked: the service process
+# runs threads (event loop, scheduler, persistence) whose locks a fork would
+# copy in whatever state they happen to be in
+POOL_START_METHOD = os.getenv("KB_EXTRACT_START_METHOD", "spawn")
+
+
+def get_extraction_cache() -> Optional[SQLiteLRUCache]:
+    """Return the shared extraction cache, or None if caching is disabled."""
+    global _extraction_cache
+    if EXTRACT_CACHE_ENABLED and _extraction_cache is None:
+        _extraction_cache = SQLiteLRUCache(os.path.join(DEFAULT_CACHE_DIR, "extraction.db"), EXTRACT_CACHE_MAX_BYTES)
+    return _extraction_cache
+
+
+def _window_markdown(doc, pages: List[int], file_hash: Optional[str]) -> List[str]:
+    """
+    Convert a window of pages to markdown, one string per page.
+    
+    Results are cached under the file's content hash, the extractor version and
+    the page range, so re-chunking or rebuilding an index never parses the same
+    pages twice.
+    """
+    cache = get_extraction_cache() if file_hash else None
+    key = f"{file_hash}:{EXTRACTOR_VERSION}:{pages[0]}-{pages[-1]}"
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+    page_chunks = pymupdf4llm.to_markdown(doc, pages=pages, page_chunks=True)
+    texts = [page["text"] for page in page_chunks]
+    if cache is not None:
+        cache.put(key, json.dumps(texts).encode('utf-8'))
+    return texts
+
+
+def _page_records(chunks: List[Chunk], bounds: List[Tuple[int, int]]) -> Iterator[Dict[str, Any]]:
+    """
+    Attach a page range to each chunk.
+    
+    Args:
+        chunks: Chunks with offsets into the text they were split from
+        bounds: Sorted (offset, page_number) pairs marking where pages start
+        
+    Yields:
+        Chunk records with "content", "page_start" and "page_end"
+    """
+    offsets = [b[0] for b in bounds]
+    
+    def page_at(pos: int) -> int:
+        return bounds[max(bisect.bisect_right(offsets, pos) - 1, 0)][1]
+    
+    for chunk in chunks:
+        yield {
+            "content": chunk.text,
+            "page_start": page_at(chunk.start),
+            "page_end": page_at(max(chunk.end - 1, chunk.start))
+        }
+
+
+def iter_pdf_chunks(
+    file_path: str,
+    chunk_size: int = 4000,
+    chunk_overlap: int = 400,
+    pages_per_window: int = PAGES_PER_WINDOW,
+    file_hash: Optional[str] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Stream chunks from a PDF, converting it a window of pages at a time.
+    
+    Only the current window's markdown plus the unfinished last chunk of the
+    previous window are held in memory, so memory use does not grow with the
+    document and the first chunks are available after the first window.
+    
+    Args:
+        file_path: Path to the PDF file
+        chunk_size: Size of each text chunk
+        chunk_overlap: Overlap between chunks
+        pages_per_window: Number of pages converted per pymupdf4llm call
+        file_hash: Content hash of the file if the caller already has it; keys
+            the extraction cache (computed here when missing)
+        
+    Yields:
+        Dict with "content", "page_start" and "page_end" (1-based, inclusive)
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"PDF file not found: {file_path}")
+    
+    if file_hash is None and get_extraction_cache() is not None:
+        file_hash = file_sha256(file_path)
+    doc = pymupdf.open(file_path)
+    try:
+        carry = ""
+        carry_bounds = []  # (offset, page_number) for pages that start inside carry
+        for window_start in range(0, doc.page_count, pages_per_window):
+            pages = list(range(window_start, min(window_start + pages_per_window, doc.page_count)))
+            page_texts = _window_markdown(doc, pages, file_hash)
+            
+            # Stitch the carried tail and this window together, remembering where each page starts
+            parts = [carry]
+            bounds = list(carry_bounds)
+            offset = len(carry)
+            for page_number, text in zip(pages, page_texts):
+                bounds.append((offset, page_number + 1))
+                parts.append(text)
+                offset += len(text)
+            buffer = "".join(parts)
+            del parts, page_texts
+            
+            chunks = chunk_text(buffer, chunk_size, chunk_overlap)
+            if not chunks:
+                carry, carry_bounds = "", []
+                continue
+            
+            # Hold back the last chunk: it may continue into the next window
+            yield from _page_records(chunks[:-1], bounds)
+            tail_start = chunks[-1].start
+            tail_page = next(_page_records(chunks[-1:], bounds))["page_start"]
+            carry = buffer[tail_start:]
+            carry_bounds = [(0, tail_page)] + [(o - tail_start, p) for o, p in bounds if o > tail_start]
+        
+        if carry.strip():
+            yield from _page_records(chunk_text(carry, chunk_size, chunk_overlap), carry_bounds)
+    finally:
+        doc.close()
 
 
 def extract_pdf_text(file_path: str, chunk_size: int = 4000, chunk_overlap: int = 400) -> List[str]:
@@ -18,21 +172,7 @@ def extract_pdf_text(file_path: str, chunk_size: int = 4000, chunk_overlap: int
         List[str]: List of text chunks
     """
     try:
-        if not os.path.exists(file_path):
-            raise FileNotFoundError(f"PDF file not found: {file_path}")
-            
-        # Extract text from PDF using pymupdf4llm
-        md_text = pymupdf4llm.to_markdown(file_path)
-        
-        # Use RecursiveCharacterTextSplitter for better semantic chunking
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            separators=["\n## ", "\n### ", "\n#### ", "\n\n", "\n", ". ", " ", ""],
-            keep_separator=True
-        )
-        documents = splitter.create_documents([md_text])
-        chunks = [doc.page_content for doc in documents]
+        chunks = [c["content"] for c in iter_pdf_chunks(file_path, chunk_size, chunk_overlap)]
         
         # Print chunk stats
         total_chars = sum(len(chunk) for chunk in chunks)
@@ -63,15 +203,8 @@ def extract_txt_text(file_path: str, chunk_size: int = 4000, chunk_overlap: int
         with open(file_path, 'r', encoding='utf-8') as file:
             text = file.read()
         
-        # Use RecursiveCharacterTextSplitter for better semantic chunking
-        splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            separators=["\n## ", "\n### ", "\n#### ", "\n\n", "\n", ". ", " ", ""],
-            keep_separator=True
-        )
-        documents = splitter.create_documents([text])
-        chunks = [doc.page_content for doc in documents]
+        # Split on markdown headings, then paragraphs, sentences and words
+        chunks = [c.text for c in chunk_text(text, chunk_size, chunk_overlap)]
         
         # Print chunk stats
         total_chars = sum(len(chunk) for chunk in chunks)
@@ -98,20 +231,300 @@ def process_directory(directory_path: str, chunk_size: int = 4000, chunk_overlap
     all_chunks = []
     file_count = 0
     try:
-        for file_path in Path(directory_path).glob('*.*'):
-            if file_path.suffix.lower() == '.pdf':
-                chunks = extract_pdf_text(str(file_path), chunk_size, chunk_overlap)
-                file_count += 1
-            elif file_path.suffix.lower() == '.txt':
-                chunks = extract_txt_text(str(file_path), chunk_size, chunk_overlap)
-                file_count += 1
-            else:
-                continue
-            all_chunks.extend(chunks)
+        for file_path in iter_directory_files(directory_path, recursive=False):
+            all_chunks.extend(r["content"] for r in iter_file_records(str(file_path), chunk_size, chunk_overlap))
+            file_count += 1
         
         # Print summary
         print(f"Processed {file_count} files into {len(all_chunks)} chunks from directory: {directory_path}")
         
         return all_chunks
     except Exception as e:
-        raise Exception(f"Error processing directory: {str(e)}") 
\ No newline at end of file
+        raise Exception(f"Error processing directory: {str(e)}") 
+
+def extract_file_text(file_path: str, chunk_size: int = 4000, chunk_overlap: int = 400) -> List[str]:
+    """
+    Extract and chunk a single supported file, dispatching on its extension.
+    
+    Args:
+        file_path: Path to a PDF or TXT file
+        chunk_size: Size of each text chunk
+        chunk_overlap: Overlap between chunks
+        
+    Returns:
+        List[str]: List of text chunks
+    """
+    suffix = Path(file_path).suffix.lower()
+    if suffix == '.pdf':
+        return extract_pdf_text(str(file_path), chunk_size, chunk_overlap)
+    if suffix == '.txt':
+        return extract_txt_text(str(file_path), chunk_size, chunk_overlap)
+    raise ValueError(f"Unsupported file type: {file_path}")
+
+
+def iter_file_records(file_path: str, chunk_size: int = 4000, chunk_overlap: int = 400,
+                      file_hash: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the chunks of a single supported file, keeping page numbers for PDFs.
+    
+    Args:
+        file_path: Path to a PDF or TXT file
+        chunk_size: Size of each text chunk
+        chunk_overlap: Overlap between chunks
+        file_hash: Content hash of the file, if known (see iter_pdf_chunks)
+        
+    Yields:
+        Chunk records with "content" and, for PDFs, "page_start"/"page_end"
+    """
+    suffix = Path(file_path).suffix.lower()
+    if suffix == '.pdf':
+        yield from iter_pdf_chunks(str(file_path), chunk_size, chunk_overlap, file_hash=file_hash)
+    elif suffix == '.txt':
+        yield from ({"content": c} for c in extract_txt_text(str(file_path), chunk_size, chunk_overlap))
+    else:
+        raise ValueError(f"Unsupported file type: {file_path}")
+
+
+def iter_parts(records: Iterable[Dict[str, Any]], part_size: int = RECORDS_PER_PART) -> Iterator[List[Dict[str, Any]]]:
+    """Group a stream of chunk records into lists of up to ``part_size``."""
+    part = []
+    for record in records:
+        part.append(record)
+        if len(part) >= part_size:
+            yield part
+            part = []
+    if part:
+        yield part
+
+
+def iter_directory_files(directory_path: str, recursive: bool = True) -> Iterator[Path]:
+    """
+    Yield supported files in a directory in a stable order.
+    
+    Args:
+        directory_path: Path to the directory containing files
+        recursive: Whether to descend into subdirectories
+    """
+    pattern = '**/*' if recursive else '*'
+    for file_path in sorted(Path(directory_path).glob(pattern)):
+        if file_path.is_file() and file_path.suffix.lower() in SUPPORTED_EXTENSIONS:
+            yield file_path
+
+
+_parts = None  # queue this pool worker sends record parts to, set by _init_worker
+
+
+def _init_worker(parts):
+    global _parts
+    _parts = parts
+
+
+def _extract_worker(file_path: str, chunk_size: int, chunk_overlap: int, file_hash: Optional[str], skip: int,
+                    part_size: int):
+    """
+    Pool entry point; must stay at module level so it can be pickled.
+    
+    Sends (file_path, records, last, error) messages: the file's records in
+    parts, or a last message carrying the error. The first ``skip`` records
+    were delivered by a worker of a recycled pool; they are extracted again
+    but sent as empty parts, which only show the file is making progress.
+    """
+    try:
+        parts = iter_parts(iter_file_records(file_path, chunk_size, chunk_overlap, file_hash), part_size)
+        part = next(parts, [])
+        for following in parts:  # hold one part back to mark the last
+            _parts.put((file_path, part[skip:], False, None))
+            skip = max(0, skip - len(part))
+            part = following
+        _parts.put((file_path, part[skip:], True, None))
+    except Exception as e:
+        _parts.put((file_path, None, True, str(e)))
+
+
+def iter_records_parallel(
+    file_paths: Iterable,
+    chunk_size: int = 4000,
+    chunk_overlap: int = 400,
+    max_workers: Optional[int] = None,
+    timeout: Optional[float] = FILE_TIMEOUT,
+    file_hashes: Optional[Dict[str, str]] = None,
+    part_size: int = RECORDS_PER_PART
+) -> Iterator[Tuple[str, Optional[List[Dict[str, Any]]], bool]]:
+    """
+    Extract files in a process pool and stream their chunk records as they are produced.
+    
+    Workers send each file's records in parts of ``part_size`` through a
+    bounded queue, so no side holds a whole file's records and a consumer
+    that falls behind holds extraction up. At most ``max_workers`` files are
+    in flight at once. A file fails when its extraction raises or when no part
+    of it arrives for ``timeout`` seconds of the consumer waiting; it is
+    reported and ends with a ``(file_path, None, True)`` that tells the
+    consumer to drop any parts of it already yielded. A timeout
+    recycles the pool (the hung worker is killed); the other in-flight files
+    are resubmitted and resume after the records already yielded.
+    
+    Args:
+        file_paths: Files to extract
+        chunk_size: Size of each text chunk
+        chunk_overlap: Overlap between chunks
+        max_workers: Number of worker processes (default: CPU count)
+        timeout: Seconds without progress after which a file is abandoned, or None to wait indefinitely
+        file_hashes: Content hashes already computed for the files, by path;
+            workers reuse them instead of hashing the files again
+        part_size: Records per part
+        
+    Yields:
+        (file_path, records, last): the parts of each file in order, with the
+        files interleaved; ``last`` marks a file's final (possibly empty) part
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    file_hashes = file_hashes or {}
+    pending = [str(p) for p in file_paths]
+    pending.reverse()  # pop() from the end keeps the original order
+    context = multiprocessing.get_context(POOL_START_METHOD)
+    in_flight = {}  # file_path -> time of its submission or last part
+    delivered = {}  # file_path -> records yielded so far
+    failed = 0
+    pool = parts = None
+
+    def start_pool():
+        # A worker killed while writing could leave the queue locked, so each pool gets its own
+        nonlocal pool, parts
+        parts = context.Queue(max_workers * 2)
+        pool = context.Pool(max_workers, initializer=_init_worker, initargs=(parts,),
+                            maxtasksperchild=MAX_TASKS_PER_WORKER)
+
+    def submit(file_path: str):
+        target = parts
+        pool.apply_async(
+            _extract_worker,
+            (file_path, chunk_size, chunk_overlap, file_hashes.get(file_path), delivered.get(file_path, 0), part_size),
+            error_callback=lambda err: target.put((file_path, None, True, str(err)))
+        )
+        in_flight[file_path] = time.monotonic()
+
+    def hand_over(items):
+        # Time spent in the consumer does not count against the files in flight
+        for item in items:
+            suspended = time.monotonic()
+            yield item
+            paused = time.monotonic() - suspended
+            for file_path in in_flight:
+                in_flight[file_path] += paused
+
+    start_pool()
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_workers:
+                submit(pending.pop())
+
+            wait = None
+            if timeout is not None:
+                wait = max(0.0, min(in_flight.values()) + timeout - time.monotonic())
+            try:
+                file_path, records, last, err = parts.get(timeout=wait)
+            except queue.Empty:
+                now = time.monotonic()
+                expired = [p for p, seen in in_flight.items() if now - seen >= timeout]
+                if not expired:
+                    continue
+                dropped = []
+                for file_path in expired:
+                    print(f"⚠️ Extraction of {file_path} timed out after {timeout}s, skipping")
+                    del in_flight[file_path]
+                    delivered.pop(file_path, None)
+                    failed += 1
+                    dropped.append((file_path, None, True))
+                # The hung workers cannot be interrupted, so replace the pool
+                pool.terminate()
+                start_pool()
+                for file_path in list(in_flight):
+                    submit(file_path)
+                yield from hand_over(dropped)
+                continue
+
+            if file_path not in in_flight:
+                continue  # Abandoned after a timeout
+            if err is not None:
+                print(f"⚠️ Failed to extract {file_path}: {err}")
+                del in_flight[file_path]
+                delivered.pop(file_path, None)
+                failed += 1
+            elif last:
+                del in_flight[file_path]
+                delivered.pop(file_path, None)
+            else:
+                in_flight[file_path] = time.monotonic()
+                if not records:
+                    continue  # a resumed file is catching up
+                delivered[file_path] = delivered.get(file_path, 0) + len(records)
+            yield from hand_over([(file_path, records, last)])
+    finally:
+        pool.terminate()
+        if failed:
+            print(f"⚠️ {failed} file(s) could not be extracted")
+
+
+def extract_files_parallel(
+    file_paths: Iterable,
+    chunk_size: int = 4000,
+    chunk_overlap: int = 400,
+    max_workers: Optional[int] = None,
+    timeout: Optional[float] = FILE_TIMEOUT
+) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Extract files in a process pool and yield each file's chunks once it is complete.
+    
+    Collects the parts streamed by ``iter_records_parallel``; failed and
+    timed-out files are reported and skipped.
+    
+    Args:
+        file_paths: Files to extract
+        chunk_size: Size of each text chunk
+        chunk_overlap: Overlap between chunks
+        max_workers: Number of worker processes (default: CPU count)
+        timeout: Per-file timeout in seconds, or None to wait indefinitely
+        
+    Yields:
+        Tuple[str, List[str]]: (file_path, chunks) in completion order
+    """
+    collected = {}
+    parts = iter_records_parallel(file_paths, chunk_size, chunk_overlap, max_workers, timeout)
+    try:
+        for file_path, records, last in parts:
+            if records is None:
+                collected.pop(file_path, None)
+                continue
+            collected.setdefault(file_path, []).extend(r["content"] for r in records)
+            if last:
+                yield file_path, collected.pop(file_path)
+    finally:
+        parts.close()
+
+
+def process_directory_parallel(
+    directory_path: str,
+    chunk_size: int = 4000,
+    chunk_overlap: int = 400,
+    max_workers: Optional[int] = None,
+    recursive: bool = True,
+    timeout: Optional[float] = FILE_TIMEOUT
+) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Process all PDF and TXT files under a directory in parallel.
+    
+    Args:
+        directory_path: Path to the directory containing files
+        chunk_size: Size of each text chunk
+        chunk_overlap: Overlap between chunks
+        max_workers: Number of worker processes (default: CPU count)
+        recursive: Whether to descend into subdirectories
+        timeout: Per-file timeout in seconds
+        
+    Yields:
+        Tuple[str, List[str]]: (file_path, chunks) as each file completes
+    """
+    if not os.path.isdir(directory_path):
+        raise FileNotFoundError(f"Directory not found: {directory_path}")
+    files = iter_directory_files(directory_path, recursive=recursive)
+    yield from extract_files_parallel(files, chunk_size, chunk_overlap, max_workers, timeout)
@@ -0,0 +1,189 @@
+"""
+Token-budgeted, concurrent batching of embedding requests.
+
+Texts are packed into requests up to the embedding model's per-request
+instance and token limits, and several requests are kept in flight at once,
+so ingestion throughput is bounded by the API quota rather than by a fixed
+batch size. Requests run on the process-wide WorkScheduler, and can be
+awaited from the ingestion pipeline with ``embed_async``.
+"""
+import asyncio
+import os
+import threading
+import time
+from typing import List, Dict, Any, Optional
+
+from supavec import (
+    create_embeddings_batch,
+    EMBEDDING_MAX_INSTANCES,
+    EMBEDDING_MAX_REQUEST_TOKENS,
+    EMBEDDING_MAX_INPUT_TOKENS,
+)
+from scheduler import BULK, get_scheduler
+
+# Number of embedding requests allowed in flight at once
+MAX_IN_FLIGHT = int(os.getenv("KB_EMBEDDING_MAX_IN_FLIGHT", "4"))
+
+_batcher = None
+_batcher_lock = threading.Lock()
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Conservative token estimate for packing requests.
+
+    Roughly three characters per token, which overestimates for English and
+    stays safe for most other scripts; capped at the per-input truncation limit.
+    """
+    return min(len(text) // 3 + 1, EMBEDDING_MAX_INPUT_TOKENS)
+
+
+def pack_batches(texts: List[str], max_instances: int = EMBEDDING_MAX_INSTANCES,
+                 max_tokens: int = EMBEDDING_MAX_REQUEST_TOKENS) -> List[range]:
+    """
+    Greedily pack consecutive texts into requests within the model limits.
+
+    Returns:
+        List of index ranges into ``texts``, one per request
+    """
+    batches = []
+    start = 0
+    tokens = 0
+    for i, text in enumerate(texts):
+        cost = estimate_tokens(text)
+        if i > start and (i - start >= max_instances or tokens + cost > max_tokens):
+            batches.append(range(start, i))
+            start, tokens = i, 0
+        tokens += cost
+    if start < len(texts):
+        batches.append(range(start, len(texts)))
+    return batches
+
+
+class EmbeddingBatcher:
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT, max_instances: int = EMBEDDING_MAX_INSTANCES,
+                 max_tokens: int = EMBEDDING_MAX_REQUEST_TOKENS):
+        """
+        Initialize the batcher.
+
+        Args:
+            max_in_flight: Maximum number of concurrent embedding requests
+            max_instances: Maximum texts per request
+            max_tokens: Maximum estimated tokens per request
+        """
+        self.max_in_flight = max_in_flight
+        self.max_instances = max_instances
+        self.max_tokens = max_tokens
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._texts = 0
+        self._requests = 0
+        self._seconds = 0.0
+        self._last_rate = 0.0
+
+    def _embed_batch(self, texts: List[str], **kwargs) -> List[List[float]]:
+        with self._in_flight:
+            return create_embeddings_batch(texts, **kwargs)
+
+    def _submit(self, texts: List[str], batches: List[range], store_in_db: bool, metadata: Optional[Dict[str, Any]],
+                source_file: Optional[str], chunk_indices: Optional[List[int]], total_chunks: Optional[int],
+                task_type: str, priority: int, job: Optional[str]) -> list:
+        """Queue one request per packed batch on the scheduler."""
+        scheduler = get_scheduler()
+        return [
+            scheduler.submit(
+                self._embed_batch,
+                [texts[i] for i in batch],
+                store_in_db=store_in_db,
+                metadata=metadata,
+                source_file=source_file,
+                chunk_indices=[chunk_indices[i] for i in batch] if chunk_indices else list(batch),
+                total_chunks=total_chunks,
+                task_type=task_type,
+                priority=priority,
+                job=job
+            )
+            for batch in batches
+        ]
+
+    def _record(self, texts: List[str], batches: List[range], started: float):
+        elapsed = time.monotonic() - started
+        rate = len(texts) / elapsed if elapsed > 0 else 0.0
+        with self._lock:
+            self._texts += len(texts)
+            self._requests += len(batches)
+            self._seconds += elapsed
+            self._last_rate = rate
+        print(f"Embedded {len(texts)} texts in {len(batches)} requests, {elapsed:.1f}s ({rate:.1f} texts/sec)")
+
+    def embed(self, texts: List[str], store_in_db: bool = True, metadata: Optional[Dict[str, Any]] = None,
+              source_file: Optional[str] = None, chunk_indices: Optional[List[int]] = None,
+              total_chunks: Optional[int] = None, task_type: str = "RETRIEVAL_DOCUMENT",
+              priority: int = BULK, job: Optional[str] = None) -> List[List[float]]:
+        """
+        Embed texts in packed, concurrent requests.
+
+        ``priority`` and ``job`` select the scheduler class and bulk job; the
+        other arguments after ``texts`` are passed through to create_embeddings_batch.
+
+        Returns:
+            Embeddings in the same order as ``texts``
+        """
+        if not texts:
+            return []
+        started = time.monotonic()
+        batches = pack_batches(texts, self.max_instances, self.max_tokens)
+        futures = self._submit(texts, batches, store_in_db, metadata, source_file, chunk_indices, total_chunks,
+                               task_type, priority, job)
+        try:
+            embeddings = []
+            for future in futures:
+                embeddings.extend(future.result())
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        self._record(texts, batches, started)
+        return embeddings
+
+    async def embed_async(self, texts: List[str], store_in_db: bool = True, metadata: Optional[Dict[str, Any]] = None,
+                          source_file: Optional[str] = None, chunk_indices: Optional[List[int]] = None,
+                          total_chunks: Optional[int] = None, task_type: str = "RETRIEVAL_DOCUMENT",
+                          priority: int = BULK, job: Optional[str] = None) -> List[List[float]]:
+        """Like ``embed``, awaiting the requests without blocking the event loop."""
+        if not texts:
+            return []
+        started = time.monotonic()
+        batches = pack_batches(texts, self.max_instances, self.max_tokens)
+        futures = self._submit(texts, batches, store_in_db, metadata, source_file, chunk_indices, total_chunks,
+                               task_type, priority, job)
+        try:
+            results = await asyncio.gather(*(asyncio.wrap_future(future) for future in futures))
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        self._record(texts, batches, started)
+        return [embedding for result in results for embedding in result]
+
+    def stats(self) -> Dict[str, Any]:
+        """Return cumulative throughput figures."""
+        with self._lock:
+            return {
+                "texts": self._texts,
+                "requests": self._requests,
+                "seconds": round(self._seconds, 3),
+                "texts_per_sec": self._texts / self._seconds if self._seconds else 0.0,
+                "last_texts_per_sec": self._last_rate,
+                "max_in_flight": self.max_in_flight
+            }
+
+
+def get_embedding_batcher() -> EmbeddingBatcher:
+    """Return the process-wide embedding batcher."""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = EmbeddingBatcher()
+    return _batcher
@@ -0,0 +1,176 @@
+"""
+Persistent local cache of embedding vectors.
+
+Vectors live in one flat file of fixed-size rows (float16 by default) that is
+memory-mapped; a small SQLite table maps each key to its row and tracks last
+access for least-recently-used eviction once the entry cap is reached.
+Keys combine the model id, the task type and the text hash, so a vector is
+only reused for exactly the same request.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Any
+
+import numpy as np
+
+SQLITE_MAX_VARIABLES = 500
+
+
+def embedding_key(model_id: str, task_type: str, text: str) -> str:
+    """Cache key for one embedding request."""
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{model_id}:{task_type}:{digest}"
+
+
+class EmbeddingCache:
+    def __init__(self, directory: str, dim: int = 768, dtype: str = "float16", max_entries: int = 2_000_000):
+        """
+        Open or create an embedding cache.
+
+        Args:
+            directory: Directory holding the vector and index files
+            dim: Embedding dimension
+            dtype: Storage dtype, "float16" or "float32"
+            max_entries: Maximum number of cached vectors before LRU eviction
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.max_entries = max_entries
+        self.row_bytes = dim * self.dtype.itemsize
+        base = os.path.join(directory, f"embeddings_{dim}_{self.dtype.name}")
+        self.vectors_path = base + ".bin"
+        self.index_path = base + ".db"
+        self._lock = threading.Lock()
+
+        self._conn = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER NOT NULL UNIQUE, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+
+        if not os.path.exists(self.vectors_path):
+            open(self.vectors_path, "wb").close()
+        self.capacity = os.path.getsize(self.vectors_path) // self.row_bytes
+        self._vectors = self._map(self.capacity)
+
+    def _map(self, capacity: int):
+        if capacity == 0:
+            return None
+        return np.memmap(self.vectors_path, dtype=self.dtype, mode="r+", shape=(capacity, self.dim))
+
+    def _grow(self, needed: int):
+        """Grow the vector file geometrically so it holds at least ``needed`` rows."""
+        if needed <= self.capacity:
+            return
+        new_capacity = min(max(needed, self.capacity * 2, 1024), self.max_entries)
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        with open(self.vectors_path, "r+b") as f:
+            f.truncate(new_capacity * self.row_bytes)
+        self.capacity = new_capacity
+        self._vectors = self._map(new_capacity)
+
+    def _bump(self, name: str, amount: int):
+        if amount:
+            self._conn.execute(
+                "INSERT INTO counters(name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, amount)
+            )
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """
+        Look up cached vectors.
+
+        Returns:
+            Dict from key to float32 vector for every key that was cached
+        """
+        if not keys:
+            return {}
+        with self._lock:
+            found = {}
+            unique = list(dict.fromkeys(keys))
+            for i in range(0, len(unique), SQLITE_MAX_VARIABLES):
+                part = unique[i:i + SQLITE_MAX_VARIABLES]
+                marks = ",".join("?" * len(part))
+                found.update(self._conn.execute(f"SELECT key, slot FROM entries WHERE key IN ({marks})", part).fetchall())
+            result = {}
+            if found:
+                slots = np.fromiter(found.values(), dtype=np.int64, count=len(found))
+                vectors = np.asarray(self._vectors[slots], dtype=np.float32)
+                result = dict(zip(found.keys(), vectors))
+                now = time.time()
+                self._conn.executemany("UPDATE entries SET last_access = ? WHERE key = ?", [(now, k) for k in found])
+            hits = sum(1 for k in keys if k in result)
+            self._bump("hits", hits)
+            self._bump("misses", len(keys) - hits)
+            self._conn.commit()
+            return result
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        """Store vectors, evicting the least recently used entries if the cache is full."""
+        with self._lock:
+            pending = {}
+            for key, vector in zip(keys, vectors):
+                pending[key] = vector
+            existing = set()
+            keys_list = list(pending)
+            for i in range(0, len(keys_list), SQLITE_MAX_VARIABLES):
+                part = keys_list[i:i + SQLITE_MAX_VARIABLES]
+                marks = ",".join("?" * len(part))
+                existing.update(k for (k,) in self._conn.execute(f"SELECT key FROM entries WHERE key IN ({marks})", part))
+            new_keys = [k for k in keys_list if k not in existing][-self.max_entries:]
+            if not new_keys:
+                return
+
+            # Slots are dense: fill free rows first, then reuse the least recently used ones
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            free = min(len(new_keys), self.max_entries - count)
+            slots = list(range(count, count + free))
+            evict = len(new_keys) - free
+            if evict:
+                victims = self._conn.execute(
+                    "SELECT key, slot FROM entries ORDER BY last_access LIMIT ?", (evict,)
+                ).fetchall()
+                self._conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k, _ in victims])
+                slots.extend(slot for _, slot in victims)
+                self._bump("evictions", len(victims))
+            self._grow(count + free)
+
+            block = np.asarray([pending[k] for k in new_keys], dtype=self.dtype)
+            self._vectors[np.asarray(slots, dtype=np.int64)] = block
+            self._vectors.flush()
+            now = time.time()
+            self._conn.executemany(
+                "INSERT INTO entries(key, slot, last_access) VALUES (?, ?, ?)",
+                [(k, slot, now) for k, slot in zip(new_keys, slots)]
+            )
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Return cumulative hit/miss/eviction counters and current size."""
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, value FROM counters").fetchall())
+            entries = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "path": self.vectors_path,
+            "dtype": self.dtype.name,
+            "entries": entries,
+            "capacity": self.capacity,
+            "max_entries": self.max_entries,
+            "bytes": self.capacity * self.row_bytes,
+            "hits": hits,
+            "misses": misses,
+            "evictions": counters.get("evictions", 0),
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0
+        }
@@ -0,0 +1,145 @@
+"""
+Filter predicates for vector search.
+
+A filter is a dict of conditions that must all hold, keyed by "file_path" or
+a metadata key (``indexed_at``, ``file_name``, ``directory``, ``page_start``
+or any key passed as metadata at indexing time):
+
+    {"file_path": "docs/contract-x.pdf"}                 equality
+    {"file_name": ["a.pdf", "b.pdf"]}                    any of
+    {"indexed_at": {"gte": 1717200000, "lt": 1719800000}}
+    {"department": {"ne": "legal"}}
+
+Operators are eq, ne, in, nin, gt, gte, lt and lte. A filter is evaluated
+into a bitmap over vector labels (``FilterIndex``), which the search paths
+consult per candidate, so filtered queries need no over-fetching.
+"""
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from chunk_store import ChunkStore
+
+FILTER_EXACT_MAX = int(os.getenv("KB_FILTER_EXACT_MAX", "4096"))  # matches scanned exactly instead of graph-searched
+FILTER_CACHE_SIZE = int(os.getenv("KB_FILTER_CACHE_SIZE", "64"))
+
+_OPERATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "eq": lambda value, operand: value == operand,
+    "ne": lambda value, operand: value != operand,
+    "in": lambda value, operand: value in operand,
+    "nin": lambda value, operand: value not in operand,
+    "gt": lambda value, operand: value > operand,
+    "gte": lambda value, operand: value >= operand,
+    "lt": lambda value, operand: value < operand,
+    "lte": lambda value, operand: value <= operand,
+}
+
+
+def _predicate(conditions: List[Tuple[str, Any]]) -> Callable[[Any], bool]:
+    def check(value) -> bool:
+        try:
+            return all(_OPERATORS[op](value, operand) for op, operand in conditions)
+        except TypeError:  # e.g. a range on a value of another type
+            return False
+    return check
+
+
+def parse_filter(spec: Optional[Dict[str, Any]]) -> List[Tuple[str, List[Tuple[str, Any]]]]:
+    """
+    Validate a filter and normalize it to (field, [(operator, operand)]) pairs.
+
+    Raises:
+        ValueError: If the filter is malformed
+    """
+    if not spec:
+        return []
+    if not isinstance(spec, dict):
+        raise ValueError("Filter must be an object of field conditions")
+    parsed = []
+    for field, condition in spec.items():
+        if isinstance(condition, dict):
+            unknown = set(condition) - set(_OPERATORS)
+            if unknown or not condition:
+                raise ValueError(f"Unsupported filter operators for '{field}': {sorted(unknown) or 'none given'}")
+            ops = []
+            for op, operand in condition.items():
+                if op in ("in", "nin") and not isinstance(operand, list):
+                    raise ValueError(f"Filter operator '{op}' on '{field}' needs a list")
+                ops.append((op, operand))
+        elif isinstance(condition, list):
+            ops = [("in", condition)]
+        else:
+            ops = [("eq", condition)]
+        parsed.append((field, ops))
+    return parsed
+
+
+class FilterIndex:
+    def __init__(self, store: ChunkStore):
+        """
+        Bitmaps of the labels matching a filter, cached per store version.
+
+        Args:
+            store: Chunk store the filters are evaluated against
+        """
+        self.store = store
+        self._cache: "OrderedDict[str, Tuple[Tuple[int, int], Tuple[np.ndarray, np.ndarray, Dict[int, int]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def match(self, spec: Dict[str, Any], store: Optional[ChunkStore] = None) -> Tuple[np.ndarray, np.ndarray, Dict[int, int]]:
+        """
+        Evaluate a filter.
+
+        Args:
+            spec: Filter (see parse_filter)
+            store: Snapshot of the index's store to evaluate it against (default: the store itself)
+
+        Returns:
+            (vector labels whose vector serves a matching chunk, a boolean
+            bitmap of those labels indexed by label, {vector label: matching
+            duplicate chunk} for vectors whose owner chunk does not match)
+        """
+        key = json.dumps(spec, sort_keys=True, default=str)
+        store = self.store if store is None else store
+        version = (store.version, len(store))  # snapshots of one version can leave out different chunks
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == version:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        labels = None
+        for field, ops in parse_filter(spec):
+            matched = store.select(field, _predicate(ops))
+            labels = matched if labels is None else np.intersect1d(labels, matched, assume_unique=True)
+            if not len(labels):
+                break
+        if labels is None:
+            labels = store.labels()
+        owners = store.owners(labels)
+        # A matching duplicate is served through its owner's vector; when the
+        # owner itself does not match, the duplicate is reported instead
+        duplicate = owners != labels
+        foreign = ~np.isin(owners[duplicate], labels)
+        substitutes = {}
+        for owner, label in zip(owners[duplicate][foreign].tolist(), labels[duplicate][foreign].tolist()):
+            substitutes.setdefault(owner, label)
+        vector_labels = np.unique(owners)
+        bitmap = np.zeros(int(vector_labels[-1]) + 1 if len(vector_labels) else 0, dtype=bool)
+        bitmap[vector_labels] = True
+        result = (vector_labels, bitmap, substitutes)
+        with self._lock:
+            self._cache[key] = (version, result)
+            while len(self._cache) > FILTER_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        return {"cached_filters": len(self._cache), "hits": self.hits, "misses": self.misses}
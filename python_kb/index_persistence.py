@@ -0,0 +1,294 @@
+"""
+Loading and saving of an index through its persistence backend.
+
+An index is stored as a snapshot plus a delta log of the chunks changed
+since (see persistence.py). ``IndexPersistence`` loads the newest snapshot
+(from the local cache when it is current), replays the log written after it
+and swaps the result in; saving appends changed chunks to the log and writes
+a new snapshot when one is due. A load that fails is retried in the
+background while writes are rejected.
+"""
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import hnswlib
+
+from chunk_store import ChunkStore
+from lexical import LEXICAL_ENABLED
+from persistence import (Snapshot, index_to_bytes, encode_vector, decode_vector, SNAPSHOT_EVERY_RECORDS,
+                         SNAPSHOT_EVERY_SECONDS)
+from sharding import ShardedIndex, INITIAL_CAPACITY, grow_index
+
+# A load from the store that fails is retried after this long, doubling up to LOAD_RETRY_MAX;
+# until one succeeds the index serves searches but rejects writes
+LOAD_RETRY_SECONDS = float(os.getenv("KB_LOAD_RETRY_SECONDS", "30"))
+LOAD_RETRY_MAX = 600.0
+
+
+class IndexPersistence:
+    """Loading, log replay and saving for DocumentIndexer."""
+
+    def _initialize_index(self, background: bool = False):
+        """
+        Load the index from the persistence backend, or create a new one.
+
+        A local snapshot whose sequence number matches the backend's is loaded
+        straight from disk with a memory-mapped chunk store; only the log
+        written after it is fetched. Otherwise the backend's snapshot is
+        downloaded and cached locally. With ``background`` that download runs
+        in a thread: a stale local snapshot (or an empty index) serves
+        searches meanwhile, writes wait for ``ready``.
+        """
+        self.log_seq = 0                  # sequence number of the last persisted log record
+        self.records_since_snapshot = 0
+        self.last_snapshot_at = time.time()
+        self.snapshot_requested = False
+        self.ready = threading.Event()
+        self.load_status = {"state": "loading", "source": None, "seconds": None, "error": None}
+        self._load_started = time.time()
+        self._load_failures = 0
+        self._load_retry = None  # timer of the next load attempt after a failure
+        self.index = None
+        self.mapping = ChunkStore()
+        if self.store is None:
+            print(f"No persistence configured for index '{self.index_name}'; it will exist only in memory.")
+            return self._loaded("memory")
+        
+        cached = None
+        if self.snapshot_cache is not None:
+            try:
+                cached = self.snapshot_cache.load_snapshot(self.index_name)
+            except Exception as e:
+                print(f"⚠️ Warning: Could not read the local snapshot of '{self.index_name}': {e}")
+        if cached is not None:
+            try:
+                if self.store.snapshot_version(self.index_name) == cached.log_seq:
+                    self._apply(*self._restore(cached))
+                    return self._loaded("cache")
+                print(f"Local snapshot of '{self.index_name}' (seq {cached.log_seq}) is stale")
+            except Exception as e:
+                print(f"⚠️ Warning: Could not validate the local snapshot of '{self.index_name}': {e}")
+        
+        if background:
+            if cached is not None:
+                # Reopen: a failed validation may have replayed part of the log into it
+                cached = self.snapshot_cache.load_snapshot(self.index_name)
+                self._apply(cached.load_index(self.dimension), cached.chunks, cached.log_seq, 0)
+            else:
+                self._apply(self._new_index(), ChunkStore(), 0, 0)
+            print(f"Loading index '{self.index_name}' in the background")
+            threading.Thread(target=self._load_from_store, name=f"load-{self.index_name}", daemon=True).start()
+        else:
+            self._load_from_store()
+
+    def _load_from_store(self):
+        """Download the backend's snapshot, cache it locally, replay the log and swap it in."""
+        try:
+            print(f"Attempting to load index '{self.index_name}' ({type(self.store).__name__})...")
+            snapshot = self.store.load_snapshot(self.index_name)
+            if snapshot is None:
+                print(f"No existing index found for '{self.index_name}'")
+                state = self._replay_log(self._new_index(), ChunkStore(), 0)  # the log may predate any snapshot
+            else:
+                self._cache_snapshot(snapshot)
+                state = self._restore(snapshot)
+            self._apply(*state)
+            self._loaded("store")
+        except Exception as e:
+            self._load_failures += 1
+            delay = min(LOAD_RETRY_MAX, LOAD_RETRY_SECONDS * 2 ** (self._load_failures - 1))
+            print(f"⚠️ Warning: Error loading index '{self.index_name}': {e}")
+            print(f"⚠️ Writes are rejected until a load succeeds, so the stored index is not overwritten; "
+                  f"retrying in {delay:.0f}s.")
+            if self.index is None:
+                self._apply(self._new_index(), ChunkStore(), 0, 0)
+            self._loaded("failed", error=str(e))
+            self._load_retry = threading.Timer(delay, self._load_from_store)
+            self._load_retry.daemon = True
+            self._load_retry.start()
+
+    def _restore(self, snapshot: Snapshot):
+        """Build the index from a snapshot plus the log written after it."""
+        self.ef_construction = snapshot.ef_construction or self.ef_construction
+        self.M = snapshot.m_parameter or self.M
+        if self.vector_tier is not None and snapshot.codebook is not None:
+            with self._tier_lock:
+                try:
+                    self.vector_tier.use_codebook(snapshot.codebook)  # codes are re-added by _sync_vector_tier
+                except Exception as e:
+                    print(f"⚠️ Could not use the vector tier codebook of '{self.index_name}': {e}")
+        return self._replay_log(snapshot.load_index(self.dimension), snapshot.chunks, snapshot.log_seq)
+
+    def _apply(self, index: hnswlib.Index, mapping: ChunkStore, log_seq: int, replayed: int):
+        """Make a loaded index current."""
+        index.set_ef(self.ef_search)
+        with self._write_lock, self._index_lock:
+            self.index = index
+            self.max_elements = index.get_max_elements()
+            self.mapping = mapping
+            self.log_seq = log_seq
+            self.records_since_snapshot = replayed
+            self._load_bookkeeping()
+            self._publish()
+
+    def _loaded(self, source: str, error: Optional[str] = None):
+        if self.index is None:
+            print(f"✨ Creating new HNSW index '{self.index_name}' with capacity {INITIAL_CAPACITY}.")
+            self._apply(self._new_index(), self.mapping, self.log_seq, 0)
+        seconds = round(time.time() - self._load_started, 3)
+        self.load_status = {"state": "failed" if error else "ready", "source": source, "seconds": seconds, "error": error,
+                            "failures": self._load_failures}
+        if not error:
+            print(f"✅ Loaded index '{self.index_name}' with {len(self.mapping)} items from {source} "
+                  f"(seq {self.log_seq}) in {seconds}s")
+        self.ready.set()
+        if self.vector_tier is not None:
+            threading.Thread(target=self._sync_vector_tier, name=f"tier-{self.index_name}", daemon=True).start()
+        if LEXICAL_ENABLED:
+            threading.Thread(target=self._get_lexical, name=f"lexical-{self.index_name}", daemon=True).start()
+        if not error:
+            self.maybe_tune_ef()
+
+    def _cache_snapshot(self, snapshot: Snapshot):
+        """Keep a local copy of a backend snapshot; failures only cost the next warm start."""
+        if self.snapshot_cache is None:
+            return
+        try:
+            self.snapshot_cache.save_snapshot(self.index_name, snapshot)
+        except Exception as e:
+            print(f"⚠️ Warning: Could not cache the snapshot of '{self.index_name}' locally: {e}")
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until the index has finished loading."""
+        return self.ready.wait(timeout)
+
+    def _check_writable(self):
+        """Refuse writes while the stored index could not be loaded; they would be lost or overwrite it."""
+        if self.load_status["state"] == "failed":
+            raise RuntimeError(f"Index '{self.index_name}' could not be loaded from its store "
+                               f"({self.load_status['error']}); writes are rejected until a load succeeds")
+
+    def _replay_log(self, index: hnswlib.Index, mapping: ChunkStore, after_seq: int):
+        """
+        Apply the log records written after ``after_seq``.
+
+        Returns:
+            (index, mapping, last sequence number, records replayed)
+        """
+        log_seq, replayed = after_seq, 0
+        for record in self.store.read_log(self.index_name, after_seq):
+            label = int(record["label"])
+            if record["op"] == "put":
+                mapping.put(label, record["entry"])
+                if record.get("vector"):
+                    # add_items on a deleted label un-deletes it and updates the vector
+                    grow_index(index, [label])
+                    index.add_items([decode_vector(record["vector"])], [label])
+            elif record["op"] == "delete":
+                mapping.pop(label)
+                try:
+                    index.mark_deleted(label)
+                except RuntimeError:
+                    pass  # Already deleted or never added
+            log_seq = max(log_seq, int(record["seq"]))
+            replayed += 1
+        mapping.take_changes()  # replayed records are already persisted
+        return index, mapping, log_seq, replayed
+
+    def _change_records(self, labels: List[int]) -> List[Dict[str, Any]]:
+        """Describe the current state of changed labels as log records."""
+        records = []
+        owners = []
+        for seq, label in enumerate(labels, start=self.log_seq + 1):
+            entry = self.mapping.get(label)
+            if entry is None:
+                records.append({"seq": seq, "op": "delete", "label": label})
+                continue
+            records.append({"seq": seq, "op": "put", "label": label, "entry": entry})
+            if "duplicate_of" not in entry:
+                owners.append(records[-1])
+        if owners:
+            with self._index_lock:
+                vectors = self.index.get_items([record["label"] for record in owners])
+            for record, vector in zip(owners, vectors):
+                record["vector"] = encode_vector(vector)
+        return records
+
+    def _snapshot_due(self) -> bool:
+        if self.snapshot_requested or self.records_since_snapshot >= SNAPSHOT_EVERY_RECORDS:
+            return True
+        return (SNAPSHOT_EVERY_SECONDS > 0 and self.records_since_snapshot > 0
+                and time.time() - self.last_snapshot_at >= SNAPSHOT_EVERY_SECONDS)
+
+    def _persist(self, snapshot: bool = False):
+        """
+        Append the chunks changed since the last call to the delta log, and
+        write a snapshot when one is due (or ``snapshot`` is set).
+        """
+        self._reclaim()  # vectors whose last readers finished after their retirement was published
+        if self.store is None or self.load_status["state"] == "failed":
+            with self._write_lock:
+                self.mapping.take_changes()
+            self._sync_vector_tier()
+            return
+        with self._persist_lock:
+            with self._write_lock:
+                labels = self.mapping.take_changes()
+                records = self._change_records(labels) if labels else []
+            try:
+                if records:
+                    self.store.append(self.index_name, records)
+                    self.log_seq = records[-1]["seq"]
+                    self.records_since_snapshot += len(records)
+                if snapshot or self._snapshot_due():
+                    self._write_snapshot()
+            except Exception as e:
+                with self._write_lock:
+                    self.mapping.mark_changed(labels)
+                print(f"Error saving index '{self.index_name}': {e}")
+                import traceback
+                traceback.print_exc()
+                print("Index will continue working; unsaved changes are retried on the next save.")
+                # Don't re-raise the exception, allow the program to continue
+        self._sync_vector_tier()
+
+    def _write_snapshot(self):
+        """
+        Write a compacted snapshot covering the log up to ``log_seq`` and truncate the log.
+
+        The chunks are those of the published view, taken together with the
+        graph under the index lock, so both come from the same generation
+        while writers carry on. Chunks of files still being indexed are left
+        out; they are logged again when their file is finalized.
+        """
+        started = time.time()
+        with self._index_lock:
+            chunks = self.view.mapping
+            sharded = isinstance(self.index, ShardedIndex)
+            if sharded:
+                shards = self.index.map_shards(index_to_bytes)
+                changed = self.index.take_dirty()
+                index_data = None
+            else:
+                shards = changed = None
+                index_data = index_to_bytes(self.index)
+            self.max_elements = self.index.get_max_elements()  # the real capacity is persisted
+            index = self.index
+        self.log_seq += 1  # a sequence number of its own identifies the snapshot
+        codebook = self.vector_tier.codebook() if self.vector_tier is not None else None
+        snapshot = Snapshot(index_data, chunks, self.log_seq, self.max_elements, self.ef_construction, self.M,
+                            shards=shards, changed_shards=changed, codebook=codebook)
+        try:
+            self.store.save_snapshot(self.index_name, snapshot)
+        except Exception:
+            if sharded:
+                index.dirty.update(changed)  # upload them with the next snapshot
+            raise
+        self.store.truncate_log(self.index_name, self.log_seq)
+        self._cache_snapshot(snapshot)
+        self.records_since_snapshot = 0
+        self.last_snapshot_at = time.time()
+        self.snapshot_requested = False
+        print(f"💾 Snapshot of index '{self.index_name}' at seq {self.log_seq} written in {time.time() - started:.2f}s")
@@ -1,220 +1,209 @@
 """
 Document indexing and search functionality using HNSW and Supabase.
+
+``DocumentIndexer`` ingests, deletes and compacts; view publication
+(views.py), loading and saving (index_persistence.py) and search (search.py)
+live in the modules of its mixins.
 """
 import os
-import json
+import asyncio
 import numpy as np
 import hnswlib
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from supabase import Client
-from supavec import create_embeddings_batch, get_supabase_client, store_embeddings_in_supabase, generate_contextual_embedding
 import time
-import base64
-import io
-import tempfile
 from pathlib import Path
-import shutil
-from doc_extract import extract_pdf_text, extract_txt_text, process_directory
+import threading
+import collections
+import itertools
+from doc_extract import iter_pdf_chunks, extract_txt_text, iter_directory_files, iter_parts, iter_records_parallel
+from chunking import chunk_text
+from embedding_batcher import get_embedding_batcher
+from dedup import ChunkDeduplicator
+from manifest import IndexManifest, file_sha256, text_sha256
+from chunk_store import ChunkStore
+from pipeline import IngestionPipeline, FileJob, run_coroutine_sync
+from scheduler import WorkScheduler, get_scheduler
+from persistence import make_index_store, make_snapshot_cache
+from sharding import ShardedIndex, INDEX_SHARDS, INITIAL_CAPACITY, CAPACITY_GROWTH, has_room, grow_index
+from quantization import VectorTier, VECTOR_TIER, VECTOR_TIER_DIR, TRAIN_MIN, TRAIN_SAMPLE
+from lexical import LEXICAL_ENABLED
+from search_tuning import EXACT_SEARCH_MAX, EF_TUNE_QUERIES
+from views import ResizeGate, ViewPublisher
+from index_persistence import IndexPersistence
+from search import IndexSearch, SEARCH_MODES, query_embedding_stats  # re-exported for service.py
+
+# Collapse exact and near-duplicate chunks onto one shared vector before embedding
+DEDUP_ENABLED = os.getenv("KB_DEDUP", "1") != "0"
+
+# Rebuild the HNSW graph without deleted vectors once this share of its elements are tombstones
+COMPACTION_THRESHOLD = float(os.getenv("KB_COMPACTION_THRESHOLD", "0.2"))
+COMPACTION_MIN_TOMBSTONES = int(os.getenv("KB_COMPACTION_MIN_TOMBSTONES", "100"))
+COMPACTION_BATCH = 10000  # vectors copied per add_items call
 
 
-class DocumentIndexer:
-    def __init__(self, client: Client, index_name: str = "default_index"):
+class DocumentIndexer(ViewPublisher, IndexPersistence, IndexSearch):
+    def __init__(self, client: Client, index_name: str = "default_index", scheduler: Optional[WorkScheduler] = None,
+                 store=None, background_load: bool = False):
         """
         Initialize the document indexer.
         
         Args:
             client: Supabase client
             index_name: Name of the index
+            scheduler: Scheduler for upstream API calls (default: the process-wide one)
+            store: Persistence backend (default: chosen by KB_PERSISTENCE, see persistence.py)
+            background_load: Download a stale or missing index in a background thread; see ``ready``
         """
         self.client = client
         self.index_name = index_name
         self.dimension = 768  # Google's embedding dimension
-        self.max_elements = 1000000  # Increased max elements
+        self.max_elements = INITIAL_CAPACITY  # grows on demand, see _ensure_capacity
         self.ef_construction = 400   # Increased ef_construction
         self.M = 64                  # Increased M
         self.ef_search = 100        # Increased ef_search
+        self.embedder = get_embedding_batcher()
+        self.scheduler = scheduler or get_scheduler()
+        # One writer at a time: ingestion bookkeeping, deletes, clears and loads change the chunk store,
+        # manifest, deduplicator and duplicate links under it; taken before the index lock
+        self._write_lock = threading.RLock()
+        self._index_lock = threading.RLock()  # serializes HNSW writes with the compaction swap
+        self._resize_gate = ResizeGate()
+        self._compaction = None
+        self.compactions = 0
+        self.last_compaction = None
+        self.last_ingestion = None
+        self.store = make_index_store(client) if store is None else store
+        self.snapshot_cache = make_snapshot_cache(self.store)
+        self._persist_lock = threading.Lock()
+        # Experimental compressed copy of the vectors that serves searches once trained (see quantization.py)
+        self.vector_tier = (VectorTier.load(os.path.join(VECTOR_TIER_DIR, index_name), self.dimension, VECTOR_TIER)
+                            if VECTOR_TIER else None)
+        if self.vector_tier is not None:
+            print(f"⚠️ Experimental {VECTOR_TIER} vector tier enabled for '{index_name}': it adds to the memory "
+                  f"of the HNSW graph and searches slower than it")
+        self._tier_lock = threading.Lock()
+        self._filter_index = None  # bitmaps of filter matches, see _search_filtered
+        self._lexical = None       # BM25 index, built on first use like the deduplicator
+        self._lexical_lock = threading.Lock()
+        self._exact = None  # (generation, ExactIndex, chunk store) serving small indexes, see _exact_index
+        self._recent_queries = collections.deque(maxlen=EF_TUNE_QUERIES)  # query embeddings the ef tuner samples
+        self._tuning = None
+        self.ef_tuning = None  # result of the last tune_ef
+        # Searches read the published view; writers change the live index and store, then publish
+        self.view = None
+        self._view_lock = threading.Lock()
+        self._readers = collections.Counter()  # generation -> searches reading it
+        self._unpublished = set()              # labels of files being indexed, hidden until finalized
+        self._pending_deletes = []             # vectors retired since the last publication
+        self._retiring = []                    # (last generation showing them, chunk store, labels)
         
         # Initialize or load HNSW index
-        self._initialize_index()
+        self._initialize_index(background=background_load)
 
-    def _serialize_index(self, index: hnswlib.Index) -> str:
-        """Serialize HNSW index to base64 string."""
-        temp_dir = tempfile.mkdtemp()
-        try:
-            temp_path = os.path.join(temp_dir, 'index.bin')
-            index.save_index(temp_path)
-            with open(temp_path, 'rb') as f:
-                data = f.read()
-            return base64.b64encode(data).decode('utf-8')
-        finally:
-            shutil.rmtree(temp_dir, ignore_errors=True)
-
-    def _deserialize_index(self, data: str) -> hnswlib.Index:
-        """Deserialize base64 string to HNSW index."""
-        temp_dir = tempfile.mkdtemp()
-        try:
-            temp_path = os.path.join(temp_dir, 'index.bin')
-            binary_data = base64.b64decode(data)
-            with open(temp_path, 'wb') as f:
-                f.write(binary_data)
+    def _new_index(self, capacity: Optional[int] = None):
+        """
+        Create an empty graph, or a ShardedIndex when KB_INDEX_SHARDS > 1.
+
+        A loaded index keeps the layout it was saved with; new, cleared and
+        compacted indexes take the configured one, so a compaction reshards.
+        """
+        capacity = capacity or INITIAL_CAPACITY
+        if INDEX_SHARDS > 1:
+            index = ShardedIndex.create(INDEX_SHARDS, self.dimension, capacity, self.ef_construction, self.M)
+        else:
             index = hnswlib.Index(space='cosine', dim=self.dimension)
-            index.load_index(temp_path)
-            return index
-        finally:
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            index.init_index(max_elements=capacity, ef_construction=self.ef_construction, M=self.M)
+        index.set_ef(self.ef_search)
+        return index
 
-    def _initialize_index(self):
-        """Initialize or load the HNSW index, ensuring sufficient capacity."""
-        desired_max_elements = self.max_elements # The capacity we want from class attribute
+    def _ensure_capacity(self, labels: List[int]):
+        """Grow the live index before adding ``labels``; the caller holds the index lock."""
+        if has_room(self.index, labels):
+            return
+        before = self.index.get_max_elements()
+        with self._resize_gate.exclusive():
+            self.max_elements = grow_index(self.index, labels)
+        print(f"📈 Grew index '{self.index_name}' from {before} to {self.max_elements} elements")
 
-        try:
-            # Try to load existing index from Supabase
-            print(f"Attempting to load index '{self.index_name}' from Supabase...")
-            response = self.client.table("hnsw_indices").select("*").eq("index_name", self.index_name).execute()
-            
-            if response.data and len(response.data) > 0:
-                index_data = response.data[0]
-                loaded_max_elements = index_data.get("max_elements") 
-                
-                # Critical: Use the desired_max_elements for the current session's index object
-                # The saved max_elements is more for record-keeping or future loads.
-                # The actual hnswlib index object needs to be initialized with enough space.
-
-                print(f"Found existing index '{self.index_name}' in Supabase with saved max_elements: {loaded_max_elements}.")
-
-                # Always initialize the HNSWLib object with the desired capacity for this session
-                self.index = self._deserialize_index(index_data["index_data"])
-                
-                # Check if the loaded index's *current item count* already prevents adding new items
-                # This requires index.get_current_count() - if available, or len(index_data["mapping_data"])
-                num_items_in_loaded_index = len(index_data.get("mapping_data", {}))
-
-                # Initialize the HNSW object with desired_max_elements for this session
-                # Note: load_index re-initializes with the saved index's structure but not necessarily max_elements
-                # We might need to re-init if num_items_in_loaded_index + new_items > loaded_max_elements
-                # OR if loaded_max_elements is simply too small for future growth in this session.
-
-                # For simplicity and robustness, if there's any doubt or if the loaded index seems constrained,
-                # it might be better to re-initialize. However, let's first try to use loaded data.
-                # If loaded_max_elements is defined and smaller than desired, it's a flag.
-                
-                self.max_elements = desired_max_elements # Ensure current session uses desired
-                self.ef_construction = index_data.get("ef_construction", self.ef_construction)
-                self.M = index_data.get("m_parameter", self.M)
-                
-                # After deserializing, re-initialize with desired max_elements if it was different,
-                # but this would lose existing items.
-                # Instead, we rely on the deserialized index having its original capacity.
-                # The key is that `add_items` checks against the index's *actual* capacity.
-                # Let's try to call `resize_index` if current count is near capacity. This is safer.
-                
-                # The `load_index` function itself determines the capacity from the loaded file.
-                # We need to ensure that the `add_items` call doesn't exceed this.
-                # If `init_index` was called before `load_index` with a different max_elements,
-                # `load_index` might override it.
-
-                self.index.set_ef(self.ef_search) # Must be called after load_index
-                self.mapping = index_data.get("mapping_data", {})
-                print(f"✅ Loaded existing index '{self.index_name}' with {len(self.mapping)} items. Effective capacity from loaded data.")
-                
-                # HNSWLib does not have a simple resize_index that preserves data and increases max_elements easily.
-                # If len(self.mapping) is already at or near loaded_max_elements, adding more will fail.
-                # The "The number of elements exceeds the specified limit" error happens if the internal
-                # capacity of the HNSW object (set during its original init_index) is hit.
-
-                # If the loaded index had 0 items (as per previous logs) but was saved with a small max_elements,
-                # that small max_elements becomes the limit.
-
-                # Simplest robust fix if 'Loaded existing index 'kb' with 0 items' is true and we hit limit:
-                # This implies the saved index metadata (max_elements) was too small.
-                # So, if we load an index that says it has 0 items, but its metadata suggests a small limit,
-                # it's better to re-initialize it with the desired_max_elements.
-
-                if len(self.mapping) == 0 and loaded_max_elements is not None and loaded_max_elements < desired_max_elements:
-                    print(f"⚠️ Loaded index '{self.index_name}' has 0 items but a small saved capacity ({loaded_max_elements}). Re-initializing with capacity {desired_max_elements}.")
-                    # Fall through to create a new index
-                elif loaded_max_elements is not None and len(self.mapping) >= loaded_max_elements:
-                     print(f"⚠️ Loaded index '{self.index_name}' is full (items: {len(self.mapping)}, capacity: {loaded_max_elements}). Re-initializing with capacity {desired_max_elements}.")
-                     # Fall through to create a new index
-                else:
-                    return # Successfully loaded and seems okay
-                    
-            # If response.data is empty or previous conditions lead here, create new.
-            print(f"No suitable existing index found in Supabase for '{self.index_name}', or re-initialization forced.")
+    def close(self):
+        """
+        Flush unsaved changes before the indexer is dropped: waits for the
+        load and any running compaction or ef tuning, then appends pending
+        changes to the delta log (writing a snapshot if one is due).
+        """
+        self.ready.wait()
+        if self._load_retry is not None:
+            self._load_retry.cancel()
+        compaction = self._compaction
+        if compaction is not None and compaction.is_alive():
+            compaction.join()
+        tuning = self._tuning
+        if tuning is not None and tuning.is_alive():
+            tuning.join()  # it searches the graph, which a sharded index is about to shut down
+        self._persist()
+        if isinstance(self.index, ShardedIndex):
+            self.index.close()
 
-        except Exception as e:
-            print(f"⚠️ Warning: Error during Supabase index load for '{self.index_name}': {e}")
-        
-        # Create a new index if loading failed or was skipped
-        print(f"✨ Creating new HNSW index '{self.index_name}' with capacity {desired_max_elements}.")
-        self.index = hnswlib.Index(space='cosine', dim=self.dimension)
-        self.max_elements = desired_max_elements # Ensure self.max_elements is the desired one
-        self.index.init_index(
-            max_elements=self.max_elements, # Use the desired_max_elements
-            ef_construction=self.ef_construction,
-            M=self.M
-        )
-        self.index.set_ef(self.ef_search)
-        self.mapping = {}
-        
-        try:
-            self._save_index_to_supabase()
-        except Exception as e:
-            print(f"⚠️ Warning: Could not save newly created index '{self.index_name}' to Supabase: {e}")
-            print("Your index will exist only in memory for this session.")
-
-    def _save_index_to_supabase(self):
-        """Save the HNSW index to Supabase."""
-        # Don't attempt to save if client is a mock
-        import inspect
-        if "MagicMock" in str(inspect.getmro(type(self.client))) or hasattr(self.client, '__class__') and "Dummy" in self.client.__class__.__name__:
-            print("Not saving index - using dummy/mock Supabase client")
+    def _sync_vector_tier(self):
+        """
+        Bring the vector tier in line with the chunks that own vectors.
+
+        The quantizer is trained once TRAIN_MIN vectors exist; afterwards new
+        vectors are encoded with the existing codebook and removed ones dropped.
+        """
+        tier = self.vector_tier
+        if tier is None:
             return
-        
-        try:
-            # Convert index to base64 string
-            index_data = self._serialize_index(self.index)
-            
-            # Prepare data
-            data = {
-                "index_name": self.index_name,
-                "index_data": index_data,
-                "mapping_data": self.mapping,
-                "max_elements": self.max_elements,
-                "ef_construction": self.ef_construction,
-                "m_parameter": self.M
-            }
-            
-            # Check if index already exists
-            response = self.client.table("hnsw_indices").select("id").eq("index_name", self.index_name).execute()
-            
-            if response.data and len(response.data) > 0:
-                # Index exists, update it
-                index_id = response.data[0]['id']
-                print(f"Updating existing index with ID {index_id}")
-                self.client.table("hnsw_indices").update(data).eq("id", index_id).execute()
-            else:
-                # Index doesn't exist, insert it
-                print(f"Creating new index '{self.index_name}'")
-                self.client.table("hnsw_indices").insert(data).execute()
-            
-        except Exception as e:
-            print(f"Error saving index to Supabase: {e}")
-            import traceback
-            traceback.print_exc()
-            print("Index will continue working but won't be saved to Supabase.")
-            # Don't re-raise the exception, allow the program to continue
+        with self._tier_lock:
+            try:
+                with self._write_lock:
+                    owners = {label for label, duplicate_of in self.mapping.iter_columns("label", "duplicate_of")
+                              if duplicate_of is None}
+                if not tier.trained:
+                    if len(owners) < TRAIN_MIN:
+                        return
+                    sample = np.random.default_rng(0).choice(sorted(owners), min(len(owners), TRAIN_SAMPLE), replace=False)
+                    started = time.time()
+                    tier.train(self._get_vectors(sample.tolist()))
+                    print(f"🗜️ Trained {tier.kind} vector tier for '{self.index_name}' on {len(sample)} vectors "
+                          f"in {time.time() - started:.1f}s")
+                present = tier.labels()
+                tier.remove(list(present - owners))
+                missing = sorted(owners - present)
+                for i in range(0, len(missing), COMPACTION_BATCH):
+                    batch = missing[i:i + COMPACTION_BATCH]
+                    tier.add(batch, self._get_vectors(batch))
+                if tier.needs_compaction():
+                    tier.compact()
+                tier.save()
+            except Exception as e:
+                print(f"Error updating the vector tier of '{self.index_name}': {e}")
+                import traceback
+                traceback.print_exc()
+
+    def _get_vectors(self, labels: List[int], index=None) -> np.ndarray:
+        """Read vectors out of the HNSW graph (default: the live one)."""
+        with self._resize_gate.read():
+            return np.asarray((self.index if index is None else index).get_items(labels), dtype=np.float32)
 
-    def _get_file_chunks(self, file_path: str) -> List[str]:
+    def _iter_file_chunks(self, file_path: str, file_hash: Optional[str] = None) -> Iterator[Dict[str, Any]]:
         """
-        Get chunks of text from a file using doc_extract functions.
+        Yield chunks of text from a file using doc_extract functions.
+        
+        PDFs are converted a window of pages at a time as the chunks are
+        consumed, so a caller that stops early never extracts the rest.
+        ``file_hash`` (if known) keys their extraction cache.
+        
+        Yields:
+            Chunk records with "content" and, for PDFs, "page_start"/"page_end"
         """
         file_path = Path(file_path)
         try:
             if file_path.suffix.lower() == '.pdf':
-                return extract_pdf_text(str(file_path))
+                yield from iter_pdf_chunks(str(file_path), file_hash=file_hash)
             elif file_path.suffix.lower() == '.txt':
-                return extract_txt_text(str(file_path))
+                yield from ({"content": c} for c in extract_txt_text(str(file_path)))
             else:
                 # Fallback for unsupported types
                 try:
@@ -223,87 +212,321 @@ class DocumentIndexer:
                 except UnicodeDecodeError:
                     with open(file_path, 'r', encoding='latin-1') as f:
                         content = f.read()
-                from langchain.text_splitter import RecursiveCharacterTextSplitter
-                splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100, length_function=len)
-                return splitter.split_text(content)
+                chunks = chunk_text(content, chunk_size=1000, chunk_overlap=100, separators=["\n\n", "\n", " ", ""])
+                yield from ({"content": c.text} for c in chunks)
         except Exception as e:
             print(f"Error reading file {file_path}: {e}")
             raise
 
-    def index_file(self, file_path: str, metadata: Optional[Dict[str, Any]] = None, max_chunks: int = None):
-        """Index a single file by creating embeddings and storing them."""
-        try:
-            chunks = self._get_file_chunks(file_path)
-            print(f"Chunked file into {len(chunks)} segments")
-            if max_chunks and 0 < max_chunks < len(chunks):
-                chunks = chunks[:max_chunks]
-                print(f"Using only first {max_chunks} chunks as requested")
+    def _load_bookkeeping(self):
+        """Derive the content manifest, duplicate links and next free label from the chunk store."""
+        self.manifest = IndexManifest.from_store(self.mapping)
+        self.next_label = max(self.mapping.max_label() + 1, self.index.get_current_count())
+        duplicates = {}
+        owners = set()
+        for label, duplicate_of in self.mapping.iter_columns("label", "duplicate_of"):
+            if duplicate_of is not None:
+                duplicates.setdefault(duplicate_of, []).append(label)
+            else:
+                owners.add(label)
+        # canonical label -> labels of chunks sharing its vector; tuples, as published views share them
+        self.duplicates = {owner: tuple(labels) for owner, labels in duplicates.items()}
+        # Labels still in the HNSW graph but marked deleted
+        self.tombstones = set(self.index.get_ids_list()) - owners
+        self._deduplicator = None
+        self._lexical = None
+
+    def _get_deduplicator(self) -> ChunkDeduplicator:
+        """Build the corpus-wide deduplicator on first use."""
+        if self._deduplicator is None:
+            self._deduplicator = ChunkDeduplicator()
+            for label, content, chunk_hash, duplicate_of in self.mapping.iter_columns(
+                    "label", "content", "chunk_hash", "duplicate_of"):
+                if duplicate_of is None:
+                    self._deduplicator.add(label, content, chunk_hash or text_sha256(content))
+            print(f"Built deduplication index over {len(self._deduplicator)} chunks")
+        return self._deduplicator
+
+    def _vector_count(self) -> int:
+        """Number of live vectors: chunks that do not borrow another chunk's vector."""
+        with self._write_lock:
+            return len(self.mapping) - sum(len(d) for d in self.duplicates.values())
+
+    def _retire_labels(self, labels: List[int]):
+        """
+        Drop chunks from the chunk store and hide their vectors from search.
+        
+        If a retired chunk's vector is shared by surviving duplicates, the vector
+        is handed over to the first survivor instead of being re-embedded. The
+        change reaches searches with the next ``_publish``.
+        """
+        retiring = set(labels)
+        if labels:
+            self._writable_duplicates()
+        for label in labels:
+            entry = self.mapping.pop(label)
+            if entry is None:
+                continue
+            if "duplicate_of" in entry:
+                canonical = int(entry["duplicate_of"])
+                siblings = tuple(d for d in self.duplicates.get(canonical, ()) if d != label)
+                if siblings:
+                    self.duplicates[canonical] = siblings
+                else:
+                    self.duplicates.pop(canonical, None)
+                continue
             
+            if self._deduplicator is not None:
+                self._deduplicator.remove(label)
+            if self._lexical is not None:
+                self._lexical.remove(label)
+            survivors = [d for d in self.duplicates.pop(label, ()) if d not in retiring and d in self.mapping]
+            if survivors:
+                heir, rest = survivors[0], survivors[1:]
+                with self._index_lock:
+                    self._ensure_capacity([heir])
+                    self.index.add_items(self.index.get_items([label]), [heir])
+                heir_content = self.mapping.field(heir, "content")
+                self.mapping.set_duplicate_of(heir, None, entry.get("contextual_content", heir_content))
+                for d in rest:
+                    self.mapping.set_duplicate_of(d, heir)
+                if rest:
+                    self.duplicates[heir] = tuple(rest)
+                if self._deduplicator is not None:
+                    self._deduplicator.add(heir, heir_content, self.mapping.field(heir, "chunk_hash"))
+                if self._lexical is not None:
+                    self._lexical.add(heir, heir_content)
+            self._pending_deletes.append(label)  # tombstoned once no search can see it, see _publish
+
+    def _prepare_file(self, file_path: str, content_hash: Optional[str], metadata: Dict[str, Any]) -> FileJob:
+        """Start indexing one file; its chunks follow in parts through ``_add_chunks``."""
+        file_path = str(file_path)
+        return FileJob(file_path, content_hash, self.manifest.start_plan(file_path), metadata)
+
+    def _add_chunks(self, job: FileJob, records: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
+        """
+        Plan the indexing of the next part of a file's chunks.
+
+        Chunks whose hash is already indexed for the file keep their label; new
+        chunks get fresh labels. New chunks that exactly or nearly duplicate an
+        indexed chunk (or an earlier chunk of the same file) are not embedded;
+        their chunk store entries point at the shared vector via "duplicate_of".
+
+        Returns:
+            The (position, label) pairs of the part to embed
+        """
+        start = len(job.chunks)
+        job.chunks.extend(r["content"] for r in records)
+        job.chunk_metadata.extend({k: v for k, v in r.items() if k != "content"} for r in records)
+        job.chunk_hashes.extend(text_sha256(r["content"]) for r in records)
+        new_positions = []
+        for pos in range(start, len(job.chunks)):
+            label = job.plan.match(job.chunk_hashes[pos])
+            if label is not None:
+                job.kept[pos] = label
+            else:
+                new_positions.append(pos)
+
+        labels = range(self.next_label, self.next_label + len(new_positions))
+        self.next_label += len(new_positions)
+        job.labels.update(zip(new_positions, labels))
+        job.own.update(labels)
+        self._unpublished.update(labels)  # the file appears in searches once finalized
+
+        # Collapse duplicates before paying for contextualization and embedding
+        deduplicator = self._get_deduplicator() if DEDUP_ENABLED else None
+        to_embed = []
+        for pos, label in zip(new_positions, labels):
+            if deduplicator is not None:
+                match, signature = deduplicator.find(job.chunks[pos], job.chunk_hashes[pos])
+                # Chunks still in flight for another file may never get a vector; embed instead
+                if match is not None and (match in self.mapping or match in job.own):
+                    job.duplicate_of[label] = match
+                    entry = self._chunk_entry(job, pos, False)
+                    entry["duplicate_of"] = str(match)
+                    self.mapping.put(label, entry)
+                    duplicates = self._writable_duplicates()
+                    duplicates[match] = duplicates.get(match, ()) + (label,)
+                    continue
+                if match is None:
+                    deduplicator.add(label, job.chunks[pos], job.chunk_hashes[pos], signature)
+                    job.registered.append(label)
+            to_embed.append((pos, label))
+        job.to_embed.extend(to_embed)
+        job.remaining += len(to_embed)
+        if len(to_embed) < len(new_positions):
+            print(f"Skipping {len(new_positions) - len(to_embed)} duplicate chunks of {os.path.basename(job.file_path)}")
+        return to_embed
+
+    def _add_vectors(self, embeddings: List[List[float]], labels: List[int]):
+        """Add vectors to the HNSW index."""
+        if embeddings:
+            with self._index_lock:
+                self._ensure_capacity(labels)
+                self.index.add_items(embeddings, labels)
+
+    def _discard_vectors(self, labels: List[int]):
+        """Tombstone vectors added for chunks that were dropped before being registered."""
+        self._pending_deletes.extend(labels)
+
+    def _chunk_entry(self, job: FileJob, pos: int, is_contextual: bool) -> Dict[str, Any]:
+        # The chunk count is known once the file's last part has arrived; _finalize_file fills it in otherwise
+        totals = {"total_chunks": len(job.chunks)} if job.complete else {}
+        return {
+            "content": job.chunks[pos],
+            "file_path": job.file_path,
+            "metadata": {
+                **job.metadata,
+                **job.chunk_metadata[pos],
+                "chunk_index": pos,
+                **totals,
+                "is_contextual": is_contextual,
+                "chunk_hash": job.chunk_hashes[pos]
+            }
+        }
+
+    def _register_chunk(self, job: FileJob, pos: int, label: int, contextual_content: str, is_contextual: bool):
+        """
+        Record a freshly embedded chunk; it becomes searchable when its file is finalized.
+
+        The entry carries no file hash until the whole file is finalized, so an
+        interrupted run re-indexes the file (reusing the chunks already added).
+        """
+        entry = self._chunk_entry(job, pos, is_contextual)
+        entry["contextual_content"] = contextual_content
+        self.mapping.put(label, entry)
+        if self._lexical is not None:
+            self._lexical.add(label, job.chunks[pos])
+        self.manifest.record(job.file_path, None, job.chunk_hashes[pos], label)
+        job.indexed.add(label)
+        job.remaining -= 1
+
+    def _finalize_file(self, job: FileJob, publish: bool = True) -> Dict[str, Any]:
+        """
+        Complete a file once all its chunks have arrived and its new chunks are indexed.
+
+        Refreshes position metadata of reused chunks, stamps the file hash on every chunk, retires chunks that
+        disappeared from the file and updates the manifest.
+
+        Args:
+            job: The file
+            publish: Publish the change; a caller finalizing several files publishes once after the last
+
+        Returns:
+            Per-file result with "embedded", "deduplicated", "reused" and "retired" counts
+        """
+        for label in job.labels.values():
+            self.mapping.update_metadata(label, {"total_chunks": len(job.chunks), "file_hash": job.file_hash})
+        for pos, label in job.kept.items():
+            self.mapping.update_metadata(label, {
+                **job.chunk_metadata[pos],
+                "chunk_index": pos,
+                "total_chunks": len(job.chunks),
+                "file_hash": job.file_hash
+            })
+        self._retire_labels(job.stale)
+
+        labels = [job.kept[pos] if pos in job.kept else job.labels[pos] for pos in range(len(job.chunks))]
+        self.manifest.replace_file(job.file_path, job.file_hash, job.chunk_hashes, labels)
+        self._unpublished.difference_update(job.own)
+        if publish:
+            self._publish()  # new, changed and removed chunks of the file show up together
+        job.finished = True
+        embedded = len(job.labels) - len(job.duplicate_of)
+        if job.kept or job.stale:
+            print(f"{os.path.basename(job.file_path)}: embedded {embedded}, reused {len(job.kept)}, retired {len(job.stale)} chunks")
+        return {
+            "file_path": job.file_path,
+            "chunks": len(job.chunks),
+            "embedded": embedded,
+            "deduplicated": len(job.duplicate_of),
+            "reused": len(job.kept),
+            "retired": len(job.stale),
+            "success": True
+        }
+
+    def _abort_file(self, job: FileJob, discard: bool = False):
+        """
+        Undo the bookkeeping of a file's chunks that never got a vector.
+
+        Args:
+            job: The unfinished file
+            discard: Also drop the chunks that were indexed, as when the rest of
+                the file could not be extracted; otherwise they are kept for the
+                next run to reuse
+        """
+        if self._deduplicator is not None:
+            for label in job.registered:
+                if label not in job.indexed:
+                    self._deduplicator.remove(label)
+        if discard:
+            added = [label for label in job.own if label in self.mapping]
+            self._retire_labels(added)
+            self.manifest.discard(job.file_path, added)
+        else:
+            self._retire_labels([label for label, target in job.duplicate_of.items()
+                                 if target in job.own and target not in job.indexed])
+        self._unpublished.difference_update(job.own)
+        self._publish()
+        job.finished = True
+
+    async def index_file_async(self, file_path: str, metadata: Optional[Dict[str, Any]] = None,
+                               max_chunks: int = None, force: bool = False):
+        """
+        Index a single file through the ingestion pipeline.
+
+        Files whose content hash matches the manifest are skipped unless
+        ``force`` is set; for modified files only changed chunks are embedded.
+        """
+        try:
+            await asyncio.to_thread(self.ready.wait)  # writes wait for a background load
+            self._check_writable()
+            file_hash = await asyncio.to_thread(file_sha256, file_path)
+            if not force and self.manifest.is_unchanged(file_path, file_hash):
+                print(f"⏭️ File {os.path.basename(file_path)} is unchanged, skipping")
+                return {
+                    "file_path": str(file_path),
+                    "chunks": len(self.manifest.labels_for_file(file_path)),
+                    "skipped": True,
+                    "success": True
+                }
+
+            def source():
+                # Stream the chunks in parts, holding one back to tell which is last.
+                # Stop extracting once one chunk past max_chunks shows the file is longer.
+                limit = max_chunks + 1 if max_chunks and max_chunks > 0 else None
+                chunks = self._iter_file_chunks(file_path, file_hash)
+                try:
+                    parts = iter_parts(itertools.islice(chunks, limit))
+                    part, count = next(parts, []), 0
+                    for following in parts:
+                        count += len(part)
+                        yield str(file_path), file_hash, part, False
+                        part = following
+                    count += len(part)
+                    print(f"Chunked file into {count} segments")
+                    if limit and count == limit:
+                        print(f"Using only first {max_chunks} chunks as requested")
+                        # no file hash for a partial run, so a later full run does not skip the file
+                        yield str(file_path), None, part[:-1], True
+                    else:
+                        yield str(file_path), file_hash, part, True
+                finally:
+                    chunks.close()
+
             # Update metadata with indexing timestamp
             metadata = metadata or {}
             metadata["indexed_at"] = time.time()
             metadata["file_name"] = os.path.basename(file_path)
-            
-            full_doc = "\n".join(chunks)
-            # Generate contextual embeddings in parallel
-            contextual = []
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                futures = {executor.submit(generate_contextual_embedding, full_doc, c): i for i, c in enumerate(chunks)}
-                for future in concurrent.futures.as_completed(futures):
-                    idx = futures[future]
-                    try:
-                        text, ok = future.result()
-                    except Exception as e:
-                        print(f"Context generation error for chunk {idx}: {e}")
-                        text, ok = chunks[idx], False
-                    contextual.append((idx, text, ok))
-            contextual.sort(key=lambda x: x[0])
-            contextual_texts = [c[1] for c in contextual]
-            ok_flags = [c[2] for c in contextual]
-            
-            # Batch embedding creation
-            batch_size = 10
-            embeddings = []
-            for i in range(0, len(contextual_texts), batch_size):
-                batch = contextual_texts[i:i+batch_size]
-                emb = create_embeddings_batch(
-                    batch, 
-                    metadata=metadata, 
-                    source_file=str(file_path), 
-                    total_chunks=len(chunks)
-                )
-                embeddings.extend(emb)
-            
-            # Add to HNSW
-            start_count = len(self.mapping)
-            self.index.add_items(embeddings, list(range(start_count, start_count + len(embeddings))))
-            for j, chunk in enumerate(chunks):
-                self.mapping[str(start_count + j)] = {
-                    "content": chunk,
-                    "contextual_content": contextual_texts[j],
-                    "file_path": str(file_path),
-                    "metadata": { 
-                        **metadata, 
-                        "chunk_index": j, 
-                        "total_chunks": len(chunks), 
-                        "is_contextual": ok_flags[j] 
-                    }
-                }
-            
-            # Try to save to Supabase but don't fail if it doesn't work
-            try:
-                self._save_index_to_supabase()
-            except Exception as e:
-                print(f"Warning: Could not save index to Supabase after indexing file: {e}")
-                print("Index will be available for this session but won't persist in Supabase.")
-            
-            print(f"✅ File {os.path.basename(file_path)} indexed successfully with {len(chunks)} chunks")
-            return {
-                "file_path": str(file_path),
-                "chunks": len(chunks),
-                "success": True
-            }
+
+            pipeline = IngestionPipeline(self)
+            self.last_ingestion = pipeline
+            outcome = await pipeline.run(source(), lambda path: metadata)
+            result = outcome["files"][0]
+            self.maybe_compact()
+            self.maybe_tune_ef()
+            print(f"✅ File {os.path.basename(file_path)} indexed successfully with {result['chunks']} chunks")
+            return result
         except Exception as e:
             print(f"Error indexing file {file_path}: {e}")
             import traceback
@@ -314,90 +537,290 @@ class DocumentIndexer:
                 "success": False
             }
 
-    def index_directory(self, directory_path: str, metadata: Optional[Dict[str, Any]] = None, max_chunks: int = None):
-        """Index all PDF/Text files in a directory."""
+    def index_file(self, file_path: str, metadata: Optional[Dict[str, Any]] = None, max_chunks: int = None,
+                   force: bool = False):
+        """Index a single file by creating embeddings and storing them (blocking)."""
+        return run_coroutine_sync(self.index_file_async(file_path, metadata, max_chunks, force))
+
+    async def index_directory_async(self, directory_path: str, metadata: Optional[Dict[str, Any]] = None,
+                                    max_chunks: int = None, max_workers: Optional[int] = None,
+                                    recursive: bool = True, force: bool = False) -> Dict[str, Any]:
+        """
+        Index all PDF/Text files in a directory through the ingestion pipeline.
+
+        Files are extracted in a process pool and their chunks stream into the
+        pipeline in parts as they are produced, so parsing, contextualization,
+        embedding and indexing overlap and no file is held in memory whole. Files unchanged since the last run are
+        not extracted at all. The index is persisted once at the end.
+
+        Returns:
+            Dict with per-file "files" results, "skipped" count and pipeline "stats"
+        """
         try:
-            chunks = process_directory(directory_path)
-            if max_chunks and 0 < max_chunks < len(chunks):
-                chunks = chunks[:max_chunks]
-            full_doc = "\n".join(chunks)
-            contextual = []
-            import concurrent.futures
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-                futures = {executor.submit(generate_contextual_embedding, full_doc, c): i for i, c in enumerate(chunks)}
-                for f in concurrent.futures.as_completed(futures):
-                    idx = futures[f]
-                    try:
-                        text, ok = f.result()
-                    except Exception as e:
-                        print(f"Context err {idx}: {e}")
-                        text, ok = chunks[idx], False
-                    contextual.append((idx, text, ok))
-            contextual.sort(key=lambda x: x[0])
-            contextual_texts = [c[1] for c in contextual]
-            ok_flags = [c[2] for c in contextual]
-            # Embed
-            embeddings = []
-            batch_size = 10
-            for i in range(0, len(contextual_texts), batch_size):
-                batch = contextual_texts[i:i+batch_size]
-                emb = create_embeddings_batch(batch, metadata={**(metadata or {}), "directory": os.path.basename(directory_path)}, source_file=str(directory_path), total_chunks=len(chunks))
-                embeddings.extend(emb)
-            # Add to index
-            start_count = len(self.mapping)
-            self.index.add_items(embeddings, list(range(start_count, start_count + len(embeddings))))
-            for j, chunk in enumerate(chunks):
-                self.mapping[str(start_count + j)] = {
-                    "content": chunk,
-                    "contextual_content": contextual_texts[j],
-                    "file_path": str(directory_path),
-                    "metadata": { **(metadata or {}), "chunk_index": j, "total_chunks": len(chunks), "is_contextual": ok_flags[j] }
+            if not os.path.isdir(directory_path):
+                raise FileNotFoundError(f"Directory not found: {directory_path}")
+            await asyncio.to_thread(self.ready.wait)  # writes wait for a background load
+            self._check_writable()
+
+            def changed_files():
+                file_hashes, skipped = {}, 0
+                for file_path in iter_directory_files(directory_path, recursive=recursive):
+                    file_hash = file_sha256(str(file_path))
+                    if not force and self.manifest.is_unchanged(str(file_path), file_hash):
+                        skipped += 1
+                        continue
+                    file_hashes[str(file_path)] = file_hash
+                return file_hashes, skipped
+
+            file_hashes, skipped = await asyncio.to_thread(changed_files)
+            if skipped:
+                print(f"⏭️ Skipping {skipped} unchanged files")
+
+            def source():
+                total = 0
+                open_files = set()  # files with parts delivered but not the last one
+                parts = iter_records_parallel(file_hashes, max_workers=max_workers, file_hashes=file_hashes)
+                try:
+                    for file_path, records, last in parts:
+                        file_hash = file_hashes[file_path]
+                        if records is None:
+                            open_files.discard(file_path)
+                            yield file_path, None, None, True
+                            continue
+                        room = max_chunks - total if max_chunks and max_chunks > 0 else None
+                        if room is not None and (len(records) > room or (len(records) == room and not last)):
+                            records, last = records[:room], True
+                            file_hash = None  # partial file; see index_file_async
+                        if last:
+                            open_files.discard(file_path)
+                        else:
+                            open_files.add(file_path)
+                        yield file_path, file_hash, records, last
+                        total += len(records)
+                        if room is not None and total >= max_chunks:
+                            print(f"Reached max_chunks={max_chunks}, stopping extraction")
+                            for file_path in sorted(open_files):
+                                yield file_path, None, [], True  # partial files end here
+                            break
+                finally:
+                    parts.close()
+
+            def metadata_for(file_path: str) -> Dict[str, Any]:
+                return {
+                    **(metadata or {}),
+                    "directory": os.path.basename(directory_path),
+                    "indexed_at": time.time(),
+                    "file_name": os.path.basename(file_path)
                 }
-            self._save_index_to_supabase()
-            print("Directory indexed successfully")
+
+            pipeline = IngestionPipeline(self)
+            self.last_ingestion = pipeline
+            outcome = await pipeline.run(source(), metadata_for)
+            total = sum(r.get("chunks", 0) for r in outcome["files"])
+            self.maybe_compact()
+            self.maybe_tune_ef()
+            print(f"Directory indexed successfully: {len(outcome['files'])} files, {total} chunks, {skipped} unchanged")
+            return {**outcome, "skipped": skipped}
         except Exception as e:
             print(f"Error indexing directory {directory_path}: {e}")
             raise
 
-    def search_similar(self, query: str, limit: int = 5) -> List[Dict[str, Any]]:
-        """Return similar chunks for a query."""
+    def index_directory(self, directory_path: str, metadata: Optional[Dict[str, Any]] = None, max_chunks: int = None,
+                        max_workers: Optional[int] = None, recursive: bool = True, force: bool = False):
+        """Index all PDF/Text files in a directory (blocking)."""
+        return run_coroutine_sync(
+            self.index_directory_async(directory_path, metadata, max_chunks, max_workers, recursive, force)
+        )
+
+    def ingestion_stats(self) -> Dict[str, Any]:
+        """Per-stage throughput of the current or last ingestion run."""
+        return self.last_ingestion.stats() if self.last_ingestion is not None else {}
+
+    def delete_index(self, file_path: str) -> Dict[str, Any]:
+        """
+        Remove all chunks originating from a particular file.
+        
+        The file's labels come from the manifest, so a delete costs
+        O(chunks in file): entries are dropped from the chunk store and their
+        vectors are tombstoned with mark_deleted. Once tombstones pass
+        COMPACTION_THRESHOLD of the graph, it is rebuilt in the background.
+        """
+        self.ready.wait()
+        self._check_writable()
+        with self._write_lock:
+            labels = self.manifest.remove_file(file_path)
+            if not labels:
+                print(f"No indexed chunks for {file_path}")
+                return {"file_path": str(file_path), "deleted": 0}
+            self._retire_labels(labels)
+            self._publish()
+        print(f"🗑️ Deleted {len(labels)} chunks of {os.path.basename(str(file_path))}")
+        self._persist()
+        self.maybe_compact()
+        return {"file_path": str(file_path), "deleted": len(labels)}
+
+    def tombstone_ratio(self) -> float:
+        """Share of the HNSW graph's elements that are deleted."""
+        total = self.index.get_current_count()
+        return len(self.tombstones) / total if total else 0.0
+
+    def maybe_compact(self) -> bool:
+        """Start a background compaction if enough vectors are tombstoned; returns whether one started."""
+        if len(self.tombstones) < COMPACTION_MIN_TOMBSTONES or self.tombstone_ratio() < COMPACTION_THRESHOLD:
+            return False
+        return self.compact(background=True)
+
+    def compact(self, background: bool = True) -> bool:
+        """
+        Rebuild the HNSW graph from the stored vectors of live chunks, dropping tombstones.
+        
+        Vectors are copied out of the current graph with get_items, never
+        re-embedded. Searches keep using the current graph while the new one is
+        built; writes made meanwhile are replayed before the graphs are swapped.
+        
+        Returns:
+            False if a compaction is already running
+        """
+        with self._index_lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return False
+            self._compaction = threading.Thread(target=self._compact, name=f"compact-{self.index_name}", daemon=True)
+            self._compaction.start()
+        if not background:
+            self._compaction.join()
+        return True
+
+    def _compact(self):
         try:
-            q_emb = create_embeddings_batch([query], store_in_db=False)[0]
-            labels, dists = self.index.knn_query([q_emb], k=min(limit, len(self.mapping)))
-            results = []
-            for l, d in zip(labels[0], dists[0]):
-                if str(l) in self.mapping:
-                    doc = self.mapping[str(l)]
-                    results.append({
-                        "content": doc["content"],
-                        "file_path": doc["file_path"],
-                        "metadata": doc["metadata"],
-                        "similarity_score": float(1 - d)  # ensure native float for JSON
-                    })
-            return results
+            started = time.time()
+            with self._index_lock:
+                old = self.index
+                live = sorted(set(old.get_ids_list()) - self.tombstones)
+                tombstones = len(self.tombstones)
+            print(f"🧹 Compacting index '{self.index_name}': {len(live)} live vectors, {tombstones} tombstones")
+            
+            # Size the new graph for the live vectors plus one growth step, which may shrink it
+            new = self._new_index(max(INITIAL_CAPACITY, int(len(live) * CAPACITY_GROWTH)))
+            copied = []
+            for i in range(0, len(live), COMPACTION_BATCH):
+                # Under the lock (which also excludes resizes): vectors retired since
+                # the list was taken are deleted from the old graph and cannot be read
+                with self._index_lock:
+                    labels = [label for label in live[i:i + COMPACTION_BATCH] if label not in self.tombstones]
+                    vectors = old.get_items(labels) if labels else None
+                if labels:
+                    new.add_items(vectors, labels)
+                    copied.extend(labels)
+            
+            with self._index_lock:
+                # Replay what changed while the new graph was being built
+                current = set(old.get_ids_list()) - self.tombstones
+                built = set(copied)
+                added = sorted(current - built)
+                if added:
+                    grow_index(new, added)
+                    new.add_items(old.get_items(added), added)
+                removed = built - current
+                for label in removed:
+                    new.mark_deleted(label)
+                new.set_ef(self.ef_search)  # tuned while the new graph was being built
+                self.index = new
+                self.max_elements = new.get_max_elements()
+                self.tombstones = removed
+                self._publish(same_chunks=True)
+            
+            self.compactions += 1
+            self.last_compaction = {
+                "finished_at": time.time(),
+                "seconds": round(time.time() - started, 3),
+                "live_vectors": len(current),
+                "tombstones_dropped": tombstones
+            }
+            print(f"✅ Compacted index '{self.index_name}' in {self.last_compaction['seconds']}s")
+            # The log already describes every chunk; the smaller graph goes out with the next save's snapshot
+            self.snapshot_requested = True
         except Exception as e:
-            print(f"Search error: {e}")
-            return []
-
-    def delete_index(self, file_path: str):
-        """Remove all vectors originating from a particular file."""
-        keys = [k for k, v in self.mapping.items() if v["file_path"] == str(file_path)]
-        for k in keys:
-            del self.mapping[k]
-        # rebuild index
-        self.clear_index()
-        # re-add remaining
-        for k, v in self.mapping.items():
-            emb = create_embeddings_batch([v.get("contextual_content", v["content"])], store_in_db=False)[0]
-            self.index.add_items([emb], [int(k)])
-        self._save_index_to_supabase()
+            print(f"Error compacting index '{self.index_name}': {e}")
+            import traceback
+            traceback.print_exc()
+
+    def index_stats(self) -> Dict[str, Any]:
+        """Graph size, tombstones, compaction history, load status and the published view."""
+        return {
+            "load": self.load_status,
+            "elements": self.index.get_current_count(),
+            "live_vectors": self._vector_count(),
+            "tombstones": len(self.tombstones),
+            "tombstone_ratio": round(self.tombstone_ratio(), 4),
+            "compacting": self._compaction is not None and self._compaction.is_alive(),
+            "compactions": self.compactions,
+            "last_compaction": self.last_compaction,
+            "memory": self.memory_report(),
+            "vector_tier": self.vector_tier.stats() if self.vector_tier is not None else {"enabled": False},
+            "filters": self._filter_index.stats() if self._filter_index is not None else None,
+            "lexical": self._lexical.stats() if self._lexical is not None else {"enabled": LEXICAL_ENABLED, "built": False},
+            "search": {
+                "strategy": self.search_strategy(),
+                "exact_max": EXACT_SEARCH_MAX,
+                "ef": self.ef_search,
+                "tuning": self._tuning is not None and self._tuning.is_alive(),
+                "last_tuning": self.ef_tuning
+            },
+            "view": {
+                "generation": self.view.generation,
+                "published_at": self.view.published_at,
+                "chunks": len(self.view.mapping),
+                "readers": sum(self._readers.values()),
+                "unpublished_chunks": len(self._unpublished),
+                "retiring_vectors": sum(len(r[2]) for r in self._retiring)
+            },
+            "shards": self.index.shard_stats() if isinstance(self.index, ShardedIndex) else None
+        }
+
+    def memory_report(self) -> Dict[str, Any]:
+        """
+        Estimate the index's memory footprint.
+
+        HNSW bytes follow hnswlib's layout: every slot of capacity holds the
+        vector, the level-0 links (2*M), the label, a link-list pointer and a
+        lock; elements on upper levels (1 in M-1 on average) add M links each.
+        """
+        capacity = self.index.get_max_elements()
+        elements = self.index.get_current_count()
+        level0 = self.dimension * 4 + (2 * self.M + 1) * 4 + 8
+        slot = level0 + 8 + 4 + 40  # link-list pointer, element level, std::mutex
+        upper = (self.M + 1) * 4 / max(1, self.M - 1)
+        hnsw_allocated = int(capacity * slot + elements * upper)
+        hnsw_used = int(elements * (slot + upper))
+        store = self.mapping.stats()
+        chunk_bytes = store["content_bytes"] + store["context_bytes"] + store["column_bytes"]
+        lexical = self._lexical
+        lexical_bytes = lexical.memory_bytes() if lexical is not None else 0
+        exact = self._exact
+        exact_bytes = exact[1].vectors.nbytes if exact is not None else 0
+        return {
+            "capacity": capacity,
+            "elements": elements,
+            "fill_ratio": round(elements / capacity, 4) if capacity else 0.0,
+            "bytes_per_slot": slot,
+            "hnsw_allocated_bytes": hnsw_allocated,
+            "hnsw_used_bytes": hnsw_used,
+            "chunk_store_bytes": chunk_bytes,
+            "lexical_bytes": lexical_bytes,
+            "exact_bytes": exact_bytes,
+            "total_bytes": hnsw_allocated + chunk_bytes + lexical_bytes + exact_bytes
+        }
 
     def clear_index(self):
         """Clear entire HNSW index."""
-        self.index = hnswlib.Index(space='cosine', dim=self.dimension)
-        self.index.init_index(max_elements=self.max_elements, ef_construction=self.ef_construction, M=self.M)
-        self.index.set_ef(self.ef_search)
-        self.mapping = {}
-        self._save_index_to_supabase()
-
-    # ... existing methods (index_file, index_directory, search_similar, delete_index, clear_index) ... 
\ No newline at end of file
+        self.ready.wait()
+        self._check_writable()
+        with self._write_lock, self._index_lock:
+            self.index = self._new_index()
+            self.max_elements = self.index.get_max_elements()
+            self.mapping = ChunkStore()
+            self._load_bookkeeping()
+            self._publish()  # searches under way finish on the old index and chunks
+        if self.vector_tier is not None:
+            self.vector_tier.clear()
+        self._persist(snapshot=True)  # an empty snapshot supersedes the whole log
@@ -0,0 +1,231 @@
+"""
+In-process BM25 index over the chunk store.
+
+Postings are kept per term as two packed arrays (labels and term
+frequencies) that are scored with NumPy, so a query touches only the
+postings of its own terms and never leaves the process. Like the vector
+index it covers the chunks that own a vector; duplicate chunks are found
+through their owner. Removed chunks are masked by a zero document length and
+purged from the postings once they make up a large share of them.
+"""
+import math
+import os
+import re
+import threading
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+LEXICAL_ENABLED = os.getenv("KB_LEXICAL", "1") != "0"
+BM25_K1 = float(os.getenv("KB_BM25_K1", "1.2"))
+BM25_B = float(os.getenv("KB_BM25_B", "0.75"))
+RRF_K = 60  # reciprocal rank fusion damping: a result at rank r contributes 1 / (RRF_K + r)
+PURGE_RATIO = 0.3  # purge removed chunks once this share of postings belongs to them
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased word tokens, matching the dedup shingler's notion of a word."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+def reciprocal_rank_fusion(rankings: List[Tuple[np.ndarray, np.ndarray]], k: int,
+                           rrf_k: int = RRF_K) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fuse ranked label lists by reciprocal rank, ignoring their incomparable scores.
+
+    Args:
+        rankings: (labels, scores) per ranking, best first
+        k: Number of results
+
+    Returns:
+        (labels, fused scores), best first
+    """
+    fused: Dict[int, float] = {}
+    for labels, _ in rankings:
+        for rank, label in enumerate(np.asarray(labels).tolist(), start=1):
+            fused[int(label)] = fused.get(int(label), 0.0) + 1.0 / (rrf_k + rank)
+    best = sorted(fused.items(), key=lambda item: -item[1])[:k]
+    return (np.array([label for label, _ in best], dtype=np.int64),
+            np.array([score for _, score in best], dtype=np.float32))
+
+
+class LexicalIndex:
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        """
+        Initialize an empty index.
+
+        Args:
+            k1: BM25 term frequency saturation
+            b: BM25 document length normalization
+        """
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Tuple[array, array]] = {}  # term -> (labels, term frequencies)
+        self._doc_len = np.zeros(0, dtype=np.int32)          # tokens per label; 0 = not indexed
+        self._doc_terms = np.zeros(0, dtype=np.int32)        # distinct terms per label
+        self._docs = 0
+        self._total_len = 0
+        self._live_postings = 0
+        self._dead_postings = 0
+        self._removed = set()  # labels whose postings are still present
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._docs
+
+    def _grow(self, label: int):
+        if label >= len(self._doc_len):
+            size = max(label + 1, len(self._doc_len) * 2, 1024)
+            for name in ("_doc_len", "_doc_terms"):
+                grown = np.zeros(size, dtype=np.int32)
+                old = getattr(self, name)
+                grown[:len(old)] = old
+                setattr(self, name, grown)
+
+    def add(self, label: int, text: str):
+        """Index a chunk's text, replacing what was indexed under ``label`` before."""
+        counts = Counter(tokenize(text))
+        with self._lock:
+            label = int(label)
+            self._remove(label)
+            if label in self._removed:
+                self._purge()  # stale postings of the old text would count for the new one
+            self._grow(label)
+            for term, tf in counts.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = (array("q"), array("I"))
+                postings[0].append(label)
+                postings[1].append(tf)
+            length = sum(counts.values())
+            if length:
+                self._doc_len[label] = length
+                self._doc_terms[label] = len(counts)
+                self._docs += 1
+                self._total_len += length
+                self._live_postings += len(counts)
+
+    def remove(self, label: int):
+        with self._lock:
+            self._remove(int(label))
+            if self._dead_postings > PURGE_RATIO * (self._live_postings + self._dead_postings):
+                self._purge()
+
+    def _remove(self, label: int):
+        if label >= len(self._doc_len) or not self._doc_len[label]:
+            return
+        self._docs -= 1
+        self._total_len -= int(self._doc_len[label])
+        self._live_postings -= int(self._doc_terms[label])
+        self._dead_postings += int(self._doc_terms[label])
+        self._doc_len[label] = 0
+        self._doc_terms[label] = 0
+        self._removed.add(label)
+
+    def _purge(self):
+        """Drop the postings of removed chunks."""
+        removed = np.fromiter(self._removed, dtype=np.int64, count=len(self._removed))
+        for term in list(self._postings):
+            labels, tfs = self._postings[term]
+            label_arr = np.frombuffer(labels, dtype=np.int64).copy()  # a view would pin the array's buffer
+            keep = ~np.isin(label_arr, removed)
+            if keep.all():
+                continue
+            if not keep.any():
+                del self._postings[term]
+                continue
+            kept_labels = array("q", label_arr[keep].tobytes())
+            kept_tfs = array("I", np.frombuffer(tfs, dtype=np.uint32)[keep].tobytes())
+            self._postings[term] = (kept_labels, kept_tfs)
+        self._removed = set()
+        self._dead_postings = 0
+
+    def sync(self, store) -> Tuple[int, int]:
+        """
+        Bring the index in line with the chunks of ``store`` that own a vector.
+
+        Returns:
+            (chunks added, chunks removed)
+        """
+        labels = store.labels()
+        owners = labels[store.owners(labels) == labels]
+        with self._lock:
+            indexed = np.flatnonzero(self._doc_len)
+        missing = np.setdiff1d(owners, indexed, assume_unique=True)
+        extra = np.setdiff1d(indexed, owners, assume_unique=True)
+        for label in missing.tolist():
+            try:
+                self.add(label, store.field(label, "content"))
+            except KeyError:
+                pass  # removed meanwhile
+        for label in extra.tolist():
+            self.remove(label)
+        return len(missing), len(extra)
+
+    def search(self, query: str, k: int, allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rank indexed chunks by BM25 against ``query``.
+
+        Args:
+            query: Query text
+            k: Number of results
+            allowed: Boolean bitmap indexed by label; only labels set in it are returned
+
+        Returns:
+            (labels, BM25 scores), best first
+        """
+        terms = set(tokenize(query))
+        with self._lock:
+            docs = self._docs
+            if not docs or k <= 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+            avg_len = self._total_len / docs
+            hit_labels, hit_scores = [], []
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                labels = np.frombuffer(postings[0], dtype=np.int64).copy()
+                tfs = np.frombuffer(postings[1], dtype=np.uint32).astype(np.float32)
+                lengths = self._doc_len[labels]
+                live = lengths > 0
+                df = int(live.sum())
+                if allowed is not None:
+                    inside = labels < len(allowed)
+                    live &= inside
+                    live[inside] &= allowed[labels[inside]]
+                if not live.any():
+                    continue
+                labels, tfs, lengths = labels[live], tfs[live], lengths[live]
+                idf = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths / avg_len)
+                hit_labels.append(labels)
+                hit_scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+        if not hit_labels:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        labels, inverse = np.unique(np.concatenate(hit_labels), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(hit_scores)).astype(np.float32)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+            labels, scores = labels[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return labels[order], scores[order]
+
+    def memory_bytes(self) -> int:
+        """Approximate resident size: 12 bytes per posting, the per-label arrays and per-term dict overhead."""
+        postings = 12 * (self._live_postings + self._dead_postings)
+        return postings + self._doc_len.nbytes + self._doc_terms.nbytes + 200 * len(self._postings)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "chunks": self._docs,
+                "terms": len(self._postings),
+                "postings": self._live_postings,
+                "dead_postings": self._dead_postings,
+                "bytes": self.memory_bytes()
+            }
@@ -0,0 +1,142 @@
+"""
+Content-hash manifest used to make re-indexing incremental.
+
+The manifest records, per source file, the hash of the file contents and the
+hash of every chunk indexed from it together with the chunk's index label.
+The hashes are stored in each chunk's metadata ("file_hash", "chunk_hash"),
+so the manifest is persisted with the chunk store and can be rebuilt from it
+on load.
+"""
+import hashlib
+from typing import Dict, Any, List, Optional, Tuple
+
+
+def file_sha256(file_path: str, block_size: int = 1 << 20) -> str:
+    """Hash a file's contents without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha256(text: str) -> str:
+    """Hash a chunk's text."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class IndexManifest:
+    def __init__(self):
+        """Create an empty manifest."""
+        # file_path -> {"file_hash": str | None, "chunks": {chunk_hash: [labels]}}
+        self.files: Dict[str, Dict[str, Any]] = {}
+
+    @classmethod
+    def from_store(cls, store) -> "IndexManifest":
+        """
+        Rebuild the manifest from the chunk store's metadata columns.
+
+        Chunks indexed before hashes were recorded get their chunk hash
+        computed from their content and a file hash of None, so the next
+        re-index of their file reuses matching chunks instead of duplicating them.
+        """
+        manifest = cls()
+        for label, file_path, file_hash, chunk_hash in store.iter_columns("label", "file_path", "file_hash", "chunk_hash"):
+            if chunk_hash is None:
+                chunk_hash = text_sha256(store.field(label, "content"))
+            manifest.record(file_path, file_hash, chunk_hash, label)
+        return manifest
+
+    def file_hash(self, file_path: str) -> Optional[str]:
+        """Return the recorded hash of a file, if any."""
+        entry = self.files.get(str(file_path))
+        return entry["file_hash"] if entry else None
+
+    def is_unchanged(self, file_path: str, file_hash: str) -> bool:
+        """Whether the file was already indexed with exactly this content."""
+        return file_hash is not None and self.file_hash(file_path) == file_hash
+
+    def labels_for_file(self, file_path: str) -> List[int]:
+        """Return every label indexed from a file."""
+        entry = self.files.get(str(file_path))
+        if not entry:
+            return []
+        return [label for labels in entry["chunks"].values() for label in labels]
+
+    def plan(self, file_path: str, chunk_hashes: List[str]) -> Tuple[Dict[int, int], List[int], List[int]]:
+        """
+        Work out which chunks of a modified file need embedding.
+
+        Args:
+            file_path: Source file
+            chunk_hashes: Hashes of the file's new chunks, in document order
+
+        Returns:
+            Tuple containing:
+            - kept: position in the new chunk list -> existing label to reuse
+            - new_positions: positions whose chunks must be embedded
+            - stale_labels: existing labels no longer present in the file
+        """
+        plan = self.start_plan(file_path)
+        kept = {}
+        new_positions = []
+        for pos, chunk_hash in enumerate(chunk_hashes):
+            label = plan.match(chunk_hash)
+            if label is not None:
+                kept[pos] = label
+            else:
+                new_positions.append(pos)
+        return kept, new_positions, plan.stale()
+
+    def start_plan(self, file_path: str) -> "FilePlan":
+        """Start a ``plan`` for a file whose chunks arrive a part at a time."""
+        entry = self.files.get(str(file_path))
+        return FilePlan(entry["chunks"] if entry else {})
+
+    def record(self, file_path: str, file_hash: Optional[str], chunk_hash: str, label: int):
+        """Record that a chunk of a file is indexed under a label."""
+        entry = self.files.setdefault(str(file_path), {"file_hash": file_hash, "chunks": {}})
+        if file_hash is not None:
+            entry["file_hash"] = file_hash
+        entry["chunks"].setdefault(chunk_hash, []).append(label)
+
+    def replace_file(self, file_path: str, file_hash: str, chunk_hashes: List[str], labels: List[int]):
+        """Replace everything recorded for a file with its current chunks."""
+        self.files[str(file_path)] = {"file_hash": file_hash, "chunks": {}}
+        for chunk_hash, label in zip(chunk_hashes, labels):
+            self.record(file_path, file_hash, chunk_hash, label)
+
+    def discard(self, file_path: str, labels: List[int]):
+        """Forget some labels recorded for a file, keeping the rest of its entry."""
+        entry = self.files.get(str(file_path))
+        if not entry:
+            return
+        dropped = set(labels)
+        for chunk_hash in list(entry["chunks"]):
+            kept = [label for label in entry["chunks"][chunk_hash] if label not in dropped]
+            if kept:
+                entry["chunks"][chunk_hash] = kept
+            else:
+                del entry["chunks"][chunk_hash]
+
+    def remove_file(self, file_path: str) -> List[int]:
+        """Forget a file and return the labels that were recorded for it."""
+        labels = self.labels_for_file(file_path)
+        self.files.pop(str(file_path), None)
+        return labels
+
+
+class FilePlan:
+    """Incremental ``IndexManifest.plan``: matches a file's chunks to its indexed labels as they arrive."""
+
+    def __init__(self, chunks: Dict[str, List[int]]):
+        self.available = {h: list(labels) for h, labels in chunks.items()}
+
+    def match(self, chunk_hash: str) -> Optional[int]:
+        """Return an existing label to reuse for the next chunk with this hash, or None if it must be embedded."""
+        labels = self.available.get(chunk_hash)
+        return labels.pop(0) if labels else None
+
+    def stale(self) -> List[int]:
+        """Existing labels no chunk matched; call once the file's last chunk is planned."""
+        return [label for labels in self.available.values() for label in labels]
@@ -0,0 +1,415 @@
+"""
+Incremental persistence for HNSW indexes: snapshots plus an append-only delta log.
+
+Every save appends one record per chunk changed since the last save: a "put"
+carrying the chunk's entry and (unless it shares another chunk's vector) its
+float32 vector, or a "delete". A compacted snapshot of the whole graph and
+chunk store is written only every SNAPSHOT_EVERY_RECORDS log records or
+SNAPSHOT_EVERY_SECONDS, so the cost of a save follows the size of the change,
+not the size of the corpus. Recovery loads the latest snapshot and replays
+the records after its sequence number.
+
+Records describe the resulting state of a label rather than an operation, so
+replaying a record twice is harmless and a retried append may reuse sequence
+numbers.
+
+Two backends implement the same interface: ``LocalIndexStore`` keeps
+snapshots and logs on disk, ``SupabaseIndexStore`` keeps snapshots in the
+``hnsw_indices`` table and the log in ``hnsw_index_log``. A remote store can be
+paired with a local snapshot cache (a ``LocalIndexStore`` without a log): when
+the cached snapshot's sequence number matches the remote one, startup loads
+the graph straight from disk and memory-maps the chunk store instead of
+downloading and decoding the remote snapshot.
+"""
+import base64
+import concurrent.futures
+import json
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Set, Union
+
+import hnswlib
+import numpy as np
+
+from chunk_store import ChunkStore
+from disk_cache import DEFAULT_CACHE_DIR
+from sharding import ShardedIndex
+
+# "supabase" or "local"
+PERSISTENCE_BACKEND = os.getenv("KB_PERSISTENCE", "supabase")
+LOCAL_INDEX_DIR = os.getenv("KB_INDEX_DIR", os.path.join(DEFAULT_CACHE_DIR, "indexes"))
+
+# Snapshot cadence; a snapshot also truncates the log it covers
+SNAPSHOT_EVERY_RECORDS = int(os.getenv("KB_SNAPSHOT_EVERY_RECORDS", "5000"))
+SNAPSHOT_EVERY_SECONDS = float(os.getenv("KB_SNAPSHOT_EVERY_SECONDS", "3600"))  # 0 disables
+
+# Local copies of remote snapshots for fast restarts
+SNAPSHOT_CACHE_ENABLED = os.getenv("KB_SNAPSHOT_CACHE", "1") != "0"
+SNAPSHOT_CACHE_DIR = os.getenv("KB_SNAPSHOT_CACHE_DIR", os.path.join(DEFAULT_CACHE_DIR, "snapshots"))
+
+LOG_BATCH = 500  # log rows per Supabase request
+SNAPSHOT_FORMAT = 1  # layout version of local snapshot directories
+
+
+def index_to_bytes(index: hnswlib.Index) -> bytes:
+    """Serialize an HNSW index."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        temp_path = os.path.join(temp_dir, "index.bin")
+        index.save_index(temp_path)
+        with open(temp_path, "rb") as f:
+            return f.read()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def index_from_bytes(data: bytes, dimension: int) -> hnswlib.Index:
+    """Deserialize an HNSW index written by ``index_to_bytes``."""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        temp_path = os.path.join(temp_dir, "index.bin")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        index = hnswlib.Index(space="cosine", dim=dimension)
+        index.load_index(temp_path)
+        return index
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _load_graph(graph: Union[bytes, str], dimension: int) -> hnswlib.Index:
+    """Load a graph held as serialized bytes or as the path of a local file."""
+    if isinstance(graph, (bytes, bytearray)):
+        return index_from_bytes(graph, dimension)
+    index = hnswlib.Index(space="cosine", dim=dimension)
+    index.load_index(graph)
+    return index
+
+
+def _parallel(fn, items: list) -> list:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(len(items), os.cpu_count() or 4))) as pool:
+        return list(pool.map(fn, items))
+
+
+def encode_vector(vector) -> str:
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode("utf-8")
+
+
+def decode_vector(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype=np.float32)
+
+
+class Snapshot:
+    """
+    A compacted copy of an index as of log sequence number ``log_seq``.
+
+    Sequence numbers identify snapshots: every snapshot is written at a
+    sequence number no other snapshot or log record of the index uses.
+    The graph is held either as serialized bytes or as the path of a local
+    file; a sharded index holds one such graph per shard in ``shards``, and
+    ``changed_shards`` names those that differ from the previous snapshot.
+    ``codebook`` is the vector tier's serialized quantizer, if it has one.
+    """
+
+    def __init__(self, index_data: Optional[bytes], chunks: ChunkStore, log_seq: int = 0,
+                 max_elements: Optional[int] = None, ef_construction: Optional[int] = None,
+                 m_parameter: Optional[int] = None, index_path: Optional[str] = None,
+                 shards: Optional[List[Union[bytes, str]]] = None, changed_shards: Optional[Set[int]] = None,
+                 codebook: Optional[bytes] = None):
+        self.codebook = codebook
+        self.index_data = index_data
+        self.index_path = index_path
+        self.shards = shards
+        self.changed_shards = changed_shards
+        self.chunks = chunks
+        self.log_seq = log_seq
+        self.max_elements = max_elements
+        self.ef_construction = ef_construction
+        self.m_parameter = m_parameter
+
+    def load_index(self, dimension: int) -> hnswlib.Index:
+        """Build the HNSW index (shards load in parallel), reading local files directly when there are any."""
+        if self.shards is not None:
+            return ShardedIndex(_parallel(lambda graph: _load_graph(graph, dimension), self.shards), dirty=set())
+        return _load_graph(self.index_path or self.index_data, dimension)
+
+    def params(self) -> Dict[str, Any]:
+        params = {
+            "log_seq": self.log_seq,
+            "max_elements": self.max_elements,
+            "ef_construction": self.ef_construction,
+            "m_parameter": self.m_parameter
+        }
+        if self.shards is not None:
+            params["shards"] = len(self.shards)
+        return params
+
+
+class LocalIndexStore:
+    def __init__(self, directory: str = LOCAL_INDEX_DIR):
+        """
+        Keep snapshots and logs under ``directory/<index_name>/``.
+
+        A snapshot is a directory holding the serialized graph, the chunk store
+        (see ``ChunkStore.save``) and a params file; it is written next to the
+        current one and swapped in by rename. The log is a JSON-lines file.
+        """
+        self.directory = directory
+
+    def _path(self, index_name: str, *parts: str) -> str:
+        return os.path.join(self.directory, index_name, *parts)
+
+    def _params(self, index_name: str) -> Optional[Dict[str, Any]]:
+        path = self._path(index_name, "snapshot", "params.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            params = json.load(f)
+        if params.pop("format", None) != SNAPSHOT_FORMAT:
+            print(f"⚠️ Ignoring local snapshot of '{index_name}' written in an older format")
+            return None
+        return params
+
+    def list_indexes(self) -> List[str]:
+        """Names of the indexes that have a snapshot or a log."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.exists(self._path(name, "snapshot", "params.json"))
+                      or os.path.exists(self._path(name, "log.jsonl")))
+
+    def snapshot_version(self, index_name: str) -> Optional[int]:
+        """Sequence number of the latest snapshot, without loading it."""
+        params = self._params(index_name)
+        return params["log_seq"] if params else None
+
+    def load_snapshot(self, index_name: str, mmap: bool = True) -> Optional[Snapshot]:
+        """Open the latest snapshot; with ``mmap`` the chunk store is memory-mapped."""
+        params = self._params(index_name)
+        if params is None:
+            return None
+        path = self._path(index_name, "snapshot")
+        chunks = ChunkStore.load(os.path.join(path, "chunks"), mmap=mmap)
+        codebook = None
+        if os.path.exists(os.path.join(path, "codebook.npz")):
+            with open(os.path.join(path, "codebook.npz"), "rb") as f:
+                codebook = f.read()
+        shard_count = params.pop("shards", None)
+        if shard_count:
+            shards = [os.path.join(path, "shards", f"shard-{i}.bin") for i in range(shard_count)]
+            return Snapshot(None, chunks, shards=shards, codebook=codebook, **params)
+        return Snapshot(None, chunks, index_path=os.path.join(path, "index.bin"), codebook=codebook, **params)
+
+    def save_snapshot(self, index_name: str, snapshot: Snapshot):
+        path = self._path(index_name, "snapshot")
+        tmp = path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        if snapshot.shards is not None:
+            os.makedirs(os.path.join(tmp, "shards"))
+            for i, graph in enumerate(snapshot.shards):
+                self._write_graph(graph, os.path.join(tmp, "shards", f"shard-{i}.bin"))
+        else:
+            self._write_graph(snapshot.index_path or snapshot.index_data, os.path.join(tmp, "index.bin"))
+        snapshot.chunks.save(os.path.join(tmp, "chunks"))
+        if snapshot.codebook is not None:
+            self._write_graph(snapshot.codebook, os.path.join(tmp, "codebook.npz"))
+        # params.json is written last: a snapshot directory without it is incomplete
+        with open(os.path.join(tmp, "params.json"), "w", encoding="utf-8") as f:
+            json.dump({"format": SNAPSHOT_FORMAT, **snapshot.params()}, f)
+        old = path + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    @staticmethod
+    def _write_graph(graph: Union[bytes, str], path: str):
+        if isinstance(graph, (bytes, bytearray)):
+            with open(path, "wb") as f:
+                f.write(graph)
+        else:
+            shutil.copyfile(graph, path)
+
+    def append(self, index_name: str, records: List[Dict[str, Any]]):
+        os.makedirs(self._path(index_name), exist_ok=True)
+        with open(self._path(index_name, "log.jsonl"), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read_log(self, index_name: str, after_seq: int) -> Iterator[Dict[str, Any]]:
+        path = self._path(index_name, "log.jsonl")
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"⚠️ Ignoring torn record at the end of the log of '{index_name}'")
+                    break
+                if record["seq"] > after_seq:
+                    yield record
+
+    def truncate_log(self, index_name: str, upto_seq: int):
+        """Drop the records a snapshot covers."""
+        path = self._path(index_name, "log.jsonl")
+        if not os.path.exists(path):
+            return
+        kept = [line for line in self._lines(path) if json.loads(line)["seq"] > upto_seq]
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(kept)
+        os.replace(tmp, path)
+
+    def _lines(self, path: str) -> Iterator[str]:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.endswith("\n"):
+                    yield line
+
+
+class SupabaseIndexStore:
+    def __init__(self, client):
+        """
+        Keep snapshots in ``hnsw_indices`` (one row per index, ``log_seq``
+        marking the last record it covers) and the log in ``hnsw_index_log``.
+        The graphs of a sharded index live in rows of their own named
+        ``<index_name>#shard-<i>``; only changed shards are uploaded. The
+        vector tier's codebook, if any, is kept in ``<index_name>#codebook``.
+        """
+        self.client = client
+
+    @staticmethod
+    def _shard_name(index_name: str, shard: int) -> str:
+        return f"{index_name}#shard-{shard}"
+
+    @staticmethod
+    def _codebook_name(index_name: str) -> str:
+        return f"{index_name}#codebook"
+
+    def _upsert_row(self, data: Dict[str, Any]):
+        response = self.client.table("hnsw_indices").select("id").eq("index_name", data["index_name"]).execute()
+        if response.data:
+            self.client.table("hnsw_indices").update(data).eq("id", response.data[0]["id"]).execute()
+        else:
+            self.client.table("hnsw_indices").insert(data).execute()
+
+    def list_indexes(self) -> List[str]:
+        """Names of the indexes that have a snapshot (shard rows excluded)."""
+        rows = self.client.table("hnsw_indices").select("index_name").execute().data or []
+        return sorted(row["index_name"] for row in rows if "#" not in row["index_name"])
+
+    def snapshot_version(self, index_name: str) -> Optional[int]:
+        """Sequence number of the latest snapshot, without downloading it."""
+        response = self.client.table("hnsw_indices").select("log_seq").eq("index_name", index_name).execute()
+        if not response.data:
+            return None
+        return response.data[0].get("log_seq") or 0
+
+    def load_snapshot(self, index_name: str) -> Optional[Snapshot]:
+        response = self.client.table("hnsw_indices").select("*").eq("index_name", index_name).execute()
+        if not response.data:
+            return None
+        row = response.data[0]
+        shards = None
+        if row.get("shards"):
+            def fetch(shard: int) -> bytes:
+                name = self._shard_name(index_name, shard)
+                rows = self.client.table("hnsw_indices").select("index_data").eq("index_name", name).execute().data
+                if not rows:
+                    raise ValueError(f"Snapshot of '{index_name}' is missing shard row '{name}'")
+                return base64.b64decode(rows[0]["index_data"])
+            shards = _parallel(fetch, list(range(row["shards"])))
+        codebook_rows = (self.client.table("hnsw_indices").select("index_data")
+                         .eq("index_name", self._codebook_name(index_name)).execute().data)
+        return Snapshot(
+            base64.b64decode(row["index_data"]) if shards is None else None,
+            ChunkStore.from_payload(row.get("mapping_data")),
+            log_seq=row.get("log_seq") or 0,
+            max_elements=row.get("max_elements"),
+            ef_construction=row.get("ef_construction"),
+            m_parameter=row.get("m_parameter"),
+            shards=shards,
+            codebook=base64.b64decode(codebook_rows[0]["index_data"]) if codebook_rows else None
+        )
+
+    def save_snapshot(self, index_name: str, snapshot: Snapshot):
+        if snapshot.shards is not None:
+            # Shard rows first: the main row's log_seq publishes the snapshot
+            changed = sorted(snapshot.changed_shards if snapshot.changed_shards is not None else range(len(snapshot.shards)))
+            _parallel(lambda shard: self._upsert_row({
+                "index_name": self._shard_name(index_name, shard),
+                "index_data": base64.b64encode(snapshot.shards[shard]).decode("utf-8"),
+                "mapping_data": {},
+                "log_seq": snapshot.log_seq
+            }), changed)
+            print(f"Uploaded {len(changed)} of {len(snapshot.shards)} shards of index '{index_name}'")
+        if snapshot.codebook is not None:
+            self._upsert_row({
+                "index_name": self._codebook_name(index_name),
+                "index_data": base64.b64encode(snapshot.codebook).decode("utf-8"),
+                "mapping_data": {},
+                "log_seq": snapshot.log_seq
+            })
+        data = {
+            "index_name": index_name,
+            "index_data": base64.b64encode(snapshot.index_data).decode("utf-8") if snapshot.shards is None else "",
+            "mapping_data": snapshot.chunks.to_payload(),
+            **snapshot.params()
+        }
+        print(f"Writing snapshot of index '{index_name}' at seq {snapshot.log_seq}")
+        self._upsert_row(data)
+
+    def append(self, index_name: str, records: List[Dict[str, Any]]):
+        rows = [{
+            "index_name": index_name,
+            "seq": r["seq"],
+            "op": r["op"],
+            "label": r["label"],
+            "entry": r.get("entry"),
+            "vector": r.get("vector")
+        } for r in records]
+        for i in range(0, len(rows), LOG_BATCH):
+            # Upsert: a retried append reuses the sequence numbers of a partial one
+            self.client.table("hnsw_index_log").upsert(rows[i:i + LOG_BATCH], on_conflict="index_name,seq").execute()
+
+    def read_log(self, index_name: str, after_seq: int) -> Iterator[Dict[str, Any]]:
+        while True:
+            response = (self.client.table("hnsw_index_log").select("seq,op,label,entry,vector")
+                        .eq("index_name", index_name).gt("seq", after_seq)
+                        .order("seq").limit(LOG_BATCH).execute())
+            rows = response.data or []
+            yield from rows
+            if len(rows) < LOG_BATCH:
+                return
+            after_seq = rows[-1]["seq"]
+
+    def truncate_log(self, index_name: str, upto_seq: int):
+        self.client.table("hnsw_index_log").delete().eq("index_name", index_name).lte("seq", upto_seq).execute()
+
+
+def make_index_store(client) -> Optional[Any]:
+    """
+    Return the configured persistence backend.
+
+    Returns:
+        A LocalIndexStore when KB_PERSISTENCE=local, a SupabaseIndexStore for a
+        real client, or None when the client is a dummy/mock
+    """
+    if PERSISTENCE_BACKEND == "local":
+        return LocalIndexStore()
+    if client is None or "Mock" in type(client).__name__ or "Dummy" in type(client).__name__:
+        return None
+    return SupabaseIndexStore(client)
+
+
+def make_snapshot_cache(store) -> Optional[LocalIndexStore]:
+    """Return a local snapshot cache for a remote store, or None if the store is local or caching is off."""
+    if not SNAPSHOT_CACHE_ENABLED or store is None or isinstance(store, LocalIndexStore):
+        return None
+    return LocalIndexStore(SNAPSHOT_CACHE_DIR)
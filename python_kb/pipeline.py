@@ -0,0 +1,409 @@
+"""
+Pipelined asyncio ingestion: extract -> prepare -> contextualize -> embed -> index -> persist.
+
+Stages are connected by bounded queues and each has its own concurrency, so
+backpressure flows from the slowest stage back to extraction. CPU-bound
+extraction, LLM contextualization and embedding requests overlap instead of
+running one after another. Files stream through in parts of chunks and a
+file becomes searchable as a whole: its new, changed and removed chunks are
+published together once its last chunk is indexed, at the end of the index
+batch that completes it. The index is persisted once at the end.
+
+Index bookkeeping (labels, manifest, chunk store, deduplication) runs in
+worker threads under the indexer's write lock, which deletes, clears, loads
+and other pipeline runs take too, so it is never mutated concurrently; the
+hnswlib inserts run outside it, under the index lock only. API calls are
+submitted to the indexer's WorkScheduler as bulk work of this run's job;
+embedding requests go through the shared EmbeddingBatcher, whose in-flight
+limit holds across concurrent runs.
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from embedding_batcher import estimate_tokens
+from manifest import FilePlan
+from scheduler import BULK
+from supavec import generate_contextual_embeddings_batch, store_embeddings, CONTEXT_BATCH_SIZE
+
+CONTEXT_WORKERS = int(os.getenv("KB_CONTEXT_WORKERS", "8"))  # concurrent batched context requests
+FILE_QUEUE_SIZE = 4      # extracted parts of files waiting to be prepared
+CHUNK_QUEUE_SIZE = 256   # chunks waiting between stages
+BATCH_LINGER = 0.05      # seconds the packer waits for more chunks before sending a partial batch
+
+_DONE = object()
+_run_ids = itertools.count(1)
+
+
+def run_coroutine_sync(coro):
+    """Run a coroutine to completion from synchronous code, even inside a running loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+class FileJob:
+    """Indexing state of one file while its chunks move through the pipeline."""
+
+    def __init__(self, file_path: str, content_hash: Optional[str], plan: FilePlan, metadata: Dict[str, Any]):
+        self.file_path = file_path
+        self.content_hash = content_hash        # hash of the file's contents, keys the context cache
+        self.file_hash: Optional[str] = None    # hash recorded in the manifest, None for a partial file
+        self.plan = plan
+        self.metadata = metadata
+        self.chunks: List[str] = []             # chunk texts received so far, in document order
+        self.chunk_metadata: List[Dict[str, Any]] = []
+        self.chunk_hashes: List[str] = []
+        self.kept: Dict[int, int] = {}          # position -> existing label
+        self.stale: List[int] = []              # labels to retire
+        self.labels: Dict[int, int] = {}        # position -> new label
+        self.own: set = set()                   # the new labels
+        self.duplicate_of: Dict[int, int] = {}  # new label -> label owning the shared vector
+        self.to_embed: List[Tuple[int, int]] = []
+        self.registered: List[int] = []         # labels added to the deduplicator
+        self.indexed: set = set()
+        self.remaining = 0                      # chunks waiting for their vector
+        self.complete = False                   # the file's last chunk has arrived
+        self.finished = False                   # finalized or aborted
+
+    def seal(self, file_hash: Optional[str]):
+        """Record that all chunks have arrived; chunks of the old version left unmatched become stale."""
+        self.file_hash = file_hash
+        self.stale = self.plan.stale()
+        self.complete = True
+
+
+class ChunkItem:
+    """One chunk travelling through the contextualize/embed/index stages."""
+    __slots__ = ("job", "pos", "label", "text", "contextual", "ok", "vector")
+
+    def __init__(self, job: FileJob, pos: int, label: int):
+        self.job = job
+        self.pos = pos
+        self.label = label
+        self.text = job.chunks[pos]
+        self.contextual = self.text
+        self.ok = False
+        self.vector = None
+
+
+class StageStats:
+    def __init__(self, name: str, workers: int):
+        """Counters for one pipeline stage."""
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.errors = 0
+        self.max_queue = 0
+
+    def record(self, items: int, seconds: float):
+        self.items += items
+        self.batches += 1
+        self.busy += seconds
+
+    def observe_queue(self, queue: asyncio.Queue):
+        self.max_queue = max(self.max_queue, queue.qsize())
+
+    def snapshot(self, wall: float) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "items": self.items,
+            "batches": self.batches,
+            "busy_seconds": round(self.busy, 3),
+            "items_per_sec": round(self.items / wall, 2) if wall > 0 else 0.0,
+            "utilization": round(self.busy / (wall * self.workers), 3) if wall > 0 else 0.0,
+            "errors": self.errors,
+            "max_queue_depth": self.max_queue
+        }
+
+
+class IngestionPipeline:
+    def __init__(self, indexer, context_workers: int = CONTEXT_WORKERS, embed_workers: Optional[int] = None):
+        """
+        Initialize a pipeline for one ingestion run.
+
+        Args:
+            indexer: DocumentIndexer that receives the chunks
+            context_workers: Contextual generation requests this run keeps queued or in flight
+            embed_workers: Embedding requests this run keeps queued or in flight (default: the batcher's max_in_flight)
+        """
+        self.indexer = indexer
+        self.scheduler = indexer.scheduler
+        self.job = f"{indexer.index_name}:ingest-{next(_run_ids)}"
+        self.context_workers = context_workers
+        self.embed_workers = embed_workers or indexer.embedder.max_in_flight
+        self.max_instances = indexer.embedder.max_instances
+        self.max_tokens = indexer.embedder.max_tokens
+        self.stages = {
+            "extract": StageStats("extract", 1),
+            "prepare": StageStats("prepare", 1),
+            "contextualize": StageStats("contextualize", self.context_workers),
+            "embed": StageStats("embed", self.embed_workers),
+            "index": StageStats("index", 1),
+            "persist": StageStats("persist", 1),
+        }
+        self.results: List[Dict[str, Any]] = []
+        self._started = None
+        self._finished = None
+
+    def stats(self) -> Dict[str, Any]:
+        """Per-stage throughput of the current or last run."""
+        if self._started is None:
+            return {}
+        wall = (self._finished or time.monotonic()) - self._started
+        return {
+            "wall_seconds": round(wall, 3),
+            "files": len(self.results),
+            "stages": {name: stage.snapshot(wall) for name, stage in self.stages.items()}
+        }
+
+    async def run(self, source: Iterator[Tuple[str, Optional[str], Optional[List[Dict[str, Any]]], bool]],
+                  metadata_for: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Ingest files from a source iterator.
+
+        Args:
+            source: Blocking iterator of (file_path, file_hash, chunk_records, last)
+                parts, consumed in a background thread. A file's parts come in
+                document order, possibly interleaved with other files; its
+                first part's hash keys the context cache and its last part's
+                hash is recorded in the manifest (None for a partial file).
+                A last part whose records are None drops the file.
+            metadata_for: Returns the shared metadata for a file
+
+        Returns:
+            Dict with per-file "files" results and pipeline "stats"
+        """
+        loop = asyncio.get_running_loop()
+        self._started = time.monotonic()
+        files_q = asyncio.Queue(FILE_QUEUE_SIZE)
+        chunks_q = asyncio.Queue(max(1, CHUNK_QUEUE_SIZE // CONTEXT_BATCH_SIZE))
+        contextual_q = asyncio.Queue(CHUNK_QUEUE_SIZE)
+        batches_q = asyncio.Queue(self.embed_workers * 2)
+        embedded_q = asyncio.Queue(self.embed_workers * 2)
+        stop = threading.Event()
+        jobs: List[FileJob] = []
+        open_jobs: Dict[str, FileJob] = {}  # files with parts still to come
+
+        def produce():
+            # Runs in a thread: pull files from the blocking source and hand them to the loop
+            stats = self.stages["extract"]
+            try:
+                started = time.monotonic()
+                for item in source:
+                    stats.record(1, time.monotonic() - started)
+                    future = asyncio.run_coroutine_threadsafe(files_q.put(item), loop)
+                    while True:
+                        try:
+                            future.result(timeout=0.5)
+                            break
+                        except concurrent.futures.TimeoutError:
+                            if stop.is_set():
+                                future.cancel()
+                                return
+                    if stop.is_set():
+                        return
+                    started = time.monotonic()
+            finally:
+                close = getattr(source, "close", None)
+                if close:
+                    close()
+                if not stop.is_set():
+                    asyncio.run_coroutine_threadsafe(files_q.put(_DONE), loop)
+
+        def prepare_part(file_path: str, file_hash: Optional[str], records: Optional[List[Dict[str, Any]]],
+                         last: bool) -> Tuple[Optional[FileJob], List[Tuple[int, int]]]:
+            # Runs in a worker thread, under the indexer's write lock
+            with self.indexer._write_lock:
+                job = open_jobs.get(file_path)
+                if records is None:
+                    # Extraction failed; drop what earlier parts of the file added
+                    if job is not None:
+                        del open_jobs[file_path]
+                        self.indexer._abort_file(job, discard=True)
+                    self.results.append({"file_path": file_path, "error": "extraction failed", "success": False})
+                    return None, []
+                if job is None:
+                    job = open_jobs[file_path] = self.indexer._prepare_file(file_path, file_hash, metadata_for(file_path))
+                    jobs.append(job)
+                to_embed = self.indexer._add_chunks(job, records)
+                if last:
+                    del open_jobs[file_path]
+                    job.seal(file_hash)
+                    if not job.remaining:
+                        self.results.append(self.indexer._finalize_file(job))
+                return job, to_embed
+
+        async def prepare():
+            stats = self.stages["prepare"]
+            while True:
+                item = await files_q.get()
+                if item is _DONE:
+                    break
+                started = time.monotonic()
+                job, to_embed = await asyncio.to_thread(prepare_part, *item)
+                stats.record(1 if item[3] else 0, time.monotonic() - started)
+                # Chunks of one part are contextualized together, CONTEXT_BATCH_SIZE per request
+                for i in range(0, len(to_embed), CONTEXT_BATCH_SIZE):
+                    await chunks_q.put([ChunkItem(job, pos, label) for pos, label in to_embed[i:i + CONTEXT_BATCH_SIZE]])
+                    stats.observe_queue(chunks_q)
+            for _ in range(self.context_workers):
+                await chunks_q.put(_DONE)
+
+        async def contextualize():
+            stats = self.stages["contextualize"]
+            while True:
+                group = await chunks_q.get()
+                if group is _DONE:
+                    break
+                started = time.monotonic()
+                job = group[0].job
+                if job.finished:
+                    continue  # the file was dropped
+                try:
+                    contexts = await self.scheduler.run(
+                        generate_contextual_embeddings_batch, None, [item.text for item in group], job.content_hash,
+                        priority=BULK, job=self.job
+                    )
+                except Exception as e:
+                    print(f"Context generation error for chunks of {job.file_path}: {e}")
+                    stats.errors += 1
+                    contexts = [(item.text, False) for item in group]
+                for item, (contextual, ok) in zip(group, contexts):
+                    item.contextual, item.ok = contextual, ok
+                stats.record(len(group), time.monotonic() - started)
+                for item in group:
+                    await contextual_q.put(item)
+                stats.observe_queue(contextual_q)
+            await contextual_q.put(_DONE)
+
+        async def pack():
+            # Group contextualized chunks into requests within the model limits
+            batch, tokens, done = [], 0, 0
+            while done < self.context_workers:
+                try:
+                    item = await asyncio.wait_for(contextual_q.get(), timeout=BATCH_LINGER if batch else None)
+                except asyncio.TimeoutError:
+                    await batches_q.put(batch)
+                    batch, tokens = [], 0
+                    continue
+                if item is _DONE:
+                    done += 1
+                    continue
+                cost = estimate_tokens(item.contextual)
+                if batch and (len(batch) >= self.max_instances or tokens + cost > self.max_tokens):
+                    await batches_q.put(batch)
+                    batch, tokens = [], 0
+                batch.append(item)
+                tokens += cost
+            if batch:
+                await batches_q.put(batch)
+            for _ in range(self.embed_workers):
+                await batches_q.put(_DONE)
+
+        async def embed():
+            stats = self.stages["embed"]
+            while True:
+                batch = await batches_q.get()
+                if batch is _DONE:
+                    break
+                started = time.monotonic()
+                vectors = await self.indexer.embedder.embed_async(
+                    [item.contextual for item in batch], store_in_db=False, priority=BULK, job=self.job
+                )
+                for item, vector in zip(batch, vectors):
+                    item.vector = vector
+                stats.record(len(batch), time.monotonic() - started)
+                await embedded_q.put(batch)
+                stats.observe_queue(embedded_q)
+                # Mirror the vectors into the Supabase embeddings table, grouped by file
+                by_file: Dict[int, List[ChunkItem]] = {}
+                for item in batch:
+                    by_file.setdefault(id(item.job), []).append(item)
+                for items in by_file.values():
+                    job = items[0].job
+                    await self.scheduler.run(
+                        store_embeddings,
+                        [item.contextual for item in items],
+                        [item.vector for item in items],
+                        metadata=job.metadata,
+                        source_file=job.file_path,
+                        chunk_indices=[item.pos for item in items],
+                        total_chunks=len(job.chunks) if job.complete else None,
+                        priority=BULK,
+                        job=self.job
+                    )
+            await embedded_q.put(_DONE)
+
+        def index_batch(batch: List[ChunkItem]):
+            # Runs in a worker thread; the graph insert holds only the index lock
+            with self.indexer._write_lock:
+                batch = [item for item in batch if not item.job.finished]
+            self.indexer._add_vectors([i.vector for i in batch], [i.label for i in batch])
+            with self.indexer._write_lock:
+                self.indexer._discard_vectors([item.label for item in batch if item.job.finished])
+                finalized = 0
+                for item in batch:
+                    job = item.job
+                    if job.finished:
+                        continue  # dropped while its vectors were being added
+                    self.indexer._register_chunk(job, item.pos, item.label, item.contextual, item.ok)
+                    if job.complete and job.remaining == 0:
+                        self.results.append(self.indexer._finalize_file(job, publish=False))
+                        finalized += 1
+                if finalized:
+                    self.indexer._publish()  # the files completed by this batch show up together
+
+        async def index():
+            stats = self.stages["index"]
+            done = 0
+            while done < self.embed_workers:
+                batch = await embedded_q.get()
+                if batch is _DONE:
+                    done += 1
+                    continue
+                started = time.monotonic()
+                await asyncio.to_thread(index_batch, batch)
+                stats.record(len(batch), time.monotonic() - started)
+
+        producer = loop.run_in_executor(None, produce)
+        tasks = [asyncio.ensure_future(c) for c in (
+            [prepare(), pack(), index()]
+            + [contextualize() for _ in range(self.context_workers)]
+            + [embed() for _ in range(self.embed_workers)]
+        )]
+        try:
+            await asyncio.gather(*tasks)
+            await producer
+        except BaseException:
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # A bookkeeping thread may still be running; it skips jobs aborted here
+            with self.indexer._write_lock:
+                for job in jobs:
+                    if not job.finished:
+                        self.indexer._abort_file(job)
+            raise
+        finally:
+            stop.set()
+
+        started = time.monotonic()
+        await asyncio.to_thread(self.indexer._persist)
+        self.stages["persist"].record(1, time.monotonic() - started)
+        self._finished = time.monotonic()
+        stats = self.stats()
+        print(f"Ingested {len(self.results)} files in {stats['wall_seconds']}s: " + ", ".join(
+            f"{name} {s['items_per_sec']}/s" for name, s in stats["stages"].items() if name in ("contextualize", "embed", "index")
+        ))
+        return {"files": self.results, "stats": stats}
@@ -0,0 +1,441 @@
+"""
+Compressed vector tier: int8 scalar or product quantization with exact re-ranking.
+
+The tier keeps one compact code per vector in memory and the full-precision
+(normalized float32) vectors in a file on disk that is memory-mapped. A search
+scans the codes to score every vector approximately, keeps the best
+``k * RERANK_FACTOR`` candidates and re-ranks them by exact cosine similarity
+against the mapped vectors, so only a few rows of the file are read per query.
+
+Two quantizers are available, both trained on a sample of the corpus and
+saved with the tier:
+
+- "sq8": per-dimension int8 scalar quantization (dimension bytes per vector)
+- "pq": product quantization with 256 centroids per subspace
+  (PQ_SUBSPACES bytes per vector), scored with lookup tables
+
+For comparison an HNSW slot with the default M=64 and 768 dimensions takes
+about 3.6 KB. See bench_quantization.py for recall and latency figures.
+
+The tier is experimental and off by default (KB_VECTOR_TIER unset). It is
+kept next to the float32 HNSW graph rather than replacing it, so enabling it
+adds memory instead of saving it, and its flat scan is several times slower
+than a graph search at a few thousand vectors already. Use it to measure
+what compression would cost in recall, not to serve searches. The codebook
+is persisted with the index snapshot (see ``codebook``), so every replica
+encodes vectors the same way; codes and vectors are rebuilt locally from it.
+"""
+import io
+import json
+import os
+import shutil
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from disk_cache import DEFAULT_CACHE_DIR
+
+# "" (disabled), "sq8" or "pq"
+VECTOR_TIER = os.getenv("KB_VECTOR_TIER", "")
+VECTOR_TIER_DIR = os.getenv("KB_VECTOR_TIER_DIR", os.path.join(DEFAULT_CACHE_DIR, "vector_tier"))
+PQ_SUBSPACES = int(os.getenv("KB_PQ_SUBSPACES", "96"))
+PQ_CENTROIDS = 256
+TRAIN_MIN = int(os.getenv("KB_QUANT_TRAIN_MIN", "1000"))        # vectors needed before training
+TRAIN_SAMPLE = int(os.getenv("KB_QUANT_TRAIN_SAMPLE", "20000"))  # vectors used for training
+RERANK_FACTOR = int(os.getenv("KB_RERANK_FACTOR", "10"))        # candidates re-ranked per result
+KMEANS_ITERATIONS = 15
+SCAN_BLOCK = 16384  # codes scored per step
+TIER_FORMAT = 1
+
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class ScalarQuantizer:
+    kind = "sq8"
+
+    def __init__(self, low: Optional[np.ndarray] = None, scale: Optional[np.ndarray] = None):
+        self.low = low
+        self.scale = scale
+
+    @property
+    def code_size(self) -> int:
+        return len(self.low)
+
+    def train(self, vectors: np.ndarray):
+        """Fit each dimension's range, clipping the outer 0.1% so outliers do not waste resolution."""
+        self.low = np.quantile(vectors, 0.001, axis=0).astype(np.float32)
+        high = np.quantile(vectors, 0.999, axis=0).astype(np.float32)
+        self.scale = np.maximum(high - self.low, 1e-6) / 255
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint((vectors - self.low) / self.scale), 0, 255).astype(np.uint8)
+
+    def scorer(self, query: np.ndarray):
+        """Return a function giving approximate inner products of ``query`` with a block of codes."""
+        weights = (query * self.scale).astype(np.float32)
+        offset = float(query @ self.low)
+        return lambda codes: codes.astype(np.float32) @ weights + offset
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"low": self.low, "scale": self.scale}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "ScalarQuantizer":
+        return cls(arrays["low"], arrays["scale"])
+
+
+class ProductQuantizer:
+    kind = "pq"
+
+    def __init__(self, centroids: Optional[np.ndarray] = None, subspaces: int = PQ_SUBSPACES):
+        self.centroids = centroids  # (subspaces, PQ_CENTROIDS, sub_dim)
+        self.subspaces = subspaces if centroids is None else len(centroids)
+
+    @property
+    def code_size(self) -> int:
+        return self.subspaces
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """View vectors as (n, subspaces, sub_dim)."""
+        return vectors.reshape(len(vectors), self.subspaces, -1)
+
+    def train(self, vectors: np.ndarray, seed: int = 0):
+        """Run k-means in every subspace."""
+        if vectors.shape[1] % self.subspaces:
+            raise ValueError(f"Dimension {vectors.shape[1]} is not divisible into {self.subspaces} subspaces")
+        rng = np.random.default_rng(seed)
+        parts = self._split(vectors)
+        k = min(PQ_CENTROIDS, len(vectors))
+        centroids = np.zeros((self.subspaces, PQ_CENTROIDS, parts.shape[2]), dtype=np.float32)
+        for j in range(self.subspaces):
+            x = np.ascontiguousarray(parts[:, j])
+            c = x[rng.choice(len(x), k, replace=False)].copy()
+            for _ in range(KMEANS_ITERATIONS):
+                assign = self._nearest(x, c)
+                sums = np.zeros_like(c)
+                np.add.at(sums, assign, x)
+                counts = np.bincount(assign, minlength=k)
+                empty = counts == 0
+                c[~empty] = sums[~empty] / counts[~empty, None]
+                if empty.any():  # restart empty clusters on random points
+                    c[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+            centroids[j, :k] = c
+            centroids[j, k:] = c[0]
+        self.centroids = centroids
+
+    @staticmethod
+    def _nearest(x: np.ndarray, c: np.ndarray) -> np.ndarray:
+        return ((c * c).sum(1) - 2 * x @ c.T).argmin(1)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        parts = self._split(vectors)
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for j in range(self.subspaces):
+            codes[:, j] = self._nearest(np.ascontiguousarray(parts[:, j]), self.centroids[j])
+        return codes
+
+    def scorer(self, query: np.ndarray):
+        """Return a function giving approximate inner products via per-subspace lookup tables."""
+        tables = np.einsum("mkd,md->mk", self.centroids, self._split(query[None])[0]).astype(np.float32)
+
+        def score(codes: np.ndarray) -> np.ndarray:
+            # One table lookup per subspace column is ~3x faster than a single fancy-indexed gather
+            scores = np.zeros(len(codes), dtype=np.float32)
+            for j in range(self.subspaces):
+                scores += tables[j].take(codes[:, j])
+            return scores
+        return score
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return {"centroids": self.centroids}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray]) -> "ProductQuantizer":
+        return cls(arrays["centroids"])
+
+
+QUANTIZERS = {"sq8": ScalarQuantizer, "pq": ProductQuantizer}
+
+
+class VectorTier:
+    def __init__(self, directory: str, dimension: int, kind: str = "sq8"):
+        """
+        Initialize an empty tier; call ``train`` before adding vectors.
+
+        Args:
+            directory: Where codes, the codebook and the full-precision vectors are kept
+            dimension: Vector dimension
+            kind: "sq8" or "pq"
+        """
+        if kind not in QUANTIZERS:
+            raise ValueError(f"Unknown vector tier '{kind}', expected one of {sorted(QUANTIZERS)}")
+        self.directory = directory
+        self.dimension = dimension
+        self.kind = kind
+        self.quantizer = None
+        self._lock = threading.RLock()
+        self._n = 0
+        self._live = 0
+        self._codes = np.empty((0, 0), dtype=np.uint8)
+        self._labels = np.empty(0, dtype=np.int64)
+        self._alive = np.empty(0, dtype=bool)
+        self._row_of_label: Dict[int, int] = {}
+        self._vectors = None  # memmap of vectors.f32, reopened when the file grows
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def _vectors_path(self) -> str:
+        return os.path.join(self.directory, "vectors.f32")
+
+    @property
+    def trained(self) -> bool:
+        return self.quantizer is not None
+
+    def __len__(self) -> int:
+        return self._live
+
+    def labels(self) -> set:
+        return set(self._row_of_label)
+
+    def train(self, vectors):
+        """Train the quantizer on a sample of the corpus; drops any vectors already added."""
+        with self._lock:
+            quantizer = QUANTIZERS[self.kind]()
+            quantizer.train(normalize(vectors))
+            self._reset(quantizer)
+
+    def _reset(self, quantizer):
+        """Start over empty with ``quantizer``; the caller holds the lock."""
+        self.quantizer = quantizer
+        self._n = self._live = 0
+        self._codes = np.empty((0, quantizer.code_size), dtype=np.uint8)
+        self._labels = np.empty(0, dtype=np.int64)
+        self._alive = np.empty(0, dtype=bool)
+        self._row_of_label = {}
+        self._vectors = None
+        open(self._vectors_path, "wb").close()
+
+    def codebook(self) -> Optional[bytes]:
+        """The trained quantizer, serialized for the index snapshot; None before training."""
+        with self._lock:
+            if not self.trained:
+                return None
+            buffer = io.BytesIO()
+            arrays = {f"q_{name}": array for name, array in self.quantizer.to_arrays().items()}
+            np.savez(buffer, kind=np.array(self.kind), **arrays)
+            return buffer.getvalue()
+
+    def use_codebook(self, codebook: bytes) -> bool:
+        """
+        Encode with a codebook saved by ``codebook`` (e.g. loaded with a snapshot).
+
+        Vectors encoded with another codebook are dropped and have to be added
+        again; nothing changes if the codebook is already in use.
+
+        Returns:
+            False if the codebook is for another kind of quantizer
+        """
+        with np.load(io.BytesIO(codebook)) as archive:
+            kind = str(archive["kind"])
+            arrays = {name[2:]: archive[name] for name in archive.files if name.startswith("q_")}
+        if kind != self.kind:
+            return False
+        with self._lock:
+            if self.trained:
+                current = self.quantizer.to_arrays()
+                if current.keys() == arrays.keys() and all(np.array_equal(current[k], arrays[k]) for k in arrays):
+                    return True
+            self._reset(QUANTIZERS[kind].from_arrays(arrays))
+        return True
+
+    def _grow(self, needed: int):
+        capacity = len(self._labels)
+        if needed <= capacity:
+            return
+        capacity = max(needed, capacity * 2, 1024)
+        codes = np.empty((capacity, self.quantizer.code_size), dtype=np.uint8)
+        codes[:self._n] = self._codes[:self._n]
+        labels = np.empty(capacity, dtype=np.int64)
+        labels[:self._n] = self._labels[:self._n]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self._n] = self._alive[:self._n]
+        self._codes, self._labels, self._alive = codes, labels, alive
+
+    def add(self, labels: List[int], vectors):
+        """Encode vectors and append their full-precision copies to the vector file."""
+        if not len(labels):
+            return
+        vectors = normalize(vectors)
+        with self._lock:
+            codes = self.quantizer.encode(vectors)
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            start = self._n
+            self._grow(start + len(labels))
+            self._codes[start:start + len(labels)] = codes
+            self._labels[start:start + len(labels)] = labels
+            self._alive[start:start + len(labels)] = True
+            for row, label in enumerate(labels, start):
+                old = self._row_of_label.get(int(label))
+                if old is not None:
+                    self._alive[old] = False
+                    self._live -= 1
+                self._row_of_label[int(label)] = row
+            self._n += len(labels)
+            self._live += len(labels)
+            self._vectors = None
+
+    def remove(self, labels: List[int]):
+        with self._lock:
+            for label in labels:
+                row = self._row_of_label.pop(int(label), None)
+                if row is not None:
+                    self._alive[row] = False
+                    self._live -= 1
+
+    def needs_compaction(self) -> bool:
+        dead = self._n - self._live
+        return dead > 1024 and dead > self._live
+
+    def compact(self):
+        """Rewrite the vector file and codes without removed rows."""
+        with self._lock:
+            rows = np.flatnonzero(self._alive[:self._n])
+            vectors = self._mapped()
+            tmp = self._vectors_path + ".tmp"
+            with open(tmp, "wb") as f:
+                for i in range(0, len(rows), SCAN_BLOCK):
+                    f.write(np.ascontiguousarray(vectors[rows[i:i + SCAN_BLOCK]]).tobytes())
+            os.replace(tmp, self._vectors_path)
+            self._codes = self._codes[rows].copy()
+            self._labels = self._labels[rows].copy()
+            self._alive = np.ones(len(rows), dtype=bool)
+            self._n = self._live = len(rows)
+            self._row_of_label = {int(label): row for row, label in enumerate(self._labels.tolist())}
+            self._vectors = None
+
+    def _mapped(self) -> np.ndarray:
+        if self._vectors is None or len(self._vectors) < self._n:
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                      shape=(self._n, self.dimension)) if self._n else np.empty((0, self.dimension), np.float32)
+        return self._vectors
+
+    def search(self, query, k: int, rerank: Optional[int] = None,
+               allowed: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the ``k`` most similar vectors.
+
+        Args:
+            query: Query vector
+            k: Number of results
+            rerank: Candidates re-ranked exactly (default k * RERANK_FACTOR; 0 returns approximate scores)
+            allowed: Boolean bitmap indexed by label; only labels set in it are returned
+
+        Returns:
+            (labels, cosine similarities), best first
+        """
+        with self._lock:
+            n, codes, labels, alive = self._n, self._codes, self._labels, self._alive
+            vectors = self._mapped()
+            quantizer = self.quantizer
+        q = normalize(query)[0]
+        k = min(k, self._live)
+        if allowed is not None:
+            row_labels = labels[:n]
+            inside = row_labels < len(allowed)
+            alive = alive[:n] & inside  # a copy: the tier's own flags stay untouched
+            alive[inside] &= allowed[row_labels[inside]]
+            k = min(k, int(alive.sum()))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        pool = k if rerank == 0 else min(n, max(k, rerank if rerank is not None else k * RERANK_FACTOR))
+        score = quantizer.scorer(q)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, n, SCAN_BLOCK):
+            block = score(codes[start:start + SCAN_BLOCK][:n - start])
+            block[~alive[start:start + len(block)]] = -np.inf
+            rows = np.arange(start, start + len(block))
+            if len(block) > pool:
+                top = np.argpartition(-block, pool)[:pool]
+                rows, block = rows[top], block[top]
+            best_rows = np.concatenate([best_rows, rows])
+            best_scores = np.concatenate([best_scores, block])
+            if len(best_scores) > pool:
+                top = np.argpartition(-best_scores, pool)[:pool]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+        keep = np.isfinite(best_scores)
+        best_rows, best_scores = best_rows[keep], best_scores[keep]
+        if rerank != 0:
+            order = np.sort(best_rows)  # sequential reads from the mapped file
+            best_scores = vectors[order] @ q
+            best_rows = order
+        top = np.argsort(-best_scores)[:k]
+        return labels[best_rows[top]], best_scores[top].astype(np.float32)
+
+    def stats(self) -> Dict[str, Any]:
+        code_size = self.quantizer.code_size if self.quantizer is not None else 0
+        return {
+            "kind": self.kind,
+            "trained": self.trained,
+            "vectors": self._live,
+            "dead_rows": self._n - self._live,
+            "code_bytes": self._live * code_size,
+            "bytes_per_vector": code_size + 8 + 1,
+            "full_precision_bytes_on_disk": self._n * self.dimension * 4
+        }
+
+    def save(self):
+        """Write codes, labels and the codebook next to the vector file."""
+        with self._lock:
+            if not self.trained:
+                return
+            tmp = os.path.join(self.directory, "tier.tmp.npz")
+            np.savez(tmp, codes=self._codes[:self._n], labels=self._labels[:self._n], alive=self._alive[:self._n],
+                     **{f"q_{name}": array for name, array in self.quantizer.to_arrays().items()})
+            os.replace(tmp, os.path.join(self.directory, "tier.npz"))
+            with open(os.path.join(self.directory, "tier.json"), "w", encoding="utf-8") as f:
+                json.dump({"format": TIER_FORMAT, "kind": self.kind, "dimension": self.dimension, "rows": self._n}, f)
+
+    @classmethod
+    def load(cls, directory: str, dimension: int, kind: str) -> "VectorTier":
+        """Open a saved tier, or return an empty one if it is missing, of another kind or inconsistent."""
+        tier = cls(directory, dimension, kind)
+        try:
+            with open(os.path.join(directory, "tier.json"), encoding="utf-8") as f:
+                info = json.load(f)
+            if (info.get("format"), info.get("kind"), info.get("dimension")) != (TIER_FORMAT, kind, dimension):
+                return tier
+            expected = info["rows"] * dimension * 4
+            size = os.path.getsize(tier._vectors_path)
+            if size < expected:
+                print(f"⚠️ Vector tier in {directory} is incomplete, rebuilding")
+                return tier
+            if size > expected:
+                os.truncate(tier._vectors_path, expected)  # rows appended after the last save
+            with np.load(os.path.join(directory, "tier.npz")) as archive:
+                arrays = {name: archive[name] for name in archive.files}
+        except (FileNotFoundError, KeyError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"⚠️ Could not load vector tier from {directory}: {e}")
+            return tier
+        tier.quantizer = QUANTIZERS[kind].from_arrays({k[2:]: v for k, v in arrays.items() if k.startswith("q_")})
+        tier._codes, tier._labels, tier._alive = arrays["codes"], arrays["labels"], arrays["alive"]
+        tier._n = len(tier._labels)
+        tier._live = int(tier._alive.sum())
+        tier._row_of_label = {int(label): row for row, label in enumerate(tier._labels.tolist()) if tier._alive[row]}
+        return tier
+
+    def clear(self):
+        with self._lock:
+            self.quantizer = None
+            self._n = self._live = 0
+            self._row_of_label = {}
+            self._vectors = None
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
@@ -0,0 +1,302 @@
+"""
+Adaptive rate limiting for upstream API calls.
+
+Each upstream (the embedding model, each generation model) gets its own
+limiter with a requests-per-minute and a tokens-per-minute token bucket.
+Limiters are thread-safe and can also be awaited from asyncio code. The
+allowed rate follows AIMD: it is halved when the upstream answers with
+429 / "Quota exceeded" and grows back additively while calls succeed.
+A throttled call is retried after an exponential, jittered backoff that
+honours the upstream's Retry-After hint, so a throttle lasting longer than
+the buckets take to refill does not use up the attempts at once.
+
+Calls made inside ``urgent()`` (interactive query embedding) do not queue
+behind the reservations of bulk calls already waiting: they wait only for
+their own cost, and the waiting calls' debt grows by that much instead.
+"""
+import asyncio
+import contextlib
+import os
+import random
+import re
+import threading
+import time
+from typing import Callable, Dict, Any, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Default quotas per kind of upstream; override with KB_RATE_<KIND>_RPM / KB_RATE_<KIND>_TPM
+DEFAULT_LIMITS = {
+    "embedding": {"rpm": 600, "tpm": 1_000_000},
+    "generation": {"rpm": 1000, "tpm": 4_000_000},
+}
+
+MIN_FRACTION = 0.05       # never throttle below 5% of the configured quota
+DECREASE_FACTOR = 0.5     # multiplicative decrease on 429
+INCREASE_STEP = 0.05      # additive increase (fraction of quota) per second of successes
+DECREASE_COOLDOWN = 2.0   # seconds; a burst of 429s from in-flight calls counts once
+MAX_ATTEMPTS = 5
+BACKOFF_MIN = 4.0         # seconds before the first retry, doubled per attempt
+BACKOFF_MAX = 60.0
+RETRY_DEADLINE = float(os.getenv("KB_RATE_RETRY_DEADLINE", "300"))  # seconds one call may spend retrying
+
+_RETRY_AFTER_RE = re.compile(r"(?:retry[-_ ]?after|retry[-_ ]?delay|retry in)\W{0,4}(\d+(?:\.\d+)?)", re.IGNORECASE)
+
+_limiters: Dict[str, "AdaptiveRateLimiter"] = {}
+_registry_lock = threading.Lock()
+_local = threading.local()
+
+
+def estimate_tokens(text: str) -> int:
+    """Conservative token estimate (about three characters per token)."""
+    return len(text) // 3 + 1
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Whether an exception means the upstream is rate limiting us."""
+    message = str(error)
+    return "429" in message or "Quota exceeded" in message or "RESOURCE_EXHAUSTED" in message
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the upstream asked us to wait before retrying, if it said so."""
+    value = getattr(error, "retry_after", None)
+    if value is None:
+        headers = getattr(getattr(error, "response", None), "headers", None) or {}
+        value = headers.get("Retry-After") if hasattr(headers, "get") else None
+    if value is None:
+        match = _RETRY_AFTER_RE.search(str(error))
+        value = match.group(1) if match else None
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None  # an HTTP date; the exponential backoff applies
+
+
+def backoff_delay(attempt: int, hint: Optional[float] = None) -> float:
+    """
+    Seconds to wait before retrying after the ``attempt``-th throttled call (0-based).
+
+    Exponential from BACKOFF_MIN up to BACKOFF_MAX with jitter in its upper
+    half, so calls throttled together do not retry together; never shorter
+    than the upstream's Retry-After ``hint``.
+    """
+    delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** attempt)
+    return max(hint or 0.0, random.uniform(delay / 2, delay))
+
+
+@contextlib.contextmanager
+def urgent():
+    """Let the limiter calls made by this thread jump the queue of waiting reservations."""
+    previous = getattr(_local, "urgent", False)
+    _local.urgent = True
+    try:
+        yield
+    finally:
+        _local.urgent = previous
+
+
+def is_urgent() -> bool:
+    return getattr(_local, "urgent", False)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        """
+        Initialize a bucket that refills at ``rate`` units per second.
+
+        Reservations may drive the level negative; the caller then waits until
+        the debt is repaid, so concurrent callers are served in arrival order.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float, urgent: bool = False) -> float:
+        """
+        Take ``amount`` units and return how long the caller must wait.
+
+        An ``urgent`` caller is served ahead of the debt of earlier reservations.
+        """
+        self._refill(now)
+        wait = self.wait_for(amount, now, urgent)
+        self.level -= amount
+        return wait
+
+    def wait_for(self, amount: float, now: float, urgent: bool = False) -> float:
+        """How long a reservation of ``amount`` units would wait, without taking them."""
+        level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        if urgent:
+            level = max(level, 0.0)
+        level -= amount
+        return max(0.0, -level / self.rate) if level < 0 else 0.0
+
+    def set_rate(self, rate: float, now: float):
+        self._refill(now)
+        self.rate = rate
+
+    def drain(self, now: float):
+        self._refill(now)
+        self.level = min(self.level, 0.0)
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float):
+        """
+        Initialize a limiter for one upstream.
+
+        Args:
+            name: Upstream name, e.g. "embedding:text-multilingual-embedding-002"
+            requests_per_minute: Configured request quota
+            tokens_per_minute: Configured token quota
+        """
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.fraction = 1.0
+        # One second of burst capacity
+        self._requests = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 60))
+        self._tokens = TokenBucket(tokens_per_minute / 60, max(1.0, tokens_per_minute / 60))
+        self._lock = threading.Lock()
+        self._last_increase = time.monotonic()
+        self._last_decrease = 0.0
+        self._calls = 0
+        self._throttled = 0
+        self._waited = 0.0
+        self._backed_off = 0.0
+        self._urgent = 0
+
+    def _reserve(self, tokens: int) -> float:
+        urgent = is_urgent()
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self._requests.reserve(1, now, urgent), self._tokens.reserve(tokens, now, urgent))
+            self._calls += 1
+            self._urgent += int(urgent)
+            self._waited += wait
+            return wait
+
+    def acquire(self, tokens: int = 1):
+        """Block until a request of ``tokens`` tokens may be sent."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    def expected_wait(self, tokens: int = 1) -> float:
+        """Seconds a request of ``tokens`` tokens would wait if sent now (nothing is reserved)."""
+        urgent = is_urgent()
+        with self._lock:
+            now = time.monotonic()
+            return max(self._requests.wait_for(1, now, urgent), self._tokens.wait_for(tokens, now, urgent))
+
+    async def acquire_async(self, tokens: int = 1):
+        """Wait without blocking the event loop until a request may be sent."""
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _apply_fraction(self, now: float):
+        self._requests.set_rate(self.fraction * self.requests_per_minute / 60, now)
+        self._tokens.set_rate(self.fraction * self.tokens_per_minute / 60, now)
+
+    def on_success(self):
+        """Additively raise the allowed rate, at most once per second."""
+        with self._lock:
+            now = time.monotonic()
+            if self.fraction < 1.0 and now - self._last_increase >= 1.0:
+                steps = (now - self._last_increase) // 1.0
+                self.fraction = min(1.0, self.fraction + INCREASE_STEP * steps)
+                self._last_increase = now
+                self._apply_fraction(now)
+
+    def on_throttle(self):
+        """Multiplicatively lower the allowed rate after a 429."""
+        with self._lock:
+            now = time.monotonic()
+            self._throttled += 1
+            if now - self._last_decrease < DECREASE_COOLDOWN:
+                return
+            self.fraction = max(MIN_FRACTION, self.fraction * DECREASE_FACTOR)
+            self._last_decrease = now
+            self._last_increase = now
+            self._apply_fraction(now)
+            self._requests.drain(now)
+            self._tokens.drain(now)
+            print(f"⚠️ {self.name}: quota exceeded, rate lowered to {self.fraction:.0%} of quota")
+
+    def call(self, fn: Callable[[], T], tokens: int = 1, max_attempts: int = MAX_ATTEMPTS) -> T:
+        """
+        Call ``fn`` under this limiter, retrying when the upstream throttles.
+
+        Non-quota errors are raised immediately. After a quota error the rate
+        is lowered and the call retried after ``backoff_delay``; the quota error
+        is raised once ``max_attempts`` calls have been throttled or the next
+        retry would start more than RETRY_DEADLINE seconds after the first call.
+        """
+        started = time.monotonic()
+        for attempt in range(max_attempts):
+            self.acquire(tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_quota_error(e) or attempt == max_attempts - 1:
+                    raise
+                self.on_throttle()
+                delay = backoff_delay(attempt, retry_after(e))
+                if time.monotonic() - started + delay > RETRY_DEADLINE:
+                    raise
+                with self._lock:
+                    self._backed_off += delay
+                time.sleep(delay)
+                continue
+            self.on_success()
+            return result
+        raise RuntimeError("unreachable")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Return the configured and current rates plus counters."""
+        with self._lock:
+            return {
+                "name": self.name,
+                "configured_rpm": self.requests_per_minute,
+                "configured_tpm": self.tokens_per_minute,
+                "current_rpm": round(self.fraction * self.requests_per_minute, 2),
+                "current_tpm": round(self.fraction * self.tokens_per_minute, 2),
+                "fraction": round(self.fraction, 3),
+                "calls": self._calls,
+                "urgent_calls": self._urgent,
+                "throttled": self._throttled,
+                "seconds_waited": round(self._waited, 3),
+                "seconds_backed_off": round(self._backed_off, 3)
+            }
+
+
+def get_limiter(name: str, requests_per_minute: Optional[float] = None,
+                tokens_per_minute: Optional[float] = None) -> AdaptiveRateLimiter:
+    """
+    Return the shared limiter for an upstream, creating it on first use.
+
+    The upstream kind is the part of the name before ":" and selects the
+    default quota, e.g. "generation:gemini-2.0-flash".
+    """
+    limiter = _limiters.get(name)
+    if limiter is not None:
+        return limiter
+    with _registry_lock:
+        if name not in _limiters:
+            kind = name.split(":", 1)[0]
+            defaults = DEFAULT_LIMITS.get(kind, DEFAULT_LIMITS["generation"])
+            rpm = requests_per_minute or float(os.getenv(f"KB_RATE_{kind.upper()}_RPM", defaults["rpm"]))
+            tpm = tokens_per_minute or float(os.getenv(f"KB_RATE_{kind.upper()}_TPM", defaults["tpm"]))
+            _limiters[name] = AdaptiveRateLimiter(name, rpm, tpm)
+        return _limiters[name]
+
+
+def snapshot_all() -> Dict[str, Dict[str, Any]]:
+    """Return snapshots of every limiter created so far."""
+    return {name: limiter.snapshot() for name, limiter in list(_limiters.items())}
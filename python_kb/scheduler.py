@@ -0,0 +1,199 @@
+"""
+Process-wide work scheduler for blocking upstream calls.
+
+All calls to Gemini and the embedding model from the service go through one
+bounded pool of worker threads instead of per-request thread pools. Work is
+queued by priority class: interactive query embedding first, then answer
+generation, then bulk ingestion. Bulk work may never occupy the last
+``reserved`` workers, so interactive requests find a free thread even while
+large ingestion jobs run, and concurrent ingestion jobs are served round-robin
+so each gets an equal share of the bulk capacity. Interactive work also
+runs ahead of the bulk reservations waiting at the rate limiters.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import os
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Optional
+
+from rate_limiter import urgent
+
+INTERACTIVE = 0  # query embedding for /search and /ask
+ASK = 1          # answer generation for /ask
+BULK = 2         # ingestion: contextualization, embedding, storage
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", ASK: "ask", BULK: "bulk"}
+
+SCHEDULER_WORKERS = int(os.getenv("KB_SCHEDULER_WORKERS", "16"))
+RESERVED_WORKERS = int(os.getenv("KB_SCHEDULER_RESERVED", "4"))  # workers bulk work may not use
+WAIT_SAMPLES = 1000  # recent wait times kept per class for percentiles
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class _Task:
+    __slots__ = ("fn", "args", "kwargs", "future", "priority", "job", "enqueued")
+
+    def __init__(self, fn, args, kwargs, priority, job):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.priority = priority
+        self.job = job
+        self.enqueued = time.monotonic()
+
+
+class _ClassStats:
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.running = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.waits: Deque[float] = collections.deque(maxlen=WAIT_SAMPLES)
+
+    def snapshot(self, queued: int) -> Dict[str, Any]:
+        waits = sorted(self.waits)
+        started = self.completed + self.failed + self.running
+        return {
+            "queued": queued,
+            "running": self.running,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_ms": round(1000 * self.wait_total / started, 2) if started else 0.0,
+            "p95_wait_ms": round(1000 * waits[int(0.95 * (len(waits) - 1))], 2) if waits else 0.0,
+            "max_wait_ms": round(1000 * self.wait_max, 2)
+        }
+
+
+class WorkScheduler:
+    def __init__(self, workers: int = SCHEDULER_WORKERS, reserved: int = RESERVED_WORKERS):
+        """
+        Initialize the scheduler; worker threads start on first submit.
+
+        Args:
+            workers: Total number of worker threads
+            reserved: Workers kept free of bulk work for interactive and ask requests
+        """
+        self.workers = max(1, workers)
+        self.bulk_limit = max(1, self.workers - reserved)
+        self._cond = threading.Condition()
+        self._queues: Dict[int, Deque[_Task]] = {INTERACTIVE: collections.deque(), ASK: collections.deque()}
+        # Bulk work is queued per job and jobs are served round-robin
+        self._bulk_jobs: "collections.OrderedDict[str, Deque[_Task]]" = collections.OrderedDict()
+        self._bulk_queued = 0
+        self._stats = {priority: _ClassStats() for priority in PRIORITY_NAMES}
+        self._threads = []
+
+    def _start(self):
+        for i in range(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name=f"kb-worker-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn: Callable, *args, priority: int = BULK, job: Optional[str] = None, **kwargs) -> concurrent.futures.Future:
+        """
+        Queue ``fn(*args, **kwargs)``.
+
+        Args:
+            fn: Blocking callable
+            priority: INTERACTIVE, ASK or BULK
+            job: Bulk job the work belongs to, for fair sharing between jobs
+
+        Returns:
+            Future with the call's result
+        """
+        task = _Task(fn, args, kwargs, priority, job or "default")
+        with self._cond:
+            if len(self._threads) < self.workers:
+                self._start()
+            if priority == BULK:
+                self._bulk_jobs.setdefault(task.job, collections.deque()).append(task)
+                self._bulk_queued += 1
+            else:
+                self._queues[priority].append(task)
+            self._stats[priority].submitted += 1
+            self._cond.notify()
+        return task.future
+
+    async def run(self, fn: Callable, *args, priority: int = BULK, job: Optional[str] = None, **kwargs):
+        """Await ``fn(*args, **kwargs)`` run by the scheduler."""
+        return await asyncio.wrap_future(self.submit(fn, *args, priority=priority, job=job, **kwargs))
+
+    def _next_task(self) -> Optional[_Task]:
+        """Pop the next runnable task; the caller holds the condition."""
+        for priority in (INTERACTIVE, ASK):
+            if self._queues[priority]:
+                return self._queues[priority].popleft()
+        if self._bulk_jobs and self._stats[BULK].running < self.bulk_limit:
+            job, tasks = next(iter(self._bulk_jobs.items()))
+            task = tasks.popleft()
+            del self._bulk_jobs[job]
+            if tasks:
+                self._bulk_jobs[job] = tasks  # back of the rotation
+            self._bulk_queued -= 1
+            return task
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    self._cond.wait()
+                    task = self._next_task()
+                stats = self._stats[task.priority]
+                wait = time.monotonic() - task.enqueued
+                stats.running += 1
+                stats.wait_total += wait
+                stats.wait_max = max(stats.wait_max, wait)
+                stats.waits.append(wait)
+
+            if task.future.set_running_or_notify_cancel():
+                try:
+                    with urgent() if task.priority == INTERACTIVE else contextlib.nullcontext():
+                        result = task.fn(*task.args, **task.kwargs)
+                    task.future.set_result(result)
+                    failed = False
+                except BaseException as e:
+                    task.future.set_exception(e)
+                    failed = True
+            else:
+                failed = False
+
+            with self._cond:
+                stats.running -= 1
+                if failed:
+                    stats.failed += 1
+                else:
+                    stats.completed += 1
+                if task.priority == BULK:
+                    self._cond.notify()  # a bulk slot was freed
+
+    def stats(self) -> Dict[str, Any]:
+        """Return queue depth, running work and wait times per priority class."""
+        with self._cond:
+            queued = {INTERACTIVE: len(self._queues[INTERACTIVE]), ASK: len(self._queues[ASK]), BULK: self._bulk_queued}
+            return {
+                "workers": self.workers,
+                "bulk_limit": self.bulk_limit,
+                "classes": {PRIORITY_NAMES[p]: s.snapshot(queued[p]) for p, s in self._stats.items()},
+                "bulk_jobs": {job: len(tasks) for job, tasks in self._bulk_jobs.items()}
+            }
+
+
+def get_scheduler() -> WorkScheduler:
+    """Return the process-wide scheduler."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = WorkScheduler()
+    return _scheduler
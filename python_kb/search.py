@@ -0,0 +1,542 @@
+"""
+Search over a published view of an index.
+
+Vector searches pick their strategy from the corpus size: an exact scan of
+one contiguous matrix for small indexes, the HNSW graph (or the trained
+vector tier) beyond that. Filtered searches score the bitmap matches exactly
+or hand the bitmap to the graph as a candidate filter; lexical and hybrid
+searches rank with BM25 and reciprocal rank fusion. Query embedding fails
+fast while the embedding upstream is unavailable, and searches then answer
+lexically. ``ef_search`` is tuned against brute-force recall in the
+background.
+"""
+import concurrent.futures
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from supavec import create_embeddings_batch, MODEL_ID
+from filters import FilterIndex, parse_filter, FILTER_EXACT_MAX
+from lexical import LexicalIndex, LEXICAL_ENABLED, reciprocal_rank_fusion
+from quantization import normalize
+from rate_limiter import get_limiter, estimate_tokens, urgent
+from scheduler import WorkScheduler, INTERACTIVE
+from search_tuning import (ExactIndex, exact_top_k, tune_ef, EXACT_SEARCH_MAX, EF_AUTOTUNE, EF_TARGET_RECALL,
+                           EF_TUNE_K, EF_TUNE_QUERIES, EF_RETUNE_GROWTH, TRUTH_BLOCK)
+from views import SearchView
+
+# "vector" ranks by embedding similarity, "lexical" by BM25 without an embedding call, "hybrid" fuses both
+SEARCH_MODES = ("vector", "hybrid", "lexical")
+HYBRID_DEPTH = 4  # each ranking contributes limit * HYBRID_DEPTH candidates to the fusion
+# Vector and hybrid searches answer lexically when the query cannot be embedded within the timeout;
+# after such a failure the embedding upstream is not asked again for the cooldown
+QUERY_EMBED_TIMEOUT = float(os.getenv("KB_QUERY_EMBED_TIMEOUT", "5"))
+QUERY_EMBED_COOLDOWN = float(os.getenv("KB_QUERY_EMBED_COOLDOWN", "30"))
+SEARCH_THREADS = int(os.getenv("KB_SEARCH_THREADS", str(os.cpu_count() or 4)))  # threads of a batch knn_query
+
+
+class _QueryEmbedder:
+    """
+    Embeds search queries, failing fast while the embedding upstream is slow, throttled or failing.
+
+    Calls run on the indexer's WorkScheduler as INTERACTIVE work, ahead of
+    queued bulk calls and under ``urgent()`` at the rate limiter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.unavailable_until = 0.0
+        self.last_error = None
+        self.fallbacks = 0
+
+    def _fail(self, reason: str):
+        with self._lock:
+            self.fallbacks += 1
+            self.last_error = reason
+            self.unavailable_until = time.time() + QUERY_EMBED_COOLDOWN
+        print(f"⚠️ Query embedding unavailable ({reason}); answering lexically for {QUERY_EMBED_COOLDOWN:.0f}s")
+
+    def embed(self, query: str, scheduler: WorkScheduler) -> Optional[np.ndarray]:
+        """Return the query's embedding, or None if it cannot be had within QUERY_EMBED_TIMEOUT."""
+        if time.time() < self.unavailable_until:
+            with self._lock:
+                self.fallbacks += 1
+            return None
+        with urgent():
+            wait = get_limiter(f"embedding:{MODEL_ID}").expected_wait(estimate_tokens(query))
+        if wait > QUERY_EMBED_TIMEOUT:
+            self._fail(f"rate limited for {wait:.1f}s")
+            return None
+        future = scheduler.submit(create_embeddings_batch, [query], store_in_db=False, priority=INTERACTIVE)
+        try:
+            vector = np.asarray(future.result(timeout=QUERY_EMBED_TIMEOUT)[0], dtype=np.float32)
+        except concurrent.futures.TimeoutError:
+            future.cancel()  # still queued behind other interactive work: drop it
+            self._fail(f"no answer within {QUERY_EMBED_TIMEOUT}s")
+            return None
+        except Exception as e:
+            self._fail(str(e))
+            return None
+        if not vector.any():  # create_embeddings_batch answers errors with zero vectors
+            self._fail("embedding call failed")
+            return None
+        return vector
+
+    def embed_many(self, queries: List[str], embedder) -> List[Optional[np.ndarray]]:
+        """
+        Embed many queries in packed requests; None marks queries that could not be embedded.
+
+        No timeout applies: a batch is expected to take a while, and its
+        requests wait their turn at the rate limiter like any other.
+        """
+        if time.time() < self.unavailable_until:
+            with self._lock:
+                self.fallbacks += len(queries)
+            return [None] * len(queries)
+        try:
+            vectors = embedder.embed(queries, store_in_db=False, priority=INTERACTIVE)
+        except Exception as e:
+            self._fail(str(e))
+            return [None] * len(queries)
+        vectors = [np.asarray(v, dtype=np.float32) for v in vectors]
+        return [v if v.any() else None for v in vectors]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "available": time.time() >= self.unavailable_until,
+            "lexical_fallbacks": self.fallbacks,
+            "last_error": self.last_error
+        }
+
+
+_query_embedder = _QueryEmbedder()
+
+
+def query_embedding_stats() -> Dict[str, Any]:
+    return _query_embedder.stats()
+
+
+class IndexSearch:
+    """Searches and ef tuning for DocumentIndexer; they read the published view (see views.py)."""
+
+    def _get_lexical(self, view: Optional[SearchView] = None) -> LexicalIndex:
+        """
+        Build the BM25 index on first use; it is kept current as chunks are registered and retired.
+
+        Each chunk store gets its own index, so a view published before a clear
+        keeps searching the text it was published with.
+
+        Args:
+            view: View to search; defaults to the live chunk store
+        """
+        if view is not None and view.lexical is not None:
+            return view.lexical
+        with self._lexical_lock:
+            if view is not None and view.lexical is not None:
+                return view.lexical
+            source = self.mapping if view is None else view.source
+            lexical = self._lexical if source is self.mapping else None
+            if lexical is None:
+                started = time.time()
+                lexical = LexicalIndex()
+                # Build from the published snapshot of the store, which writers leave alone;
+                # a store no longer live is not written to at all
+                published = self.view
+                lexical.sync(published.mapping if published is not None and published.source is source else source)
+                with self._write_lock:
+                    if source is self.mapping and self._lexical is None:
+                        # cleared during the build otherwise: the text may belong to reused labels
+                        self._lexical = lexical
+                        lexical.sync(source)  # chunks registered during the build
+                        with self._view_lock:
+                            if self.view is not None and self.view.source is source:
+                                self.view.lexical = lexical
+                print(f"Built lexical index over {len(lexical)} chunks in {time.time() - started:.2f}s")
+            if view is not None:
+                view.lexical = lexical
+            return lexical
+
+    def search_similar(self, query: str, limit: int = 5, filters: Optional[Dict[str, Any]] = None,
+                       mode: str = "vector") -> List[Dict[str, Any]]:
+        """
+        Return similar chunks for a query.
+
+        Args:
+            query: Query text
+            limit: Maximum number of results
+            filters: Conditions on file_path and metadata that results must meet (see filters.py)
+            mode: "vector", "lexical" or "hybrid" (see SEARCH_MODES); vector and hybrid
+                searches answer lexically when the query cannot be embedded in time
+
+        Returns:
+            Results tagged with the "retrieval" mode that produced them; "similarity_score"
+            is the cosine similarity, BM25 score or fused score accordingly
+
+        Raises:
+            ValueError: If ``filters`` or ``mode`` is invalid
+        """
+        self._check_search(filters, mode)
+        try:
+            q_emb = _query_embedder.embed(query, self.scheduler) if mode != "lexical" else None
+            with self._reading() as view:
+                return self._rank(view, query, q_emb, limit, filters, mode)
+        except Exception as e:
+            print(f"Search error: {e}")
+            return []
+
+    def search_similar_batch(self, queries: List[str], limit: int = 5, filters: Optional[Dict[str, Any]] = None,
+                             mode: str = "vector") -> List[List[Dict[str, Any]]]:
+        """
+        Run many searches at once, e.g. for evaluation jobs.
+
+        The queries are embedded in packed requests by the embedding batcher
+        (no per-query round trips), and unfiltered vector searches run as one
+        multi-row knn_query over SEARCH_THREADS threads.
+
+        Args:
+            queries: Query texts
+            limit, filters, mode: As for ``search_similar``, applied to every query
+
+        Returns:
+            One result list per query, in order
+
+        Raises:
+            ValueError: If ``filters`` or ``mode`` is invalid
+        """
+        self._check_search(filters, mode)
+        if not queries:
+            return []
+        try:
+            embeddings = _query_embedder.embed_many(queries, self.embedder) if mode != "lexical" else [None] * len(queries)
+            depth = limit * HYBRID_DEPTH if mode == "hybrid" else limit
+            rows = [i for i, q_emb in enumerate(embeddings) if q_emb is not None]
+            rankings = {}
+            results = []
+            with self._reading() as view:
+                if rows and not filters:
+                    rankings = dict(zip(rows, self._search_vectors_batch(view, [embeddings[i] for i in rows], depth)))
+                for i, query in enumerate(queries):
+                    try:
+                        results.append(self._rank(view, query, embeddings[i], limit, filters, mode, rankings.get(i)))
+                    except Exception as e:
+                        print(f"Search error for query {i}: {e}")
+                        results.append([])
+            return results
+        except Exception as e:
+            print(f"Batch search error: {e}")
+            return [[] for _ in queries]
+
+    @staticmethod
+    def _check_search(filters: Optional[Dict[str, Any]], mode: str):
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode '{mode}', expected one of {SEARCH_MODES}")
+        parse_filter(filters)
+
+    def _rank(self, view: SearchView, query: str, q_emb: Optional[np.ndarray], limit: int,
+              filters: Optional[Dict[str, Any]], mode: str, vector_ranking=None) -> List[Dict[str, Any]]:
+        """
+        Rank chunks for one query and build its results.
+
+        Args:
+            view: Published state the search reads
+            q_emb: Query embedding; None for lexical searches or when embedding failed
+            vector_ranking: Precomputed (labels, similarities, substitutes) of the vector search
+        """
+        degraded = False
+        if mode != "lexical" and q_emb is None:
+            if not LEXICAL_ENABLED:
+                return []
+            mode, degraded = "lexical", True
+        depth = limit * HYBRID_DEPTH if mode == "hybrid" else limit
+        rankings = []
+        substitutes = {}
+        if mode != "lexical":
+            self._recent_queries.append(q_emb)
+            if vector_ranking is None:
+                vector_ranking = (self._search_filtered(view, q_emb, depth, filters) if filters
+                                  else self._search_vectors(view, q_emb, depth))
+            labels, similarities, substitutes = vector_ranking
+            rankings.append((labels, similarities))
+        if mode != "vector":
+            allowed = None
+            if filters:
+                _, allowed, substitutes = self._match_filters(view, filters)
+            rankings.append(self._search_lexical(view, query, depth, allowed))
+        labels, scores = reciprocal_rank_fusion(rankings, limit) if mode == "hybrid" else rankings[0]
+        mapping = view.mapping
+        results = []
+        for owner, score in zip(labels, scores):
+            l = substitutes.get(int(owner), int(owner))
+            if l in mapping:
+                result = {
+                    "content": mapping.field(l, "content"),
+                    "file_path": mapping.field(l, "file_path"),
+                    "metadata": mapping.field(l, "metadata"),
+                    "similarity_score": float(score),  # ensure native float for JSON
+                    "retrieval": mode
+                }
+                if degraded:
+                    result["degraded"] = True
+                duplicates = view.duplicates.get(int(owner), ())
+                if l != int(owner):  # a matching duplicate stands in for its owner
+                    duplicates = [int(owner)] + [k for k in duplicates if k != l]
+                duplicates = [k for k in duplicates if k in mapping]  # chunks of files still being indexed
+                if duplicates:
+                    result["duplicates"] = [
+                        {"file_path": mapping.field(k, "file_path"),
+                         "chunk_index": mapping.field(k, "chunk_index")}
+                        for k in duplicates
+                    ]
+                results.append(result)
+        return results
+
+    def search_strategy(self, view: Optional[SearchView] = None) -> str:
+        """
+        How unfiltered vector searches run, chosen from the corpus size.
+
+        Returns:
+            "exact" for up to EXACT_SEARCH_MAX vectors (a scan of one contiguous
+            matrix), "tier" once a trained vector tier serves searches, else "hnsw"
+        """
+        if (view or self.view).vectors <= EXACT_SEARCH_MAX:
+            return "exact"
+        tier = self.vector_tier
+        if tier is not None and tier.trained and len(tier):
+            return "tier"
+        return "hnsw"
+
+    def _exact_index(self, view: SearchView) -> ExactIndex:
+        """
+        The vectors of a view as one contiguous matrix, kept once per published generation.
+
+        A generation's matrix is derived from the previous one: only vectors
+        of chunks that were not in it are read out of the graph.
+        """
+        cached = self._exact
+        if cached is not None and cached[0] == view.generation:
+            return cached[1]
+        labels = view.mapping.labels()
+        owners = labels[view.mapping.is_owner(labels)]
+        read = lambda new: (self._get_vectors(new.tolist(), view.index) if len(new)
+                            else np.zeros((0, self.dimension), dtype=np.float32))
+        if cached is not None and cached[2] is view.source:
+            exact = cached[1].updated(owners, read)
+        else:
+            exact = ExactIndex(owners, read(owners))  # cleared or reloaded: the labels may name other vectors
+        if view is self.view:
+            self._exact = (view.generation, exact, view.source)
+        return exact
+
+    def _graph_vectors(self, view: SearchView) -> int:
+        """Vectors a graph search in ``view`` can return, including ones the view does not show."""
+        if view.index is not self.index:
+            return view.vectors  # swapped out by a compaction or clear; only its own vectors are counted on
+        return max(view.vectors, self.index.get_current_count() - len(self.tombstones))
+
+    def _visible_top(self, view: SearchView, search, limit: int, available: int):
+        """
+        Run ``search(k)`` -> (labels, scores) with a growing k until ``limit`` of its
+        results are visible in ``view``.
+
+        The graph, vector tier and lexical index are shared with writers, so they
+        also return chunks of files still being indexed and chunks retired after
+        the view was published. Their number (``available`` minus the view's
+        vectors) sizes the first over-fetch.
+        """
+        k = min(available, limit + min(max(0, available - view.vectors), limit))
+        while True:
+            labels, scores = search(k)
+            top, top_scores, found = view.visible(labels, scores, limit)
+            if found >= limit or k >= available or len(labels) < k:
+                return top, top_scores
+            k = min(available, 2 * k)
+
+    def _search_vectors(self, view: SearchView, q_emb, limit: int):
+        """Unfiltered vector search; returns (labels, similarities, {})."""
+        k = min(limit, view.vectors)
+        strategy = self.search_strategy(view)
+        if k <= 0:
+            return [], [], {}
+        if strategy == "exact":
+            labels, similarities = self._exact_index(view).search(q_emb, k)
+            return labels[0], similarities[0], {}
+        self._exact = None  # the corpus has outgrown exact search
+        if strategy == "tier":
+            # Scan the compressed codes, re-rank the best candidates exactly
+            tier = self.vector_tier
+            labels, similarities = self._visible_top(view, lambda n: tier.search(q_emb, n), k, len(tier))
+            return labels, similarities, {}
+
+        def search(n: int):
+            with self._resize_gate.read():
+                labels, dists = view.index.knn_query([q_emb], k=n)
+            return labels[0], 1 - dists[0]
+
+        labels, similarities = self._visible_top(view, search, k, self._graph_vectors(view))
+        return labels, similarities, {}
+
+    def _search_vectors_batch(self, view: SearchView, embeddings: List[np.ndarray], limit: int) -> list:
+        """Unfiltered vector search for many queries; returns one (labels, similarities, {}) per query."""
+        k = min(limit, view.vectors)
+        strategy = self.search_strategy(view)
+        if k <= 0 or strategy == "tier":
+            return [self._search_vectors(view, q_emb, limit) for q_emb in embeddings]
+        matrix = np.vstack(embeddings).astype(np.float32)
+        if strategy == "exact":
+            labels, similarities = self._exact_index(view).search(matrix, k)
+            return [(labels[i], similarities[i], {}) for i in range(len(embeddings))]
+        available = self._graph_vectors(view)
+        n = min(available, k + min(available - view.vectors, k))
+        with self._resize_gate.read():
+            labels, dists = view.index.knn_query(matrix, k=n, num_threads=SEARCH_THREADS)
+        results = []
+        for i in range(len(embeddings)):
+            top, similarities, found = view.visible(labels[i], 1 - dists[i], k)
+            if found < k and n < available:
+                results.append(self._search_vectors(view, embeddings[i], limit))  # needs a deeper search
+            else:
+                results.append((top, similarities, {}))
+        return results
+
+    def _search_lexical(self, view: SearchView, query: str, limit: int, allowed: Optional[np.ndarray] = None):
+        """BM25 ranking of the chunks visible in ``view``."""
+        lexical = self._get_lexical(view)
+        return self._visible_top(view, lambda n: lexical.search(query, n, allowed=allowed), limit, len(lexical))
+
+    def _match_filters(self, view: SearchView, filters: Dict[str, Any]):
+        filter_index = self._filter_index
+        if filter_index is None or filter_index.store is not self.mapping:
+            filter_index = self._filter_index = FilterIndex(self.mapping)
+        return filter_index.match(filters, view.mapping)
+
+    def _search_filtered(self, view: SearchView, q_emb, limit: int, filters: Dict[str, Any]):
+        """
+        Search only the vectors serving chunks that match ``filters``.
+
+        The matches come from the filter bitmaps. Up to FILTER_EXACT_MAX of them
+        are scored exactly, which beats a graph search that would have to walk
+        past mostly non-matching neighbours; larger match sets are searched in
+        the graph (or vector tier) with the bitmap as the candidate filter.
+
+        Returns:
+            (vector labels, similarities, {vector label: matching duplicate chunk})
+        """
+        vector_labels, bitmap, substitutes = self._match_filters(view, filters)
+        k = min(limit, len(vector_labels))
+        if k <= 0:
+            return [], [], {}
+        if len(vector_labels) <= FILTER_EXACT_MAX:
+            similarities = normalize(self._get_vectors(vector_labels, view.index)) @ normalize(q_emb)[0]
+            top = np.argsort(-similarities)[:k]
+            return vector_labels[top], similarities[top], substitutes
+        tier = self.vector_tier
+        if tier is not None and tier.trained and len(tier):
+            labels, similarities = tier.search(q_emb, k, allowed=bitmap)
+            return labels, similarities, substitutes
+        allowed = lambda label: label < len(bitmap) and bool(bitmap[label])
+        with self._resize_gate.read():
+            while True:
+                try:
+                    labels, dists = view.index.knn_query([q_emb], k=k, filter=allowed)
+                    break
+                except RuntimeError:
+                    if k == 1:
+                        return [], [], {}
+                    k //= 2  # the graph search reached fewer matches than k
+        return labels[0], 1 - dists[0], substitutes
+
+    def maybe_tune_ef(self) -> bool:
+        """
+        Start a background ef tuning if the graph serves searches and has not been
+        tuned at this size yet (or has grown EF_RETUNE_GROWTH times since).
+        """
+        if not EF_AUTOTUNE or self.search_strategy() != "hnsw":
+            return False
+        last = self.ef_tuning
+        if last is not None and self._vector_count() < last["vectors"] * EF_RETUNE_GROWTH:
+            return False
+        return self.tune_ef(background=True)
+
+    def tune_ef(self, target_recall: float = EF_TARGET_RECALL, background: bool = True) -> bool:
+        """
+        Set ``ef_search`` to the smallest value whose measured recall@k meets ``target_recall``.
+
+        Recent query embeddings (topped up with perturbed stored vectors) are
+        searched at increasing ef values and compared with brute-force ground
+        truth; see search_tuning.tune_ef. The result is kept in ``ef_tuning``.
+
+        Returns:
+            False if a tuning is already running
+        """
+        with self._index_lock:
+            if self._tuning is not None and self._tuning.is_alive():
+                return False
+            self._tuning = threading.Thread(target=self._tune_ef, args=(target_recall,),
+                                            name=f"tune-ef-{self.index_name}", daemon=True)
+            self._tuning.start()
+        if not background:
+            self._tuning.join()
+        return True
+
+    def _tuning_queries(self, view: SearchView, owners: np.ndarray) -> np.ndarray:
+        queries = list(self._recent_queries)
+        missing = EF_TUNE_QUERIES - len(queries)
+        if missing > 0:
+            # Stored vectors moved off their own position stand in for queries not seen yet
+            rng = np.random.default_rng()
+            sample = rng.choice(owners, size=min(missing, len(owners)), replace=False)
+            vectors = normalize(self._get_vectors(sample.tolist(), view.index))
+            noise = rng.standard_normal(vectors.shape).astype(np.float32) * (0.5 / np.sqrt(self.dimension))
+            queries.extend(vectors + noise)
+        return normalize(np.vstack(queries))
+
+    def _tune_ef(self, target_recall: float):
+        """
+        Measure recall against the published view, which keeps its vectors in the
+        graph while it is read. Each trial holds the graph exclusively, so live
+        searches never run at a trial ef; they wait for one batch of queries.
+        """
+        try:
+            started = time.time()
+            with self._reading() as view:
+                labels = view.mapping.labels()
+                owners = labels[view.mapping.is_owner(labels)]
+                k = min(EF_TUNE_K, len(owners))
+                if not k:
+                    return
+                queries = self._tuning_queries(view, owners)
+
+                def blocks():
+                    for i in range(0, len(owners), TRUTH_BLOCK):
+                        block = owners[i:i + TRUTH_BLOCK]
+                        yield block, self._get_vectors(block.tolist(), view.index)
+
+                available = self._graph_vectors(view)
+                depth = min(available, k + max(0, available - view.vectors))  # room for vectors the view hides
+
+                def search(ef: int, queries: np.ndarray, k: int) -> np.ndarray:
+                    with self._resize_gate.exclusive():
+                        view.index.set_ef(max(ef, depth))
+                        try:
+                            labels, _ = view.index.knn_query(queries, k=depth, num_threads=SEARCH_THREADS)
+                        finally:
+                            view.index.set_ef(self.ef_search)
+                    return [row[view.mapping.is_owner(row)][:k] for row in labels]
+
+                truth = exact_top_k(blocks(), queries, k)
+                result = tune_ef(search, queries, truth, target_recall)
+            with self._index_lock:  # a compaction sizes its new graph's ef from ef_search under it
+                self.ef_search = result["ef"]
+                self.index.set_ef(self.ef_search)
+            result["vectors"] = len(owners)
+            result["seconds"] = round(time.time() - started, 3)
+            self.ef_tuning = result
+            print(f"🎯 Tuned ef_search of '{self.index_name}' to {self.ef_search}: recall@{k} {result['recall']} "
+                  f"(target {target_recall}) over {len(owners)} vectors in {result['seconds']}s")
+        except Exception as e:
+            print(f"Error tuning ef_search of '{self.index_name}': {e}")
+            import traceback
+            traceback.print_exc()
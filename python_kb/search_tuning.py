@@ -0,0 +1,150 @@
+"""
+Exact search for small indexes and ef_search tuning for large ones.
+
+Below EXACT_SEARCH_MAX vectors a cosine scan over one contiguous float32
+matrix is faster than walking the HNSW graph and has perfect recall. Above
+it the graph is used, and ``tune_ef`` measures its recall@k against
+brute-force ground truth for a sample of queries at increasing ``ef`` values,
+picking the smallest one that meets EF_TARGET_RECALL.
+"""
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, Sequence, Tuple
+
+import numpy as np
+
+from quantization import normalize
+
+EXACT_SEARCH_MAX = int(os.getenv("KB_EXACT_SEARCH_MAX", "5000"))  # vectors searched exactly
+EF_AUTOTUNE = os.getenv("KB_EF_AUTOTUNE", "1") != "0"
+EF_TARGET_RECALL = float(os.getenv("KB_EF_TARGET_RECALL", "0.95"))
+EF_TUNE_K = 10
+EF_TUNE_QUERIES = 200
+EF_CANDIDATES = (16, 24, 32, 48, 64, 96, 128, 192, 256, 384, 512)
+EF_RETUNE_GROWTH = 2.0  # tune again once the vector count has grown this much since the last tuning
+TRUTH_BLOCK = 16384     # vectors scanned per block when computing ground truth
+
+
+def top_k(similarities: np.ndarray, k: int) -> np.ndarray:
+    """Column indices of the ``k`` largest values of each row, best first."""
+    k = min(k, similarities.shape[1])
+    if k < similarities.shape[1]:
+        part = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        part = np.broadcast_to(np.arange(similarities.shape[1]), similarities.shape)
+    order = np.argsort(-np.take_along_axis(similarities, part, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1)
+
+
+class ExactIndex:
+    def __init__(self, labels: np.ndarray, vectors: np.ndarray):
+        """
+        Hold normalized vectors in one contiguous matrix for exact cosine search.
+
+        Args:
+            labels: Label of each row
+            vectors: Vectors, one row per label
+        """
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.vectors = np.ascontiguousarray(normalize(vectors))
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def updated(self, labels: np.ndarray, read: Callable[[np.ndarray], np.ndarray]) -> "ExactIndex":
+        """
+        Index over ``labels`` that reuses this index's rows for the labels it holds.
+
+        Args:
+            labels: Labels of the new index
+            read: Returns the vectors of the labels this index lacks
+        """
+        labels = np.asarray(labels, dtype=np.int64)
+        rows = np.zeros(len(labels), dtype=np.int64)
+        known = np.zeros(len(labels), dtype=bool)
+        if len(self.labels):
+            order = np.argsort(self.labels)
+            rows = order[np.minimum(np.searchsorted(self.labels, labels, sorter=order), len(order) - 1)]
+            known = self.labels[rows] == labels
+        index = ExactIndex.__new__(ExactIndex)
+        index.labels = labels
+        index.vectors = np.empty((len(labels), self.vectors.shape[1]), dtype=np.float32)
+        index.vectors[known] = self.vectors[rows[known]]
+        if not known.all():
+            index.vectors[~known] = normalize(read(labels[~known]))
+        return index
+
+    def search(self, queries, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            (labels, cosine similarities) of shape (queries, min(k, len)), best first
+        """
+        similarities = normalize(queries) @ self.vectors.T
+        best = top_k(similarities, k)
+        return self.labels[best], np.take_along_axis(similarities, best, axis=1)
+
+
+def exact_top_k(blocks: Iterable[Tuple[np.ndarray, np.ndarray]], queries: np.ndarray, k: int) -> np.ndarray:
+    """
+    Ground-truth top-k labels of each query, scanning the corpus block by block.
+
+    Args:
+        blocks: (labels, vectors) blocks covering the corpus
+        queries: Normalized query matrix
+        k: Neighbours per query
+
+    Returns:
+        Label matrix of shape (queries, k'), best first
+    """
+    best_labels = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for labels, vectors in blocks:
+        scores = queries @ normalize(vectors).T
+        all_scores = np.hstack([best_scores, scores])
+        all_labels = np.hstack([best_labels, np.broadcast_to(labels, (len(queries), len(labels)))])
+        keep = top_k(all_scores, k)
+        best_scores = np.take_along_axis(all_scores, keep, axis=1)
+        best_labels = np.take_along_axis(all_labels, keep, axis=1)
+    return best_labels
+
+
+def tune_ef(search: Callable[[int, np.ndarray, int], np.ndarray], queries: np.ndarray, truth: np.ndarray,
+            target: float = EF_TARGET_RECALL, candidates: Sequence[int] = EF_CANDIDATES) -> Dict[str, Any]:
+    """
+    Find the smallest ``ef`` whose recall@k meets ``target``.
+
+    Args:
+        search: ``search(ef, queries, k)`` returning a label matrix
+        queries: Sample query matrix
+        truth: Exact top-k labels per query
+        target: Recall@k to reach
+        candidates: ef values to try, ascending
+
+    Returns:
+        Dict with the chosen "ef", its "recall", whether the target was "met"
+        and the measured "curve" of recall and latency per ef
+    """
+    k = truth.shape[1]
+    curve = []
+    for ef in candidates:
+        if ef < k:
+            continue
+        started = time.perf_counter()
+        found = search(ef, queries, k)
+        elapsed = time.perf_counter() - started
+        hits = sum(len(set(row.tolist()) & set(expected.tolist())) for row, expected in zip(found, truth))
+        recall = hits / truth.size if truth.size else 1.0
+        curve.append({"ef": ef, "recall": round(recall, 4), "ms_per_query": round(1000 * elapsed / len(queries), 3)})
+        if recall >= target:
+            break
+    chosen = curve[-1]
+    return {
+        "ef": chosen["ef"],
+        "recall": chosen["recall"],
+        "target_recall": target,
+        "met": chosen["recall"] >= target,
+        "k": k,
+        "queries": len(queries),
+        "curve": curve,
+        "tuned_at": time.time()
+    }
@@ -2,12 +2,21 @@ from fastapi import FastAPI, HTTPException, Query, UploadFile, File, BackgroundT
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional, Dict, Any, List
-from python_kb.supavec import get_supabase_client
-from python_kb.indexing import DocumentIndexer
-import python_kb.supavec as supavec  # access google_client
+# The python_kb modules import each other by bare module name; import them the
+# same way so the service shares their clients, caches and rate limiters
+from collection_manager import CollectionManager, DEFAULT_COLLECTION
+from supavec import get_supabase_client
+from doc_extract import get_extraction_cache
+from rate_limiter import snapshot_all as rate_limiter_snapshots
+from scheduler import get_scheduler, INTERACTIVE, ASK
+from filters import parse_filter
+from search_tuning import EF_TARGET_RECALL
+from indexing import SEARCH_MODES, query_embedding_stats
+import supavec  # access google_client
+import asyncio
+import contextlib
 import os
 import traceback
-import time
 from unittest.mock import MagicMock
 
 # Set up application
@@ -27,84 +36,226 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
-# Initialize indexer with retry logic
+# One scheduler for every upstream call, so queries are not starved by ingestion
+scheduler = get_scheduler()
+
+# Collections load on first use and are evicted least recently used first (see collection_manager.py).
+# The default collection serves the unscoped endpoints; it is loaded now, a stale or missing
+# local snapshot being refreshed in the background (see /ready), and never evicted.
 try:
-    indexer = DocumentIndexer(get_supabase_client(), index_name="kb")
+    collections = CollectionManager(get_supabase_client(), scheduler=scheduler)
+    indexer = collections.load(DEFAULT_COLLECTION, pin=True, background_load=True)
 except Exception as e:
     print(f"⚠️ Error initializing DocumentIndexer: {e}")
-    print("⚠️ Will retry once more after a brief delay...")
-    time.sleep(2)
-    try:
-        indexer = DocumentIndexer(get_supabase_client(), index_name="kb")
-    except Exception as e:
-        print(f"⚠️ Error on second attempt to initialize DocumentIndexer: {e}")
-        print("⚠️ Creating indexer without Supabase persistence.")
-        # Create a dummy client if all else fails
-        dummy_client = MagicMock()
-        indexer = DocumentIndexer(dummy_client, index_name="kb")
+    print("⚠️ Creating indexer without Supabase persistence.")
+    # Create a dummy client if all else fails
+    dummy_client = MagicMock()
+    collections = CollectionManager(dummy_client, scheduler=scheduler)
+    indexer = collections.load(DEFAULT_COLLECTION, pin=True)
+
+# Upper bound on the queries of one /search-batch request
+SEARCH_BATCH_MAX = int(os.getenv("KB_SEARCH_BATCH_MAX", "2000"))
 
 # Set up documents directory
 DOCS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'docs')
 os.makedirs(DOCS_DIR, exist_ok=True)
 
+@contextlib.asynccontextmanager
+async def collection(name: str):
+    """Hold a collection for one request, loading it off the event loop if it is not resident."""
+    try:
+        CollectionManager.validate(name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": str(e)})
+    try:
+        held = await asyncio.to_thread(collections.acquire, name)
+    except Exception as e:
+        print(f"Error loading collection '{name}': {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail={"error": str(e), "collection": name})
+    try:
+        yield held
+    finally:
+        collections.release(name)
+
+def check_search(filters: Optional[Dict[str, Any]], mode: Optional[str]):
+    if mode not in SEARCH_MODES:
+        raise HTTPException(status_code=400, detail={"error": f"Unknown search mode '{mode}'", "modes": list(SEARCH_MODES)})
+    try:
+        parse_filter(filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail={"error": str(e), "filters": filters})
+
 class PathRequest(BaseModel):
     path: str
     metadata: Optional[Dict[str, Any]] = None
     max_chunks: Optional[int] = None
+    force: Optional[bool] = False
 
 class SearchRequest(BaseModel):
     query: str
     limit: Optional[int] = 5
+    filters: Optional[Dict[str, Any]] = None  # e.g. {"file_path": "...", "indexed_at": {"gte": ...}}, see filters.py
+    mode: Optional[str] = "vector"  # "vector", "hybrid" (vector + BM25) or "lexical" (no embedding call)
+
+class SearchBatchRequest(BaseModel):
+    queries: List[str]
+    limit: Optional[int] = 5
+    filters: Optional[Dict[str, Any]] = None
+    mode: Optional[str] = "vector"
 
 class AskRequest(BaseModel):
     question: str  
     max_context: Optional[int] = 5
     model_name: Optional[str] = "gemini-2.0-flash"
     use_knowledge_base: Optional[bool] = True
+    filters: Optional[Dict[str, Any]] = None  # restricts the retrieved context, as in SearchRequest
+    search_mode: Optional[str] = "vector"     # retrieval mode of the context, as SearchRequest.mode
 
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {"status": "ok", "ready": indexer.ready.is_set()}
 
-@app.post("/index-file")
-async def index_file(req: PathRequest):
-    """Index a file by path, creating embeddings and storing them."""
+@app.get("/ready")
+async def ready():
+    """Readiness probe: 503 while the index is still loading, or failed to load and rejects writes."""
+    if not indexer.ready.is_set() or indexer.load_status["state"] == "failed":
+        raise HTTPException(status_code=503, detail={"ready": False, "load": indexer.load_status})
+    return {"ready": True, "load": indexer.load_status}
+
+@app.get("/stats")
+async def stats():
+    """Report cache and throughput statistics."""
+    cache = get_extraction_cache()
+    embedding_cache = supavec.get_embedding_cache()
+    context_cache = supavec.get_context_cache()
+    return {
+        "extraction_cache": cache.stats() if cache is not None else {"enabled": False},
+        "embedding_cache": embedding_cache.stats() if embedding_cache is not None else {"enabled": False},
+        "context_cache": context_cache.stats() if context_cache is not None else {"enabled": False},
+        "embedding_batcher": indexer.embedder.stats(),
+        "ingestion": indexer.ingestion_stats(),
+        "chunk_store": indexer.mapping.stats(),
+        "index": indexer.index_stats(),
+        "collections": collections.stats(),
+        "query_embedding": query_embedding_stats(),
+        "scheduler": scheduler.stats(),
+        "rate_limits": rate_limiter_snapshots()
+    }
+
+@app.get("/collections")
+async def list_collections():
+    """List stored collections with residency, memory and load times of the loaded ones."""
     try:
-        print(f"Indexing file: {req.path}")
-        result = indexer.index_file(req.path, metadata=req.metadata, max_chunks=req.max_chunks)
-        return result if isinstance(result, dict) else {"indexed": req.path, "success": True}
+        names = await asyncio.to_thread(collections.names)
+        return {"collections": names, "default": DEFAULT_COLLECTION, "residency": collections.stats()}
     except Exception as e:
-        print(f"Error indexing file {req.path}: {e}")
+        print(f"Error listing collections: {e}")
         traceback.print_exc()
-        raise HTTPException(status_code=500, detail={"error": str(e), "path": req.path})
+        raise HTTPException(status_code=500, detail={"error": str(e)})
+
+@app.get("/collections/{name}/stats")
+async def collection_stats(name: str):
+    """Report index, chunk store and ingestion statistics of one collection."""
+    async with collection(name) as held:
+        return {
+            "collection": name,
+            "ingestion": held.ingestion_stats(),
+            "chunk_store": held.mapping.stats(),
+            "index": held.index_stats(),
+            "residency": collections.stats()["collections"].get(name)
+        }
+
+@app.post("/index-file")
+async def index_file(req: PathRequest):
+    """Index a file by path, creating embeddings and storing them."""
+    return await collection_index_file(DEFAULT_COLLECTION, req)
+
+@app.post("/collections/{name}/index-file")
+async def collection_index_file(name: str, req: PathRequest):
+    """Index a file by path into a collection."""
+    async with collection(name) as held:
+        try:
+            print(f"Indexing file: {req.path} (collection '{name}')")
+            result = await held.index_file_async(req.path, metadata=req.metadata, max_chunks=req.max_chunks, force=req.force)
+            return result if isinstance(result, dict) else {"indexed": req.path, "success": True}
+        except Exception as e:
+            print(f"Error indexing file {req.path}: {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail={"error": str(e), "path": req.path})
 
 @app.post("/index-directory")
 async def index_directory(req: PathRequest):
     """Index all files in a directory."""
-    try:
-        print(f"Indexing directory: {req.path}")
-        indexer.index_directory(req.path, metadata=req.metadata, max_chunks=req.max_chunks)
-        return {"indexed_directory": req.path, "success": True}
-    except Exception as e:
-        print(f"Error indexing directory {req.path}: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail={"error": str(e), "path": req.path})
+    return await collection_index_directory(DEFAULT_COLLECTION, req)
+
+@app.post("/collections/{name}/index-directory")
+async def collection_index_directory(name: str, req: PathRequest):
+    """Index all files in a directory into a collection."""
+    async with collection(name) as held:
+        try:
+            print(f"Indexing directory: {req.path} (collection '{name}')")
+            result = await held.index_directory_async(req.path, metadata=req.metadata, max_chunks=req.max_chunks, force=req.force)
+            return {"indexed_directory": req.path, "files": len(result["files"]), "skipped": result["skipped"],
+                    "stats": result["stats"], "success": True}
+        except Exception as e:
+            print(f"Error indexing directory {req.path}: {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail={"error": str(e), "path": req.path})
 
 @app.post("/search")
 async def search(req: SearchRequest):
     """Find similar documents based on semantic similarity."""
-    try:
-        print(f"Searching for: {req.query}")
-        results = indexer.search_similar(req.query, limit=req.limit)
-        return {"results": results, "query": req.query}
-    except Exception as e:
-        print(f"Error during search: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail={"error": str(e)})
+    return await collection_search(DEFAULT_COLLECTION, req)
+
+@app.post("/collections/{name}/search")
+async def collection_search(name: str, req: SearchRequest):
+    """Find similar documents in a collection, optionally only among chunks matching ``filters``."""
+    check_search(req.filters, req.mode)
+    async with collection(name) as held:
+        try:
+            print(f"Searching for: {req.query} (collection '{name}', filters {req.filters})")
+            results = await scheduler.run(held.search_similar, req.query, limit=req.limit, filters=req.filters,
+                                          mode=req.mode, priority=INTERACTIVE)
+            return {"results": results, "query": req.query,
+                    "mode": results[0]["retrieval"] if results else req.mode}
+        except Exception as e:
+            print(f"Error during search: {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail={"error": str(e)})
+
+@app.post("/search-batch")
+async def search_batch(req: SearchBatchRequest):
+    """Run many searches in one request: queries are embedded in packed batches and searched together."""
+    return await collection_search_batch(DEFAULT_COLLECTION, req)
+
+@app.post("/collections/{name}/search-batch")
+async def collection_search_batch(name: str, req: SearchBatchRequest):
+    """Run many searches against a collection in one request."""
+    check_search(req.filters, req.mode)
+    if len(req.queries) > SEARCH_BATCH_MAX:
+        raise HTTPException(status_code=400, detail={"error": f"At most {SEARCH_BATCH_MAX} queries per batch"})
+    async with collection(name) as held:
+        try:
+            print(f"Batch search of {len(req.queries)} queries (collection '{name}')")
+            # Not on the scheduler: the batch's embedding requests are themselves scheduled
+            results = await asyncio.to_thread(held.search_similar_batch, req.queries, limit=req.limit,
+                                              filters=req.filters, mode=req.mode)
+            return {"results": [{"query": query, "results": hits} for query, hits in zip(req.queries, results)]}
+        except Exception as e:
+            print(f"Error during batch search: {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail={"error": str(e)})
 
 @app.post("/ask")
 async def ask(req: AskRequest):
     """Answer questions using RAG with retrieved context from the knowledge base, or directly if specified."""
+    return await collection_ask(DEFAULT_COLLECTION, req)
+
+@app.post("/collections/{name}/ask")
+async def collection_ask(name: str, req: AskRequest):
+    """Answer questions using RAG with context retrieved from a collection."""
+    check_search(req.filters, req.search_mode)
     try:
         print(f"Question received: '{req.question}', Model: {req.model_name}, Use KB: {req.use_knowledge_base}")
         
@@ -112,8 +263,10 @@ async def ask(req: AskRequest):
         sources = []
 
         if req.use_knowledge_base:
-            print(f"Performing knowledge base search for question: {req.question}")
-            results = indexer.search_similar(req.question, limit=req.max_context)
+            print(f"Performing knowledge base search for question: {req.question} (collection '{name}')")
+            async with collection(name) as held:
+                results = await scheduler.run(held.search_similar, req.question, limit=req.max_context,
+                                              filters=req.filters, mode=req.search_mode, priority=INTERACTIVE)
             if not results:
                 # If KB is enabled but no results, we can either say "I don't know from KB" 
                 # or let the model answer from its general knowledge. For now, let's inform.
@@ -167,10 +320,7 @@ ANSWER:"""
                     "sources": sources # Return sources even if AI fails, if they were retrieved
                 }
                 
-            response = supavec.google_client.models.generate_content(
-                model=req.model_name,
-                contents=[prompt]
-            )
+            response = await scheduler.run(supavec.generate_content, req.model_name, [prompt], priority=ASK)
             
             return {
                 "answer": response.text,
@@ -184,6 +334,8 @@ ANSWER:"""
                 "sources": sources
             }
             
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Error processing question: {e}")
         traceback.print_exc()
@@ -192,20 +344,51 @@ ANSWER:"""
 @app.post("/delete-index")
 async def delete_index(req: PathRequest):
     """Delete all embeddings for a specific file."""
-    try:
-        print(f"Deleting index for: {req.path}")
-        indexer.delete_index(req.path)
-        return {"deleted": req.path, "success": True}
-    except Exception as e:
-        print(f"Error deleting index for {req.path}: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail={"error": str(e)})
+    return await collection_delete_index(DEFAULT_COLLECTION, req)
+
+@app.post("/collections/{name}/delete-index")
+async def collection_delete_index(name: str, req: PathRequest):
+    """Delete all embeddings for a specific file from a collection."""
+    async with collection(name) as held:
+        try:
+            print(f"Deleting index for: {req.path} (collection '{name}')")
+            result = await asyncio.to_thread(held.delete_index, req.path)  # waits for a load, may upload a snapshot
+            return {"deleted": req.path, "chunks": result["deleted"], "success": True}
+        except Exception as e:
+            print(f"Error deleting index for {req.path}: {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail={"error": str(e)})
+
+class TuneRequest(BaseModel):
+    target_recall: Optional[float] = EF_TARGET_RECALL
+
+@app.post("/tune-ef")
+async def tune_ef(req: TuneRequest):
+    """Measure the recall of the HNSW search and set the smallest ef_search meeting the target."""
+    return await collection_tune_ef(DEFAULT_COLLECTION, req)
+
+@app.post("/collections/{name}/tune-ef")
+async def collection_tune_ef(name: str, req: TuneRequest):
+    """Tune ef_search of a collection (see DocumentIndexer.tune_ef)."""
+    if not 0 < req.target_recall <= 1:
+        raise HTTPException(status_code=400, detail={"error": "target_recall must be in (0, 1]"})
+    async with collection(name) as held:
+        try:
+            started = await asyncio.to_thread(held.tune_ef, req.target_recall, False)
+            return {"started": started, "strategy": held.search_strategy(), "ef": held.ef_search, "tuning": held.ef_tuning}
+        except Exception as e:
+            print(f"Error tuning ef_search of '{name}': {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail={"error": str(e)})
 
-def background_indexing(file_path: str):
-    """Background task to index a file after upload."""
+async def background_indexing(file_path: str, name: str = DEFAULT_COLLECTION):
+    """Background task to index a file after upload, run on the event loop like the /index handlers."""
     try:
-        print(f"Starting background indexing of {file_path}")
-        indexer.index_file(file_path)
+        print(f"Starting background indexing of {file_path} (collection '{name}')")
+        async with collection(name) as held:
+            result = await held.index_file_async(file_path)
+        if not result.get("success"):
+            raise RuntimeError(result.get("error"))
         print(f"Successfully indexed {file_path} in background")
     except Exception as e:
         print(f"Error in background indexing of {file_path}: {e}")
@@ -214,22 +397,34 @@ def background_indexing(file_path: str):
 @app.get("/knowledgebase")
 async def knowledgebase_summary():
     """Return a lightweight summary of what is stored in the KB."""
-    try:
-        mapping = indexer.mapping
-        file_stats: Dict[str, int] = {}
-        for v in mapping.values():
-            path = v.get("file_path", "unknown")
-            file_stats[path] = file_stats.get(path, 0) + 1
-        summary = [{"file_path": k, "chunks": v, "metadata": mapping.get(list(mapping.keys())[0], {}).get("metadata", {})} for k, v in file_stats.items()]
-        return {"documents": summary, "total_chunks": len(mapping)}
-    except Exception as e:
-        print(f"Error getting knowledgebase summary: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail={"error": str(e)})
+    return await collection_summary(DEFAULT_COLLECTION)
+
+@app.get("/collections/{name}/knowledgebase")
+async def collection_summary(name: str):
+    """Return a lightweight summary of what is stored in a collection."""
+    async with collection(name) as held:
+        try:
+            mapping = held.view.mapping
+            file_stats: Dict[str, int] = {}
+            first_label: Dict[str, int] = {}
+            for label, path in mapping.iter_columns("label", "file_path"):
+                file_stats[path] = file_stats.get(path, 0) + 1
+                first_label.setdefault(path, label)
+            summary = [{"file_path": k, "chunks": v, "metadata": mapping.field(first_label[k], "metadata")} for k, v in file_stats.items()]
+            return {"documents": summary, "total_chunks": len(mapping)}
+        except Exception as e:
+            print(f"Error getting knowledgebase summary: {e}")
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail={"error": str(e)})
 
 @app.post("/upload-file")
-async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
-    """Upload a file, save it into docs/, index it immediately."""
+async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File(...),
+                      collection_name: str = Query(DEFAULT_COLLECTION, alias="collection")):
+    """Upload a file, save it into docs/, index it immediately (into ``?collection=``, default the KB)."""
+    try:
+        CollectionManager.validate(collection_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     try:
         # Log the start of upload processing
         print(f"Processing upload of file: {file.filename}")
@@ -260,7 +455,7 @@ async def upload_file(background_tasks: BackgroundTasks, file: UploadFile = File
             raise HTTPException(status_code=500, detail=f"Failed to save file: {str(e)}")
         
         # Index the file in the background to avoid blocking the response
-        background_tasks.add_task(background_indexing, dest_path)
+        background_tasks.add_task(background_indexing, dest_path, collection_name)
         
         return {
             "uploaded": dest_path,
@@ -0,0 +1,229 @@
+"""
+Sharded HNSW index.
+
+``ShardedIndex`` splits one logical index into several hnswlib graphs and
+implements the part of the ``hnswlib.Index`` interface the indexer uses, so it
+can stand in for a single graph. Labels are routed to shard ``label % shards``;
+labels are allocated sequentially, so shards stay balanced and a label's
+shard never has to be looked up.
+
+Inserts are split per shard and the shards are filled in parallel; a query
+fans out to all shards at once (hnswlib releases the GIL during search) and
+the per-shard top-k lists are merged with a heap. Each shard records whether
+it changed since the last snapshot, so snapshots only rewrite changed shards.
+"""
+import concurrent.futures
+import heapq
+import os
+from typing import Callable, List, Optional, Set, Tuple
+
+import hnswlib
+import numpy as np
+
+INDEX_SHARDS = int(os.getenv("KB_INDEX_SHARDS", "1"))  # 1 keeps a single hnswlib graph
+SHARD_WORKERS = int(os.getenv("KB_SHARD_WORKERS", str(os.cpu_count() or 4)))
+
+# HNSW capacity starts small and grows geometrically with resize_index
+INITIAL_CAPACITY = int(os.getenv("KB_INITIAL_CAPACITY", "1024"))
+CAPACITY_GROWTH = float(os.getenv("KB_CAPACITY_GROWTH", "2.0"))
+
+
+class ShardedIndex:
+    def __init__(self, shards: List[hnswlib.Index], dirty: Optional[Set[int]] = None):
+        """
+        Wrap existing graphs; they must share space and dimension.
+
+        Args:
+            shards: One hnswlib index per shard, in shard order
+            dirty: Shards that differ from the last snapshot (default: all)
+        """
+        self.shards = shards
+        self.space = shards[0].space
+        self.dim = shards[0].dim
+        self.dirty = set(range(len(shards))) if dirty is None else set(dirty)
+        workers = max(1, min(len(shards), SHARD_WORKERS))
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="shard")
+        self._threads_per_shard = max(1, (os.cpu_count() or 1) // workers)
+
+    @classmethod
+    def create(cls, count: int, dim: int, capacity: int, ef_construction: int, M: int,
+               space: str = "cosine") -> "ShardedIndex":
+        """Create ``count`` empty shards sharing ``capacity`` between them."""
+        shards = []
+        for _ in range(count):
+            shard = hnswlib.Index(space=space, dim=dim)
+            shard.init_index(max_elements=-(-capacity // count), ef_construction=ef_construction, M=M)
+            shards.append(shard)
+        return cls(shards)
+
+    def __len__(self) -> int:
+        return len(self.shards)
+
+    def _route(self, labels) -> np.ndarray:
+        return np.asarray(labels, dtype=np.int64) % len(self.shards)
+
+    def _groups(self, labels) -> List[Tuple[int, np.ndarray]]:
+        """Return (shard, positions of its labels) for every shard that owns any of ``labels``."""
+        route = self._route(labels)
+        return [(s, np.flatnonzero(route == s)) for s in np.unique(route).tolist()]
+
+    def _each(self, fn: Callable, items) -> list:
+        items = list(items)
+        if len(items) == 1:
+            return [fn(items[0])]
+        return list(self._pool.map(fn, items))
+
+    # hnswlib.Index interface
+
+    def add_items(self, data, ids, num_threads: int = -1, replace_deleted: bool = False):
+        data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+        ids = np.asarray(ids, dtype=np.int64)
+        groups = self._groups(ids)
+        threads = num_threads if len(groups) == 1 else self._threads_per_shard
+
+        def add(group):
+            s, positions = group
+            self.shards[s].add_items(data[positions], ids[positions], num_threads=threads)
+        self._each(add, groups)
+        self.dirty.update(s for s, _ in groups)
+
+    def get_items(self, ids) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        out = np.empty((len(ids), self.dim), dtype=np.float32)
+        for s, positions in self._groups(ids):
+            out[positions] = self.shards[s].get_items(ids[positions])
+        return out
+
+    def mark_deleted(self, label: int):
+        s = int(self._route([label])[0])
+        self.shards[s].mark_deleted(label)
+        self.dirty.add(s)
+
+    def knn_query(self, data, k: int = 1, num_threads: int = -1, filter: Optional[Callable[[int], bool]] = None):
+        """
+        Query every shard concurrently and merge their top-k lists.
+
+        Returns:
+            (labels, distances) arrays of shape (queries, k'), where k' <= k
+            is the number of results every query could fill
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=np.float32))
+
+        def query(shard):
+            n = shard.get_current_count()
+            shard_k = min(k, n)
+            while shard_k > 0:
+                try:
+                    return shard.knn_query(data, k=shard_k, num_threads=1, filter=filter)
+                except RuntimeError:
+                    shard_k //= 2  # too few live (or matching) elements for shard_k results
+            return np.empty((len(data), 0), dtype=np.uint64), np.empty((len(data), 0), dtype=np.float32)
+        results = self._each(query, self.shards)
+
+        merged = []
+        for row in range(len(data)):
+            candidates = []
+            for labels, distances in results:
+                candidates.extend(zip(distances[row].tolist(), labels[row].tolist()))
+            merged.append(heapq.nsmallest(k, candidates))
+        width = min(len(m) for m in merged)
+        if width == 0:
+            raise RuntimeError("Cannot return the results in a contiguous 2D array. Probably ef or M is too small")
+        labels = np.array([[label for _, label in m[:width]] for m in merged], dtype=np.uint64)
+        distances = np.array([[distance for distance, _ in m[:width]] for m in merged], dtype=np.float32)
+        return labels, distances
+
+    def get_ids_list(self) -> List[int]:
+        ids = []
+        for shard in self.shards:
+            ids.extend(shard.get_ids_list())
+        return ids
+
+    def get_current_count(self) -> int:
+        return sum(shard.get_current_count() for shard in self.shards)
+
+    def get_max_elements(self) -> int:
+        return sum(shard.get_max_elements() for shard in self.shards)
+
+    def resize_index(self, new_size: int):
+        """Spread ``new_size`` over the shards; shards are never shrunk."""
+        per_shard = -(-new_size // len(self.shards))
+        for s, shard in enumerate(self.shards):
+            if per_shard > shard.get_max_elements():
+                shard.resize_index(per_shard)
+                self.dirty.add(s)
+
+    def set_ef(self, ef: int):
+        for shard in self.shards:
+            shard.set_ef(ef)
+
+    @property
+    def ef(self) -> int:
+        return self.shards[0].ef
+
+    @ef.setter
+    def ef(self, value: int):
+        self.set_ef(value)
+
+    # Sharding specifics
+
+    def has_room(self, labels) -> bool:
+        """Whether every shard can take its share of ``labels`` without resizing."""
+        return all(self.shards[s].get_current_count() + len(positions) <= self.shards[s].get_max_elements()
+                   for s, positions in self._groups(labels))
+
+    def reserve(self, labels, growth: float) -> int:
+        """
+        Grow the shards that cannot take their share of ``labels``.
+
+        Returns:
+            Total capacity afterwards
+        """
+        for s, positions in self._groups(labels):
+            shard = self.shards[s]
+            needed = shard.get_current_count() + len(positions)
+            if needed > shard.get_max_elements():
+                shard.resize_index(max(needed, int(shard.get_max_elements() * growth)))
+                self.dirty.add(s)
+        return self.get_max_elements()
+
+    def take_dirty(self) -> Set[int]:
+        """Return the shards changed since the last call and mark all clean."""
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def map_shards(self, fn: Callable[[hnswlib.Index], object]) -> list:
+        """Apply ``fn`` to every shard in parallel, e.g. to serialize them."""
+        return self._each(fn, self.shards)
+
+    def close(self):
+        """Stop the fan-out workers; the index cannot be queried afterwards."""
+        self._pool.shutdown(wait=True)
+
+    def shard_stats(self) -> List[dict]:
+        return [{"elements": shard.get_current_count(), "capacity": shard.get_max_elements()}
+                for shard in self.shards]
+
+
+def has_room(index, labels: List[int]) -> bool:
+    """Whether ``labels`` can be added without resizing."""
+    if isinstance(index, ShardedIndex):
+        return index.has_room(labels)
+    return index.get_current_count() + len(labels) <= index.get_max_elements()
+
+
+def grow_index(index, labels: List[int]) -> int:
+    """
+    Make room for ``labels``, growing capacity (per shard, if sharded) by CAPACITY_GROWTH.
+
+    Returns:
+        The index's capacity afterwards
+    """
+    if isinstance(index, ShardedIndex):
+        return index.reserve(labels, CAPACITY_GROWTH)
+    capacity = index.get_max_elements()
+    needed = index.get_current_count() + len(labels)
+    if needed > capacity:
+        capacity = max(needed, int(capacity * CAPACITY_GROWTH), INITIAL_CAPACITY)
+        index.resize_index(capacity)
+    return capacity
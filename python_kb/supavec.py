@@ -8,9 +8,13 @@ from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
 from dotenv import load_dotenv
 from google import genai
 import time
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+import threading
 import numpy as np
 from unittest.mock import MagicMock
+from disk_cache import DEFAULT_CACHE_DIR, SQLiteLRUCache
+from embedding_cache import EmbeddingCache, embedding_key
+from rate_limiter import get_limiter, estimate_tokens, is_quota_error
+from manifest import text_sha256
 
 # Load environment variables
 load_dotenv()
@@ -20,22 +24,53 @@ REGION = "us-central1"
 
 MODEL_ID = "text-multilingual-embedding-002"
 
+# Per-request limits of the embedding model
+EMBEDDING_MAX_INSTANCES = 250
+EMBEDDING_MAX_REQUEST_TOKENS = 20000
+EMBEDDING_MAX_INPUT_TOKENS = 2048  # longer inputs are truncated by the API
+
 # Initialize clients
 google_client = None
 supabase_client = None
 
-# Rate limiting
-RATE_LIMIT_DELAY = 1  # seconds between requests
-last_request_time = 0
+# Shared embedding model handle
+embedding_model = None
+embedding_model_lock = threading.Lock()
+
+# Local embedding cache
+EMBEDDING_CACHE_ENABLED = os.getenv("KB_EMBEDDING_CACHE", "1") != "0"
+EMBEDDING_CACHE_DTYPE = os.getenv("KB_EMBEDDING_CACHE_DTYPE", "float16")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("KB_EMBEDDING_CACHE_MAX_ENTRIES", "2000000"))
+local_embedding_cache = None
+
+# Model used to situate chunks within their document
+CONTEXT_MODEL_ID = "gemini-1.5-flash"
+CONTEXT_PROMPT_VERSION = "1"  # bump when the context prompts change to invalidate cached contexts
 
-def rate_limit():
-    """Implement rate limiting for API calls."""
-    global last_request_time
-    current_time = time.time()
-    time_since_last_request = current_time - last_request_time
-    if time_since_last_request < RATE_LIMIT_DELAY:
-        time.sleep(RATE_LIMIT_DELAY - time_since_last_request)
-    last_request_time = time.time()
+# Chunks contextualized per generation request, and the excerpt budget of one request
+CONTEXT_BATCH_SIZE = int(os.getenv("KB_CONTEXT_BATCH_SIZE", "8"))
+CONTEXT_BATCH_MAX_CHARS = int(os.getenv("KB_CONTEXT_BATCH_MAX_CHARS", "60000"))
+
+# Persistent cache of generated contexts
+CONTEXT_CACHE_ENABLED = os.getenv("KB_CONTEXT_CACHE", "1") != "0"
+CONTEXT_CACHE_MAX_BYTES = int(os.getenv("KB_CONTEXT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+context_cache = None
+
+def generate_content(model: str, contents: List[str], expected_output_tokens: int = 1024):
+    """
+    Call a Gemini model through its shared rate limiter.
+    
+    Args:
+        model: Gemini model name
+        contents: Prompt parts
+        expected_output_tokens: Output tokens to reserve against the token quota
+        
+    Returns:
+        The generate_content response
+    """
+    limiter = get_limiter(f"generation:{model}")
+    tokens = sum(estimate_tokens(c) for c in contents) + expected_output_tokens
+    return limiter.call(lambda: google_client.models.generate_content(model=model, contents=contents), tokens=tokens)
 
 def initialize_clients():
     """Initialize Supabase and Google clients with proper error handling."""
@@ -130,6 +165,42 @@ def initialize_clients():
             supabase_client = DummyClient()
             google_client = DummyClient()
 
+def get_embedding_model() -> TextEmbeddingModel:
+    """Load the Vertex embedding model once and reuse the handle."""
+    global embedding_model
+    if embedding_model is None:
+        with embedding_model_lock:
+            if embedding_model is None:
+                embedding_model = TextEmbeddingModel.from_pretrained(MODEL_ID)
+    return embedding_model
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Return the shared embedding cache, or None if it is disabled or unavailable."""
+    global local_embedding_cache
+    if EMBEDDING_CACHE_ENABLED and local_embedding_cache is None:
+        try:
+            local_embedding_cache = EmbeddingCache(
+                os.path.join(DEFAULT_CACHE_DIR, "embeddings"),
+                dim=768,
+                dtype=EMBEDDING_CACHE_DTYPE,
+                max_entries=EMBEDDING_CACHE_MAX_ENTRIES
+            )
+        except Exception as e:
+            print(f"⚠️ Could not open embedding cache: {e}")
+            return None
+    return local_embedding_cache
+
+def get_context_cache() -> Optional[SQLiteLRUCache]:
+    """Return the shared cache of generated contexts, or None if it is disabled."""
+    global context_cache
+    if CONTEXT_CACHE_ENABLED and context_cache is None:
+        context_cache = SQLiteLRUCache(os.path.join(DEFAULT_CACHE_DIR, "contexts.db"), CONTEXT_CACHE_MAX_BYTES)
+    return context_cache
+
+def context_key(doc_hash: str, chunk_hash: str) -> str:
+    """Cache key for the generated context of one chunk of one document."""
+    return f"{CONTEXT_MODEL_ID}:{CONTEXT_PROMPT_VERSION}:{doc_hash}:{chunk_hash}"
+
 def get_supabase_client() -> Client:
     """
     Get a Supabase client with the URL and key from environment variables.
@@ -237,26 +308,63 @@ def store_embeddings_in_supabase(
         print("⚠️ Embeddings will not be persisted but will be available for the current session.")
         return False # Not successful
 
+def store_embeddings(
+    texts: List[str],
+    embeddings: List[List[float]],
+    metadata: Optional[Dict[str, Any]] = None,
+    source_file: Optional[str] = None,
+    chunk_indices: Optional[List[int]] = None,
+    total_chunks: Optional[int] = None
+) -> bool:
+    """
+    Store embeddings in Supabase if real credentials are configured.
+    
+    Returns True if everything was stored, False otherwise (never raises).
+    """
+    supabase_storage_successful = False
+    try:
+        if not os.getenv("SUPABASE_URL") or not os.getenv("SUPABASE_ANON_KEY") or \
+           os.getenv("SUPABASE_URL") == "https://your-project-id.supabase.co" or \
+           os.getenv("SUPABASE_URL") == "https://example.supabase.co": # Added example.co
+            print("\n⚠️ WARNING: Supabase credentials are missing or placeholders.")
+            print("⚠️ Cannot store embeddings in database. Check SUPABASE_URL and SUPABASE_ANON_KEY.")
+        else:
+            print(f"Attempting to store {len(texts)} embeddings in Supabase...")
+            supabase_storage_successful = store_embeddings_in_supabase(
+                supabase_client, 
+                texts, 
+                embeddings, 
+                metadata=metadata,
+                source_file=source_file,
+                chunk_indices=chunk_indices,
+                total_chunks=total_chunks
+            )
+            if not supabase_storage_successful:
+                print("⚠️ Supabase storage was not fully successful. Embeddings may be in-memory only.")
+    except Exception as e:
+        print(f"\n⚠️ Exception during attempt to store embeddings in Supabase: {e}")
+        print("⚠️ Check your Supabase credentials and network connection.")
+    return supabase_storage_successful
+
 class QuotaExceededError(Exception):
     """Custom exception for quota exceeded errors."""
     pass
 
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_exponential(multiplier=2, min=4, max=60),
-    retry=retry_if_exception_type(QuotaExceededError)
-)
 def create_embeddings_batch(
     texts: List[str], 
     store_in_db: bool = True,
     metadata: Optional[Dict[str, Any]] = None,
     source_file: Optional[str] = None,
     chunk_indices: Optional[List[int]] = None,
-    total_chunks: Optional[int] = None
+    total_chunks: Optional[int] = None,
+    task_type: str = "RETRIEVAL_DOCUMENT"
 ) -> List[List[float]]:
     """
     Create embeddings for multiple texts using Google's text-multilingual-embedding-002 model.
     
+    Vectors already in the local embedding cache (same model, task type and
+    text) are served from it; only the remaining texts are sent to the API.
+    
     Args:
         texts: List of texts to create embeddings for
         store_in_db: Whether to store embeddings in Supabase
@@ -264,6 +372,7 @@ def create_embeddings_batch(
         source_file: Optional source file path
         chunk_indices: Optional list of chunk indices
         total_chunks: Optional total number of chunks
+        task_type: Vertex embedding task type
         
     Returns:
         List of embeddings (each embedding is a list of floats)
@@ -284,43 +393,40 @@ def create_embeddings_batch(
             print("⚠️ Update it with your actual Google API key in the .env file.")
             return [[0.0] * 768 for _ in range(len(texts))]
             
-        rate_limit()
+        cache = get_embedding_cache()
+        keys = [embedding_key(MODEL_ID, task_type, text) for text in texts]
+        cached = cache.get_many(keys) if cache is not None else {}
+        missing = [i for i, key in enumerate(keys) if key not in cached]
         
-        print(f"Generating embeddings for {len(texts)} text chunks using Google model")
-        model = TextEmbeddingModel.from_pretrained(MODEL_ID)
-        inputs = [TextEmbeddingInput(text, "RETRIEVAL_DOCUMENT") for text in texts]
-        embeddings_response = model.get_embeddings(inputs)
-        result = [embedding.values for embedding in embeddings_response]
-        print(f"Successfully generated {len(result)} embeddings")
+        fresh = {}
+        if missing:
+            print(f"Generating embeddings for {len(missing)} text chunks using Google model")
+            model = get_embedding_model()
+            inputs = [TextEmbeddingInput(texts[i], task_type) for i in missing]
+            tokens = sum(min(estimate_tokens(texts[i]), EMBEDDING_MAX_INPUT_TOKENS) for i in missing)
+            limiter = get_limiter(f"embedding:{MODEL_ID}")
+            embeddings_response = limiter.call(lambda: model.get_embeddings(inputs), tokens=tokens)
+            fresh = {i: embedding.values for i, embedding in zip(missing, embeddings_response)}
+            print(f"Successfully generated {len(fresh)} embeddings")
+            if cache is not None:
+                cache.put_many([keys[i] for i in missing], [fresh[i] for i in missing])
+        if cache is not None:
+            print(f"Embedding cache: {len(texts) - len(missing)}/{len(texts)} hits")
+        result = [fresh[i] if i in fresh else cached[keys[i]].tolist() for i in range(len(texts))]
         
         if store_in_db:
-            supabase_storage_successful = False
-            try:
-                if not os.getenv("SUPABASE_URL") or not os.getenv("SUPABASE_ANON_KEY") or \
-                   os.getenv("SUPABASE_URL") == "https://your-project-id.supabase.co" or \
-                   os.getenv("SUPABASE_URL") == "https://example.supabase.co": # Added example.co
-                    print("\n⚠️ WARNING: Supabase credentials are missing or placeholders.")
-                    print("⚠️ Cannot store embeddings in database. Check SUPABASE_URL and SUPABASE_ANON_KEY.")
-                else:
-                    print(f"Attempting to store {len(texts)} embeddings in Supabase...")
-                    supabase_storage_successful = store_embeddings_in_supabase(
-                        supabase_client, 
-                        texts, 
-                        result, 
-                        metadata=metadata,
-                        source_file=source_file,
-                        chunk_indices=chunk_indices,
-                        total_chunks=total_chunks
-                    )
-                    if not supabase_storage_successful:
-                        print("⚠️ Supabase storage was not fully successful. Embeddings may be in-memory only.")
-            except Exception as e:
-                print(f"\n⚠️ Exception during attempt to store embeddings in Supabase: {e}")
-                print("⚠️ Check your Supabase credentials and network connection.")
+            store_embeddings(
+                texts,
+                result,
+                metadata=metadata,
+                source_file=source_file,
+                chunk_indices=chunk_indices,
+                total_chunks=total_chunks
+            )
         return result
     except Exception as e:
-        if "429" in str(e) or "Quota exceeded" in str(e):
-            print("Quota exceeded, waiting before retry...")
+        if is_quota_error(e):
+            print("Quota exceeded after repeated backoff")
             raise QuotaExceededError("Google API quota exceeded")
         print(f"Error creating batch embeddings: {e}")
         import traceback
@@ -345,13 +451,68 @@ def create_embedding(text: str, store_in_db: bool = True) -> List[float]:
         print(f"Error creating embedding: {e}")
         return [0.0] * 768
 
-def generate_contextual_embedding(full_document: str, chunk: str) -> Tuple[str, bool]:
+def _truncate_excerpt(chunk: str, max_chunk_length: int = 10000) -> str:
+    """Ensure a chunk is not too long for the context prompt."""
+    if len(chunk) <= max_chunk_length:
+        return chunk
+    print(f"Chunk truncated from {len(chunk)} to {max_chunk_length} chars for contextual embedding")
+    return chunk[:max_chunk_length] + "\n[Chunk truncated due to length...]"
+
+def _clean_context(context: str) -> str:
+    """Check a generated context and cap unusually long ones."""
+    context = context.strip()
+    if len(context) < 10 or len(context) > 500:
+        print(f"Warning: Contextual embedding generation produced unusual output length ({len(context)} chars)")
+        if len(context) > 500:
+            context = context[:500] + "..."
+    return context
+
+def _cached_contexts(doc_hash: Optional[str], chunks: List[str]) -> Tuple[List[Optional[str]], List[Optional[str]]]:
+    """Look up cached contexts; returns (contexts or None per chunk, cache keys or None)."""
+    cache = get_context_cache() if doc_hash else None
+    if cache is None:
+        return [None] * len(chunks), [None] * len(chunks)
+    keys = [context_key(doc_hash, text_sha256(chunk)) for chunk in chunks]
+    contexts = []
+    for key in keys:
+        cached = cache.get(key)
+        contexts.append(cached.decode("utf-8") if cached is not None else None)
+    return contexts, keys
+
+def _store_context(key: Optional[str], context: str):
+    cache = get_context_cache()
+    if key is not None and cache is not None:
+        cache.put(key, context.encode("utf-8"))
+
+def _generate_context(chunk: str) -> str:
+    """Ask the context model to situate one chunk; raises on API errors."""
+    truncated_chunk = _truncate_excerpt(chunk)
+    
+    # Create the prompt for generating contextual information - use a more focused prompt
+    prompt = f"""You are working on an information retrieval system. Your task is to provide a brief context (2-3 sentences) explaining how a document excerpt fits within the overall document. This context will be used to improve search.
+
+Here is an excerpt from a document:
+---
+{truncated_chunk}
+---
+
+Based on your understanding of how this excerpt relates to the broader document, provide ONLY a brief context (2-3 sentences) that would help a search system understand this excerpt better. Do not summarize the excerpt itself."""
+
+    # Call the Gemini API to generate contextual information
+    response = generate_content(CONTEXT_MODEL_ID, [prompt], expected_output_tokens=200)
+    context = _clean_context(response.text)
+    print(f"Created contextual embedding: {len(context)} chars context + {len(chunk)} chars content")
+    return context
+
+def generate_contextual_embedding(full_document: str, chunk: str, doc_hash: Optional[str] = None) -> Tuple[str, bool]:
     """
     Generate contextual information for a chunk within a document to improve retrieval.
     
     Args:
         full_document: The complete document text
         chunk: The specific chunk of text to generate context for
+        doc_hash: Optional content hash of the document; when given, the
+            context is cached under it and the chunk hash and reused on later runs
         
     Returns:
         Tuple containing:
@@ -359,51 +520,120 @@ def generate_contextual_embedding(full_document: str, chunk: str) -> Tuple[str,
         - Boolean indicating if contextual embedding was performed
     """
     try:
-        # Remove strict truncation; allow larger documents (200k chars safeguard)
-        max_doc_length = 200000  # generous limit (~30k tokens)
-        truncated_document = full_document if len(full_document) <= max_doc_length else full_document[:max_doc_length] + "\n[Document truncated due to length...]"
-        
-        # Ensure chunk is not too long for the API
-        max_chunk_length = 10000
-        truncated_chunk = chunk[:max_chunk_length]
-        if len(chunk) > max_chunk_length:
-            print(f"Chunk truncated from {len(chunk)} to {max_chunk_length} chars for contextual embedding")
-            truncated_chunk += "\n[Chunk truncated due to length...]"
-        
-        # Create the prompt for generating contextual information - use a more focused prompt
-        prompt = f"""You are working on an information retrieval system. Your task is to provide a brief context (2-3 sentences) explaining how a document excerpt fits within the overall document. This context will be used to improve search.
+        (context,), (key,) = _cached_contexts(doc_hash, [chunk])
+        if context is None:
+            context = _generate_context(chunk)
+            _store_context(key, context)
+        # Combine the context with the original chunk (not truncated)
+        return f"{context}\n---\n{chunk}", True
+    except Exception as e:
+        print(f"Error generating contextual embedding: {e}. Using original chunk instead.")
+        return chunk, False
 
-Here is an excerpt from a document:
----
-{truncated_chunk}
----
+def _parse_batch_contexts(text: str, count: int) -> Dict[int, str]:
+    """
+    Parse the JSON answer of a batched context request.
+    
+    Returns:
+        Dict from excerpt number to context for every well-formed item
+    """
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        return {}
+    try:
+        items = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    contexts = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            number = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        context = item.get("context")
+        if 0 <= number < count and isinstance(context, str) and context.strip():
+            contexts[number] = context
+    return contexts
 
-Based on your understanding of how this excerpt relates to the broader document, provide ONLY a brief context (2-3 sentences) that would help a search system understand this excerpt better. Do not summarize the excerpt itself."""
+def _context_groups(excerpts: List[str]) -> List[List[int]]:
+    """Split excerpts into requests of at most CONTEXT_BATCH_SIZE items and CONTEXT_BATCH_MAX_CHARS chars."""
+    groups, current, size = [], [], 0
+    for i, excerpt in enumerate(excerpts):
+        if current and (len(current) >= CONTEXT_BATCH_SIZE or size + len(excerpt) > CONTEXT_BATCH_MAX_CHARS):
+            groups.append(current)
+            current, size = [], 0
+        current.append(i)
+        size += len(excerpt)
+    if current:
+        groups.append(current)
+    return groups
 
-        # Call the Gemini API to generate contextual information
-        response = google_client.models.generate_content(
-            model="gemini-1.5-flash",
-            contents=[prompt]
-        )
-        
-        # Extract the generated context
-        context = response.text.strip()
-        
-        # Check if we got a meaningful context
-        if len(context) < 10 or len(context) > 500:
-            print(f"Warning: Contextual embedding generation produced unusual output length ({len(context)} chars)")
-            if len(context) > 500:
-                context = context[:500] + "..."
-        
-        # Combine the context with the original chunk (not truncated)
-        contextual_text = f"{context}\n---\n{chunk}"
+def generate_contextual_embeddings_batch(full_document: Optional[str], chunks: List[str],
+                                         doc_hash: Optional[str] = None) -> List[Tuple[str, bool]]:
+    """
+    Generate contexts for several chunks of one document with one request per group.
+    
+    Cached contexts are reused. The remaining chunks are sent in groups of up
+    to CONTEXT_BATCH_SIZE excerpts and the model answers with a JSON list of
+    per-excerpt contexts; any excerpt missing from a malformed or partial
+    answer falls back to a single-chunk request.
+    
+    Args:
+        full_document: The complete document text; not sent to the model (the
+            prompts see only the excerpts), so callers may pass None
+        chunks: Chunks of the document to contextualize
+        doc_hash: Optional content hash of the document, used as cache key
         
-        print(f"Created contextual embedding: {len(context)} chars context + {len(chunk)} chars content")
-        return contextual_text, True
+    Returns:
+        List of (contextual text, whether contextualization succeeded), one per chunk
+    """
+    contexts, keys = _cached_contexts(doc_hash, chunks)
+    missing = [i for i, context in enumerate(contexts) if context is None]
+    if len(chunks) > len(missing):
+        print(f"Reused {len(chunks) - len(missing)} cached contexts")
     
-    except Exception as e:
-        print(f"Error generating contextual embedding: {e}. Using original chunk instead.")
-        return chunk, False
+    excerpts = [_truncate_excerpt(chunks[i]) for i in missing]
+    for group in _context_groups(excerpts):
+        if len(group) == 1:
+            continue  # a single excerpt goes through the single-chunk prompt below
+        numbered = "\n\n".join(f"<excerpt id=\"{n}\">\n{excerpts[g]}\n</excerpt>" for n, g in enumerate(group))
+        prompt = f"""You are working on an information retrieval system. Your task is to provide a brief context (2-3 sentences) for each of the document excerpts below, explaining how the excerpt fits within the overall document. These contexts will be used to improve search.
+
+{numbered}
+
+For every excerpt, provide ONLY a brief context (2-3 sentences) that would help a search system understand it better. Do not summarize the excerpt itself.
+Answer with a JSON array and nothing else, one object per excerpt: [{{"id": <excerpt id>, "context": "<context>"}}, ...]"""
+        try:
+            response = generate_content(CONTEXT_MODEL_ID, [prompt], expected_output_tokens=200 * len(group))
+            parsed = _parse_batch_contexts(response.text, len(group))
+        except Exception as e:
+            print(f"Error generating batched contexts: {e}. Falling back to single-chunk requests.")
+            parsed = {}
+        if len(parsed) < len(group):
+            print(f"Batched context request answered {len(parsed)}/{len(group)} excerpts; retrying the rest one by one")
+        for n, g in enumerate(group):
+            if n in parsed:
+                contexts[missing[g]] = _clean_context(parsed[n])
+                _store_context(keys[missing[g]], contexts[missing[g]])
+    
+    results = []
+    for i, chunk in enumerate(chunks):
+        if contexts[i] is None:
+            try:
+                contexts[i] = _generate_context(chunk)
+                _store_context(keys[i], contexts[i])
+            except Exception as e:
+                print(f"Error generating contextual embedding: {e}. Using original chunk instead.")
+                results.append((chunk, False))
+                continue
+        results.append((f"{contexts[i]}\n---\n{chunk}", True))
+    return results
 
 def process_chunk_with_context(args):
     """
@@ -0,0 +1,98 @@
+"""
+Shared fixtures for the python_kb tests.
+
+The python_kb modules import each other by bare module name, so the package
+directory is put on sys.path. Tests that need the indexer skip themselves
+when the service dependencies (requirements.txt) are not installed.
+"""
+import hashlib
+import os
+import sys
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeEmbedder:
+    """Stands in for the EmbeddingBatcher: a fixed random vector per text, without upstream calls."""
+    max_in_flight = 2
+    max_instances = 8
+    max_tokens = 20000
+
+    def __init__(self, dimension: int = 768):
+        self.dimension = dimension
+        self.texts = []
+
+    def vector(self, text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(self.dimension).astype(np.float32)
+
+    def embed(self, texts, store_in_db=True, metadata=None, priority=None, job=None):
+        self.texts.extend(texts)
+        return [self.vector(text).tolist() for text in texts]
+
+    async def embed_async(self, texts, store_in_db=True, metadata=None, priority=None, job=None):
+        return self.embed(texts, store_in_db, metadata, priority, job)
+
+
+@pytest.fixture
+def embedder():
+    return FakeEmbedder()
+
+
+@pytest.fixture
+def make_indexer(tmp_path, monkeypatch, embedder):
+    """
+    Return a factory of DocumentIndexers persisting to one local store under tmp_path.
+
+    Embeddings come from ``embedder``; contextual generation and the Supabase
+    mirror of the embeddings are switched off.
+    """
+    indexing = pytest.importorskip("indexing", reason="needs the service dependencies in requirements.txt")
+    import pipeline
+    import search
+    from persistence import LocalIndexStore
+
+    monkeypatch.setattr(pipeline, "generate_contextual_embeddings_batch",
+                        lambda document, chunks, doc_hash=None: [(chunk, False) for chunk in chunks])
+    monkeypatch.setattr(pipeline, "store_embeddings", lambda *args, **kwargs: False)
+    monkeypatch.setattr(search, "create_embeddings_batch",
+                        lambda texts, store_in_db=True: embedder.embed(texts, store_in_db))
+    store = LocalIndexStore(str(tmp_path / "indexes"))
+
+    def make(name: str = "test"):
+        indexer = indexing.DocumentIndexer(MagicMock(), index_name=name, store=store)
+        indexer.embedder = embedder
+        return indexer
+    return make
+
+
+def write_document(path, paragraphs: int, seed: int = 0) -> str:
+    """Write a text file of random paragraphs, each long enough to be a chunk of its own."""
+    rng = np.random.default_rng(seed)
+    vocabulary = [f"word{i}" for i in range(5000)]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("\n\n".join(" ".join(rng.choice(vocabulary, 400)) for _ in range(paragraphs)), encoding="utf-8")
+    return str(path)
+
+
+@pytest.fixture
+def add_file(tmp_path, embedder):
+    """
+    Return a function that writes a text file and indexes it with ``index_file``.
+
+    It returns the file's path and {label: vector} of the chunks owning a vector.
+    """
+    seeds = iter(range(1, 1_000_000))
+
+    def add(indexer, name: str, paragraphs: int):
+        path = write_document(tmp_path / "docs" / name, paragraphs, next(seeds))
+        result = indexer.index_file(path)
+        assert result["success"], result
+        labels = indexer.manifest.labels_for_file(path)
+        return path, {label: embedder.vector(indexer.mapping.field(label, "content")) for label in labels
+                      if indexer.mapping.field(label, "duplicate_of") is None}
+    return add
@@ -0,0 +1,80 @@
+"""Snapshots of the chunk store stay fixed while the store changes, and copy only what changed."""
+import numpy as np
+
+import chunk_store
+from chunk_store import ChunkStore
+
+
+def entry(label: int, duplicate_of=None):
+    entry = {"content": f"chunk {label}", "file_path": f"f{label % 7}.txt",
+             "metadata": {"chunk_index": label, "chunk_hash": f"{label:064x}"}}
+    if duplicate_of is not None:
+        entry["duplicate_of"] = str(duplicate_of)
+    return entry
+
+
+def contents(store):
+    return {label: store.field(label, "content") for label in store.labels().tolist()}
+
+
+def test_snapshots_match_the_store_through_random_changes():
+    rng = np.random.default_rng(0)
+    store = ChunkStore()
+    views = []
+    next_label = 0
+    for step in range(60):
+        for _ in range(int(rng.integers(1, 40))):
+            owners = [l for l in store.labels().tolist() if store.field(l, "duplicate_of") is None]
+            target = int(rng.choice(owners)) if owners and rng.random() < 0.2 else None
+            store.put(next_label, entry(next_label, target))
+            next_label += 1
+        live = store.labels()
+        for label in rng.choice(live, min(len(live), int(rng.integers(0, 15))), replace=False).tolist():
+            if rng.random() < 0.5:
+                store.pop(label)
+            else:
+                store.update_metadata(label, {"file_hash": f"{step:064x}"})
+        if step % 17 == 16:
+            store.compact()  # renumbers the rows under earlier snapshots
+        hidden = set(range(max(0, next_label - 5), next_label))
+        view = store.snapshot(exclude=hidden)
+        expected = {label: text for label, text in contents(store).items() if label not in hidden}
+        labels = np.array(sorted(expected), dtype=np.int64)
+        views.append((view, expected, store.owners(labels)))
+
+    for view, expected, owners in views:
+        labels = np.array(sorted(expected), dtype=np.int64)
+        assert contents(view) == expected
+        assert len(view) == len(expected)
+        assert np.array_equal(view.owners(labels), owners)
+        assert view.owner_count() == int((owners == labels).sum())
+        assert view.max_label() == max(expected, default=-1)
+
+
+def test_snapshot_copies_only_changed_pages(monkeypatch):
+    monkeypatch.setattr(chunk_store, "_PAGE_BITS", 4)
+    monkeypatch.setattr(chunk_store, "_PAGE", 16)
+    store = ChunkStore()
+    for label in range(64):
+        store.put(label, entry(label))
+    first = store.snapshot()
+    store.put(64, entry(64))
+    store.pop(3)
+    second = store.snapshot(exclude={64})
+    shared = [a is b for a, b in zip(first._label_pages, second._label_pages)]
+    assert shared[:4] == [False, True, True, True]  # page 0 lost label 3, page 4 gained label 64
+    third = store.snapshot()
+    assert third._label_pages[0] is second._label_pages[0]
+    assert 64 in third and 64 not in second and 3 in first
+
+
+def test_snapshot_saves_and_loads(tmp_path):
+    store = ChunkStore()
+    for label in range(20):
+        store.put(label, entry(label, 0 if label % 5 == 4 else None))
+    view = store.snapshot(exclude={19})
+    store.pop(2)  # kills the row in the shared columns after the snapshot
+    view.save(str(tmp_path / "chunks"))
+    loaded = ChunkStore.load(str(tmp_path / "chunks"))
+    assert contents(loaded) == contents(view)
+    assert 2 in loaded and 19 not in loaded
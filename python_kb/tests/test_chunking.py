@@ -0,0 +1,63 @@
+"""Offsets, limits and LangChain parity of the recursive chunker."""
+import numpy as np
+import pytest
+
+from chunking import chunk_text, count_tokens, split_text
+
+
+def markdown_document(seed: int = 0) -> str:
+    rng = np.random.default_rng(seed)
+    words = [f"w{i}" for i in range(300)]
+    sections = []
+    for s in range(6):
+        paragraphs = []
+        for _ in range(rng.integers(1, 5)):
+            sentences = [" ".join(rng.choice(words, rng.integers(3, 40))) for _ in range(rng.integers(1, 8))]
+            paragraphs.append(". ".join(sentences) + ".")
+        sections.append(f"## Section {s}\n" + "\n\n".join(paragraphs))
+    return "\n".join(sections)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_chunks_point_back_into_the_text(seed):
+    text = markdown_document(seed)
+    for chunk in chunk_text(text, chunk_size=300, chunk_overlap=50):
+        assert text[chunk.start:chunk.end] == chunk.text
+        assert 0 < len(chunk.text) <= 300
+        assert chunk.text == chunk.text.strip()
+
+
+def test_consecutive_chunks_overlap():
+    text = " ".join(f"word{i}" for i in range(400))
+    chunks = chunk_text(text, chunk_size=200, chunk_overlap=60)
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk.start < previous.end  # the next chunk starts inside the previous one
+        assert previous.end - chunk.start <= 60
+    assert chunks[0].start == 0 and chunks[-1].end == len(text)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_langchain_recursive_splitter(seed):
+    splitters = pytest.importorskip("langchain_text_splitters")
+    text = markdown_document(seed)
+    separators = ["\n## ", "\n\n", "\n", ". ", " ", ""]
+    expected = splitters.RecursiveCharacterTextSplitter(
+        chunk_size=250, chunk_overlap=40, separators=separators).split_text(text)
+    assert split_text(text, chunk_size=250, chunk_overlap=40, separators=separators) == expected
+
+
+def test_token_length_unit():
+    text = markdown_document(1)
+    chunks = chunk_text(text, chunk_size=60, chunk_overlap=10, length_unit="tokens")
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk.text) <= 60 for chunk in chunks)
+    assert count_tokens("Hello, world.") == 4
+
+
+def test_invalid_arguments():
+    with pytest.raises(ValueError):
+        chunk_text("text", chunk_size=10, chunk_overlap=20)
+    with pytest.raises(ValueError):
+        chunk_text("text", length_unit="bytes")
+    assert chunk_text("") == []
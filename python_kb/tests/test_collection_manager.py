@@ -0,0 +1,48 @@
+"""Eviction and reloading of collections."""
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+
+collection_manager = pytest.importorskip("collection_manager", reason="needs the service dependencies in requirements.txt")
+
+
+def test_reload_waits_for_eviction_flush(monkeypatch):
+    events = []
+    closing = threading.Event()
+    finish_close = threading.Event()
+
+    class FakeIndexer:
+        store = object()
+
+        def __init__(self, client, index_name, **kwargs):
+            self.name = index_name
+            events.append(f"load {index_name}")
+
+        def memory_report(self):
+            return {"total_bytes": 10}
+
+        def close(self):
+            events.append(f"close {self.name}")
+            closing.set()
+            assert finish_close.wait(5)
+            events.append(f"closed {self.name}")
+
+    monkeypatch.setattr(collection_manager, "DocumentIndexer", FakeIndexer)
+    manager = collection_manager.CollectionManager(MagicMock(), memory_budget=15)
+    manager.load("a")
+    evicting = threading.Thread(target=manager.load, args=("b",))  # over budget: evicts "a"
+    evicting.start()
+    assert closing.wait(5)
+
+    reloading = threading.Thread(target=manager.load, args=("a",))
+    reloading.start()
+    reloading.join(0.2)
+    assert reloading.is_alive(), "reload must wait for the evicted collection's final flush"
+    assert events == ["load a", "load b", "close a"]
+
+    finish_close.set()
+    evicting.join(5)
+    reloading.join(5)
+    assert events[:5] == ["load a", "load b", "close a", "closed a", "load a"]
+    assert "a" in manager.names()
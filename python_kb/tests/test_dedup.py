@@ -0,0 +1,70 @@
+"""Exact and near-duplicate detection, alone and during indexing."""
+import numpy as np
+import pytest
+
+from dedup import ChunkDeduplicator
+from manifest import text_sha256
+
+from conftest import write_document
+
+
+def passage(seed: int, words: int = 200) -> str:
+    rng = np.random.default_rng(seed)
+    return " ".join(rng.choice([f"term{i}" for i in range(3000)], words))
+
+
+def test_exact_duplicate_is_found_by_hash():
+    dedup = ChunkDeduplicator()
+    text = passage(0)
+    dedup.add(7, text, text_sha256(text))
+    label, signature = dedup.find(text, text_sha256(text))
+    assert label == 7
+    assert signature.shape == (dedup.num_perm,)
+
+
+def test_near_duplicate_is_found_and_unrelated_text_is_not():
+    dedup = ChunkDeduplicator()
+    text = passage(0)
+    dedup.add(1, text, text_sha256(text))
+    edited = text.replace(text.split()[100], "changed", 1)
+    assert dedup.find(edited, text_sha256(edited))[0] == 1
+    other = passage(1)
+    assert dedup.find(other, text_sha256(other))[0] is None
+
+
+def test_removed_chunk_no_longer_matches():
+    dedup = ChunkDeduplicator()
+    text = passage(2)
+    dedup.add(3, text, text_sha256(text))
+    dedup.remove(3)
+    assert len(dedup) == 0
+    assert dedup.find(text, text_sha256(text))[0] is None
+    assert not any(dedup.buckets)
+
+
+def test_bands_must_divide_permutations():
+    with pytest.raises(ValueError):
+        ChunkDeduplicator(num_perm=100, num_bands=16)
+
+
+def test_duplicate_file_shares_vectors(make_indexer, embedder, tmp_path):
+    indexer = make_indexer()
+    original = write_document(tmp_path / "docs" / "a.txt", 4, seed=5)
+    copy = tmp_path / "docs" / "b.txt"
+    copy.write_text(open(original, encoding="utf-8").read(), encoding="utf-8")
+
+    assert indexer.index_file(original)["success"]
+    embedded = len(embedder.texts)
+    assert indexer.index_file(str(copy))["success"]
+    assert len(embedder.texts) == embedded  # every chunk of the copy borrows an existing vector
+
+    labels = indexer.manifest.labels_for_file(str(copy))
+    assert labels and all(indexer.mapping.field(label, "duplicate_of") is not None for label in labels)
+    query = indexer.mapping.field(labels[0], "content")
+    top = indexer.search_similar(query, limit=1)[0]
+    assert top["file_path"] == original
+    assert [d["file_path"] for d in top["duplicates"]] == [str(copy)]
+
+    indexer.delete_index(original)  # the copy inherits the shared vectors
+    top = indexer.search_similar(query, limit=1)[0]
+    assert top["file_path"] == str(copy) and "duplicates" not in top
@@ -0,0 +1,65 @@
+"""Lookups, persistence and LRU eviction of the embedding cache."""
+import itertools
+
+import numpy as np
+import pytest
+
+import embedding_cache
+from embedding_cache import EmbeddingCache, embedding_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A strictly increasing clock, so every access has its own LRU position."""
+    ticks = itertools.count(1000)
+    monkeypatch.setattr(embedding_cache.time, "time", lambda: float(next(ticks)))
+
+
+def vectors(n: int, dim: int = 8, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+
+
+def test_keys_separate_models_and_task_types():
+    keys = {embedding_key("m1", "RETRIEVAL_DOCUMENT", "text"), embedding_key("m2", "RETRIEVAL_DOCUMENT", "text"),
+            embedding_key("m1", "RETRIEVAL_QUERY", "text"), embedding_key("m1", "RETRIEVAL_DOCUMENT", "other")}
+    assert len(keys) == 4
+
+
+def test_round_trip_and_reopen(tmp_path, clock):
+    cache = EmbeddingCache(str(tmp_path), dim=8, dtype="float32")
+    data = vectors(3)
+    cache.put_many(["a", "b", "c"], data.tolist())
+    found = cache.get_many(["a", "c", "missing", "a"])
+    assert set(found) == {"a", "c"}
+    assert np.array_equal(found["c"], data[2])
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (3, 3, 1)
+
+    reopened = EmbeddingCache(str(tmp_path), dim=8, dtype="float32")
+    assert np.array_equal(reopened.get_many(["b"])["b"], data[1])
+
+
+def test_float16_storage_is_close(tmp_path, clock):
+    cache = EmbeddingCache(str(tmp_path), dim=8)
+    data = vectors(1)
+    cache.put_many(["a"], data.tolist())
+    vector = cache.get_many(["a"])["a"]
+    assert vector.dtype == np.float32
+    assert np.allclose(vector, data[0], atol=1e-2)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    cache = EmbeddingCache(str(tmp_path), dim=8, dtype="float32", max_entries=3)
+    data = vectors(5)
+    cache.put_many(["a", "b", "c"], data[:3].tolist())
+    cache.get_many(["a"])  # "b" is now the least recently used
+    cache.put_many(["d"], data[3:4].tolist())
+    assert set(cache.get_many(["a", "b", "c", "d"])) == {"a", "c", "d"}
+    assert np.array_equal(cache.get_many(["d"])["d"], data[3])  # written into the evicted row
+
+    cache.get_many(["a"])  # "c" is now the least recently used
+    cache.put_many(["a", "e"], [data[0].tolist(), data[4].tolist()])  # "a" is cached already
+    stats = cache.stats()
+    assert stats["entries"] == 3 and stats["evictions"] == 2
+    assert stats["capacity"] == 3
+    assert set(cache.get_many(["a", "d", "e"])) == {"a", "d", "e"}
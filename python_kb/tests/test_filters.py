@@ -0,0 +1,79 @@
+"""Filter parsing, bitmap evaluation and filtered search."""
+import numpy as np
+import pytest
+
+from chunk_store import ChunkStore
+from filters import FilterIndex, parse_filter
+
+
+def chunk(label: int, file_path: str, department: str, year: int, duplicate_of=None):
+    entry = {"content": f"chunk {label}", "file_path": file_path,
+             "metadata": {"chunk_index": label, "department": department, "year": year}}
+    if duplicate_of is not None:
+        entry["duplicate_of"] = str(duplicate_of)
+    return entry
+
+
+@pytest.fixture
+def store():
+    store = ChunkStore()
+    store.put(0, chunk(0, "a.txt", "legal", 2020))
+    store.put(1, chunk(1, "a.txt", "legal", 2021))
+    store.put(2, chunk(2, "b.txt", "sales", 2022))
+    store.put(3, chunk(3, "b.txt", "sales", 2023))
+    store.put(4, chunk(4, "c.txt", "hr", 2024, duplicate_of=0))  # shares chunk 0's vector
+    return store
+
+
+def test_parse_filter_normalizes_and_validates():
+    assert parse_filter(None) == []
+    assert parse_filter({"file_path": "a.txt", "year": {"gte": 2021, "lt": 2023}, "department": ["hr", "legal"]}) == [
+        ("file_path", [("eq", "a.txt")]), ("year", [("gte", 2021), ("lt", 2023)]),
+        ("department", [("in", ["hr", "legal"])])]
+    for invalid in (["a.txt"], {"year": {"between": [1, 2]}}, {"year": {}}, {"department": {"in": "legal"}}):
+        with pytest.raises(ValueError):
+            parse_filter(invalid)
+
+
+def test_conditions_select_vector_labels(store):
+    filters = FilterIndex(store)
+    labels, bitmap, substitutes = filters.match({"year": {"gte": 2021, "lte": 2022}})
+    assert labels.tolist() == [1, 2] and substitutes == {}
+    assert np.flatnonzero(bitmap).tolist() == [1, 2]
+    assert filters.match({"department": {"ne": "legal"}, "file_path": ["b.txt", "c.txt"]})[0].tolist() == [0, 2, 3]
+    assert filters.match({"year": {"gt": "2020"}})[0].tolist() == []  # ranges on other types never match
+    assert filters.match({"missing": "x"})[0].tolist() == []
+
+
+def test_matching_duplicate_stands_in_for_its_owner(store):
+    labels, bitmap, substitutes = FilterIndex(store).match({"department": "hr"})
+    assert labels.tolist() == [0]  # searched through the owner's vector
+    assert substitutes == {0: 4}   # and reported as the duplicate
+
+
+def test_cached_bitmaps_follow_store_changes(store):
+    filters = FilterIndex(store)
+    assert filters.match({"department": "sales"})[0].tolist() == [2, 3]
+    assert filters.match({"department": "sales"})[0].tolist() == [2, 3]
+    assert (filters.hits, filters.misses) == (1, 1)
+    store.pop(3)
+    assert filters.match({"department": "sales"})[0].tolist() == [2]
+    snapshot = store.snapshot(exclude=frozenset([2]))
+    assert filters.match({"department": "sales"}, snapshot)[0].tolist() == []
+
+
+@pytest.mark.parametrize("exact_max", [4096, 0])
+def test_filtered_search(make_indexer, add_file, monkeypatch, exact_max):
+    import search
+    monkeypatch.setattr(search, "FILTER_EXACT_MAX", exact_max)  # 0: filter the graph search with the bitmap
+    indexer = make_indexer()
+    _, vectors_a = add_file(indexer, "a.txt", 4)
+    path_b, vectors_b = add_file(indexer, "b.txt", 4)
+    query = indexer.mapping.field(next(iter(vectors_a)), "content")
+
+    results = indexer.search_similar(query, limit=3, filters={"file_path": path_b})
+    assert len(results) == 3 and {r["file_path"] for r in results} == {path_b}
+    assert indexer.search_similar(query, limit=1)[0]["content"] == query
+    assert indexer.search_similar(query, filters={"file_path": "nowhere.txt"}) == []
+    with pytest.raises(ValueError):
+        indexer.search_similar(query, filters={"file_path": {"like": "%b%"}})
@@ -0,0 +1,107 @@
+"""BM25 ranking, index maintenance, rank fusion and lexical search modes."""
+import math
+
+import numpy as np
+import pytest
+
+from chunk_store import ChunkStore
+from lexical import LexicalIndex, reciprocal_rank_fusion, tokenize
+
+DOCS = {
+    0: "the quick brown fox jumps over the lazy dog",
+    1: "a quick brown dog",
+    2: "lazy afternoons by the river",
+    3: "foxes and dogs and more foxes",
+}
+
+
+def bm25(query: str, docs, k1: float = 1.5, b: float = 0.75):
+    tokens = {label: tokenize(text) for label, text in docs.items()}
+    avg = sum(map(len, tokens.values())) / len(tokens)
+    scores = {}
+    for term in set(tokenize(query)):
+        df = sum(term in t for t in tokens.values())
+        idf = math.log(1 + (len(tokens) - df + 0.5) / (df + 0.5))
+        for label, t in tokens.items():
+            tf = t.count(term)
+            if tf:
+                norm = k1 * (1 - b + b * len(t) / avg)
+                scores[label] = scores.get(label, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+    return scores
+
+
+def indexed(docs) -> LexicalIndex:
+    index = LexicalIndex(k1=1.5, b=0.75)
+    for label, text in docs.items():
+        index.add(label, text)
+    return index
+
+
+def test_scores_match_bm25():
+    index = indexed(DOCS)
+    labels, scores = index.search("Quick dog, lazy!", 10)
+    expected = bm25("quick dog lazy", DOCS)
+    assert sorted(labels.tolist()) == sorted(expected)
+    assert np.allclose(scores, [expected[label] for label in labels.tolist()], rtol=1e-5)
+    assert np.all(np.diff(scores) <= 0)
+    assert index.search("zebra", 5)[0].tolist() == []
+
+
+def test_removed_and_replaced_chunks():
+    index = indexed(DOCS)
+    index.remove(1)
+    docs = {label: text for label, text in DOCS.items() if label != 1}
+    labels, scores = index.search("quick dog", 10)
+    expected = bm25("quick dog", docs)
+    assert sorted(labels.tolist()) == sorted(expected)
+    assert np.allclose(scores, [expected[label] for label in labels.tolist()], rtol=1e-5)
+
+    index.add(1, "river otters")  # the label is reused for other text
+    assert index.search("quick", 10)[0].tolist() == [0]
+    assert index.search("otters", 10)[0].tolist() == [1]
+    assert len(index) == 4
+
+
+def test_allowed_bitmap_and_sync_with_the_store():
+    store = ChunkStore()
+    for label, text in DOCS.items():
+        store.put(label, {"content": text, "file_path": "f.txt", "metadata": {"chunk_index": label}})
+    store.put(4, {"content": DOCS[0], "file_path": "g.txt", "metadata": {"chunk_index": 0}, "duplicate_of": "0"})
+    index = LexicalIndex()
+    assert index.sync(store) == (4, 0)  # duplicates are found through their owner
+    store.pop(2)
+    assert index.sync(store) == (0, 1)
+    allowed = np.zeros(4, dtype=bool)
+    allowed[[1, 3]] = True
+    assert sorted(index.search("dog dogs lazy", 10, allowed=allowed)[0].tolist()) == [1, 3]
+
+
+def test_reciprocal_rank_fusion():
+    labels, scores = reciprocal_rank_fusion([(np.array([1, 2, 3]), None), (np.array([3, 1]), None)], k=2, rrf_k=0)
+    assert labels.tolist() == [1, 3]
+    assert np.allclose(scores, [1 + 1 / 2, 1 / 3 + 1])
+
+
+def test_search_modes(make_indexer, add_file, monkeypatch):
+    import search
+    indexer = make_indexer()
+    path_a, vectors = add_file(indexer, "a.txt", 4)
+    add_file(indexer, "b.txt", 4)
+    content = indexer.mapping.field(next(iter(vectors)), "content")
+    query = " ".join(content.split()[:30])
+
+    lexical = indexer.search_similar(query, limit=2, mode="lexical")
+    assert lexical[0]["content"] == content and lexical[0]["retrieval"] == "lexical"
+    hybrid = indexer.search_similar(content, limit=2, mode="hybrid")
+    assert hybrid[0]["content"] == content and hybrid[0]["retrieval"] == "hybrid"
+    with pytest.raises(ValueError):
+        indexer.search_similar(query, mode="semantic")
+
+    def unavailable(texts, store_in_db=True):
+        raise RuntimeError("503 service unavailable")
+    monkeypatch.setattr(search, "create_embeddings_batch", unavailable)
+    monkeypatch.setattr(search._query_embedder, "unavailable_until", 0.0)
+    degraded = indexer.search_similar(query, limit=1)
+    assert degraded[0]["content"] == content
+    assert degraded[0]["retrieval"] == "lexical" and degraded[0]["degraded"]
+    assert not search.query_embedding_stats()["available"]
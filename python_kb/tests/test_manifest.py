@@ -0,0 +1,77 @@
+"""Incremental re-indexing driven by the content-hash manifest."""
+from chunk_store import ChunkStore
+from manifest import IndexManifest, file_sha256, text_sha256
+
+from conftest import write_document
+
+
+def test_plan_reuses_matching_chunks_in_order():
+    manifest = IndexManifest()
+    for label, chunk_hash in enumerate(["a", "b", "a", "c"]):
+        manifest.record("f.txt", "v1", chunk_hash, label)
+    kept, new_positions, stale = manifest.plan("f.txt", ["a", "x", "a", "a", "b"])
+    assert kept == {0: 0, 2: 2, 4: 1}
+    assert new_positions == [1, 3]
+    assert stale == [3]
+    assert manifest.plan("other.txt", ["a"]) == ({}, [0], [])
+
+
+def test_file_plan_matches_parts_as_they_arrive():
+    manifest = IndexManifest()
+    manifest.replace_file("f.txt", "v1", ["a", "b", "c"], [10, 11, 12])
+    plan = manifest.start_plan("f.txt")
+    assert [plan.match(h) for h in ["c", "d"]] == [12, None]
+    assert plan.match("a") == 10
+    assert plan.stale() == [11]
+    assert manifest.labels_for_file("f.txt") == [10, 11, 12]  # planning leaves the manifest alone
+
+
+def test_record_discard_and_remove():
+    manifest = IndexManifest()
+    manifest.replace_file("f.txt", "v1", ["a", "b", "b"], [1, 2, 3])
+    assert manifest.is_unchanged("f.txt", "v1")
+    assert not manifest.is_unchanged("f.txt", "v2") and not manifest.is_unchanged("g.txt", None)
+    manifest.discard("f.txt", [2, 1])
+    assert manifest.labels_for_file("f.txt") == [3]
+    assert manifest.file_hash("f.txt") == "v1"
+    assert manifest.remove_file("f.txt") == [3]
+    assert manifest.labels_for_file("f.txt") == [] and manifest.file_hash("f.txt") is None
+
+
+def test_rebuilt_from_the_chunk_store():
+    store = ChunkStore()
+    store.put(0, {"content": "one", "file_path": "f.txt",
+                  "metadata": {"file_hash": text_sha256("file"), "chunk_hash": text_sha256("one")}})
+    store.put(1, {"content": "legacy", "file_path": "g.txt", "metadata": {}})
+    manifest = IndexManifest.from_store(store)
+    assert manifest.file_hash("f.txt") == text_sha256("file")
+    assert manifest.start_plan("f.txt").match(text_sha256("one")) == 0
+    assert manifest.file_hash("g.txt") is None  # indexed before hashes were recorded
+    assert manifest.start_plan("g.txt").match(text_sha256("legacy")) == 1
+
+
+def test_reindexing_embeds_only_changed_chunks(make_indexer, embedder, tmp_path):
+    indexer = make_indexer()
+    path = write_document(tmp_path / "docs" / "a.txt", 4, seed=3)
+    first = indexer.index_file(path)
+    labels = set(indexer.manifest.labels_for_file(path))
+    assert first["success"] and len(labels) == 4
+
+    assert indexer.index_file(path)["skipped"]
+    assert indexer.manifest.file_hash(path) == file_sha256(path)
+
+    paragraphs = open(path, encoding="utf-8").read().split("\n\n")
+    paragraphs[2] = " ".join(reversed(paragraphs[2].split()))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n\n".join(paragraphs))
+    embedded = len(embedder.texts)
+    result = indexer.index_file(path)
+    assert (result["embedded"], result["reused"], result["retired"]) == (1, 3, 1)
+    assert len(embedder.texts) == embedded + 1
+    after = set(indexer.manifest.labels_for_file(path))
+    assert len(after) == 4 and len(after & labels) == 3
+    assert indexer.manifest.file_hash(path) == file_sha256(path)
+    assert sorted(indexer.mapping.field(label, "chunk_index") for label in after) == [0, 1, 2, 3]
+
+    forced = indexer.index_file(path, force=True)
+    assert (forced["embedded"], forced["reused"]) == (0, 4)
@@ -0,0 +1,38 @@
+"""Recovery from a snapshot plus the delta log."""
+import os
+
+import numpy as np
+
+
+def chunks_of(indexer):
+    return {label: indexer.mapping.field(label, "content") for label in indexer.mapping.labels().tolist()}
+
+
+def test_replay_after_crash_between_snapshot_and_truncate(make_indexer, add_file, monkeypatch):
+    indexer = make_indexer("crash")
+    deleted, _ = add_file(indexer, "a.txt", 4)
+    _, vectors = add_file(indexer, "b.txt", 4)
+    store = indexer.store
+
+    def crash(index_name, upto_seq):
+        raise RuntimeError("process killed")
+    with monkeypatch.context() as patched:
+        patched.setattr(store, "truncate_log", crash)
+        indexer._persist(snapshot=True)  # the snapshot is saved, the log keeps the records it covers
+    assert store.snapshot_version("crash") == indexer.log_seq
+    assert list(store.read_log("crash", 0))
+
+    restarted = make_indexer("crash")
+    assert restarted.load_status["state"] == "ready"
+    assert restarted.log_seq == indexer.log_seq
+    assert chunks_of(restarted) == chunks_of(indexer)
+    labels = list(vectors)
+    assert np.allclose(restarted._get_vectors(labels), indexer._get_vectors(labels))
+
+    # Changes after the restart follow the snapshot; the stale records before it are never replayed
+    restarted.delete_index(deleted)
+    add_file(restarted, "c.txt", 2)
+    again = make_indexer("crash")
+    assert chunks_of(again) == chunks_of(restarted)
+    assert {os.path.basename(again.mapping.field(label, "file_path"))
+            for label in again.mapping.labels().tolist()} == {"b.txt", "c.txt"}
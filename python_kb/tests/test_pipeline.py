@@ -0,0 +1,89 @@
+"""Streaming ingestion of directories through the pipeline."""
+import threading
+
+import pytest
+
+from conftest import write_document
+
+doc_extract = pytest.importorskip("doc_extract", reason="needs the service dependencies in requirements.txt")
+
+
+@pytest.fixture(autouse=True)
+def fork_workers(monkeypatch):
+    """Extraction workers inherit the test's patches (and start faster) when forked."""
+    monkeypatch.setattr(doc_extract, "POOL_START_METHOD", "fork")
+
+
+def contents(indexer):
+    return {label: indexer.mapping.field(label, "content") for label in indexer.mapping.labels().tolist()}
+
+
+def test_directory_of_multi_part_files(make_indexer, tmp_path):
+    docs = tmp_path / "dir"
+    write_document(docs / "long.txt", doc_extract.RECORDS_PER_PART + 8, seed=1)  # arrives in two parts
+    for i in range(3):
+        write_document(docs / f"f{i}.txt", 5, seed=10 + i)
+    indexer = make_indexer()
+
+    out = indexer.index_directory(str(docs), max_chunks=7, max_workers=2)
+    assert sum(r["chunks"] for r in out["files"]) == 7
+
+    out = indexer.index_directory(str(docs), max_workers=2)
+    assert all(r["success"] for r in out["files"])
+    total = doc_extract.RECORDS_PER_PART + 8 + 15
+    assert len(indexer.mapping) == len(indexer.view.mapping) == total
+    assert len(indexer.manifest.labels_for_file(str(docs / "long.txt"))) == doc_extract.RECORDS_PER_PART + 8
+    assert not indexer._unpublished
+    assert indexer.ingestion_stats()
+
+    assert indexer.index_directory(str(docs), max_workers=2)["skipped"] == 4
+
+
+def test_file_failing_mid_extraction_keeps_its_indexed_version(make_indexer, tmp_path, monkeypatch):
+    docs = tmp_path / "dir"
+    write_document(docs / "a.txt", 6, seed=1)
+    write_document(docs / "b.txt", 6, seed=2)
+    indexer = make_indexer()
+    indexer.index_directory(str(docs), max_workers=2)
+    before = contents(indexer)
+
+    write_document(docs / "b.txt", doc_extract.RECORDS_PER_PART + 8, seed=3)
+    extract = doc_extract.iter_file_records
+
+    def broken(path, *args, **kwargs):
+        for i, record in enumerate(extract(path, *args, **kwargs)):
+            if i == doc_extract.RECORDS_PER_PART + 2:  # after its first part reached the pipeline
+                raise RuntimeError("unreadable page")
+            yield record
+    monkeypatch.setattr(doc_extract, "iter_file_records", broken)
+    out = indexer.index_directory(str(docs), max_workers=2)
+
+    assert [r["success"] for r in out["files"]] == [False]
+    assert contents(indexer) == before
+    assert len(indexer.view.mapping) == 12
+    assert sorted(indexer.manifest.labels_for_file(str(docs / "b.txt"))) == sorted(
+        label for label in before if indexer.mapping.field(label, "file_path").endswith("b.txt"))
+
+
+def test_deletes_during_ingestion(make_indexer, add_file, tmp_path):
+    indexer = make_indexer()
+    victims = [add_file(indexer, f"v{i}.txt", 3)[0] for i in range(6)]
+    docs = tmp_path / "dir"
+    for i in range(6):
+        write_document(docs / f"f{i}.txt", 30, seed=100 + i)
+    errors = []
+
+    def delete_all():
+        try:
+            for victim in victims:
+                indexer.delete_index(victim)
+        except Exception as e:
+            errors.append(e)
+    deleter = threading.Thread(target=delete_all)
+    deleter.start()
+    indexer.index_directory(str(docs), max_workers=2)
+    deleter.join()
+
+    assert not errors
+    assert len(indexer.mapping) == len(indexer.view.mapping) == 180
+    assert set(indexer.manifest.files) == {str(docs / f"f{i}.txt") for i in range(6)}
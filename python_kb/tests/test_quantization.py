@@ -0,0 +1,83 @@
+"""Search quality, persistence and codebook sharing of the compressed vector tier."""
+import numpy as np
+import pytest
+
+from quantization import VectorTier, normalize
+
+DIMENSION = 192  # divisible into the default PQ subspaces
+
+
+def clustered_vectors(n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((20, DIMENSION))
+    return (centers[rng.integers(0, 20, n)] + 0.5 * rng.standard_normal((n, DIMENSION))).astype(np.float32)
+
+
+def recall(tier: VectorTier, vectors: np.ndarray, labels: np.ndarray, queries: np.ndarray, k: int = 10) -> float:
+    exact = labels[np.argsort(-(normalize(queries) @ normalize(vectors).T), axis=1)[:, :k]]
+    found = [tier.search(query, k)[0] for query in queries]
+    return float(np.mean([len(set(f.tolist()) & set(e.tolist())) / k for f, e in zip(found, exact)]))
+
+
+@pytest.mark.parametrize("kind", ["sq8", "pq"])
+def test_search_recall_after_reranking(tmp_path, kind):
+    vectors = clustered_vectors(1000)
+    labels = np.arange(1000) * 3  # labels need not be dense
+    tier = VectorTier(str(tmp_path), DIMENSION, kind)
+    tier.train(vectors[:600])
+    tier.add(labels.tolist(), vectors)
+    assert len(tier) == 1000
+    queries = clustered_vectors(20, seed=1)
+    assert recall(tier, vectors, labels, queries) >= 0.9
+
+    top, similarities = tier.search(vectors[5], 3)
+    assert top[0] == labels[5] and similarities[0] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_removed_and_filtered_labels_are_not_returned(tmp_path):
+    vectors = clustered_vectors(300)
+    tier = VectorTier(str(tmp_path), DIMENSION)
+    tier.train(vectors)
+    tier.add(list(range(300)), vectors)
+    tier.remove([5])
+    assert 5 not in tier.search(vectors[5], 10)[0].tolist()
+    allowed = np.zeros(300, dtype=bool)
+    allowed[[7, 8, 9]] = True
+    assert sorted(tier.search(vectors[7], 10, allowed=allowed)[0].tolist()) == [7, 8, 9]
+
+
+def test_save_load_and_compact(tmp_path):
+    vectors = clustered_vectors(3000)
+    tier = VectorTier(str(tmp_path), DIMENSION)
+    tier.train(vectors[:500])
+    tier.add(list(range(3000)), vectors)
+    tier.remove(list(range(2000)))
+    assert tier.needs_compaction()
+    tier.compact()
+    tier.save()
+    assert tier.stats()["dead_rows"] == 0
+
+    loaded = VectorTier.load(str(tmp_path), DIMENSION, "sq8")
+    assert loaded.trained and loaded.labels() == set(range(2000, 3000))
+    assert loaded.search(vectors[2500], 1)[0].tolist() == [2500]
+    assert not VectorTier.load(str(tmp_path), DIMENSION, "pq").trained  # saved for another quantizer
+
+
+def test_replicas_share_the_codebook(tmp_path):
+    vectors = clustered_vectors(400)
+    first = VectorTier(str(tmp_path / "a"), DIMENSION)
+    first.train(vectors)
+    first.add(list(range(400)), vectors)
+    codebook = first.codebook()
+
+    replica = VectorTier(str(tmp_path / "b"), DIMENSION)
+    assert replica.use_codebook(codebook)
+    replica.add(list(range(400)), vectors)
+    for query in clustered_vectors(5, seed=2):  # the same codes give the same approximate scores
+        assert all(np.array_equal(a, b) for a, b in zip(replica.search(query, 10, rerank=0),
+                                                        first.search(query, 10, rerank=0)))
+    assert first.use_codebook(codebook) and len(first) == 400  # already in use: nothing is dropped
+    assert not VectorTier(str(tmp_path / "c"), DIMENSION, "pq").use_codebook(codebook)
+
+    with pytest.raises(ValueError):
+        VectorTier(str(tmp_path / "d"), DIMENSION, "int4")
@@ -0,0 +1,112 @@
+"""Backoff, retries and urgent reservations of the adaptive rate limiter."""
+import pytest
+
+import rate_limiter
+from rate_limiter import AdaptiveRateLimiter, backoff_delay, retry_after, urgent
+
+
+class QuotaError(Exception):
+    pass
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record sleeps instead of sleeping; jitter always picks the longest delay."""
+    recorded = []
+    monkeypatch.setattr(rate_limiter.time, "sleep", recorded.append)
+    monkeypatch.setattr(rate_limiter.random, "uniform", lambda low, high: high)
+    return recorded
+
+
+def throttled_then(result, failures, message="429 Quota exceeded"):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise QuotaError(message)
+        return result
+    return fn, calls
+
+
+def test_backoff_doubles_up_to_the_cap(sleeps):
+    delays = [backoff_delay(attempt) for attempt in range(6)]
+    assert delays == [4.0, 8.0, 16.0, 32.0, 60.0, 60.0]
+
+
+def test_backoff_jitter_stays_in_upper_half():
+    for attempt in range(6):
+        delay = min(rate_limiter.BACKOFF_MAX, rate_limiter.BACKOFF_MIN * 2 ** attempt)
+        assert delay / 2 <= backoff_delay(attempt) <= delay
+
+
+def test_backoff_honours_retry_after():
+    assert backoff_delay(0, 45.0) == 45.0
+
+
+def test_retry_after_sources():
+    error = QuotaError("429")
+    error.retry_after = 7
+    assert retry_after(error) == 7.0
+
+    error = QuotaError("429")
+    error.response = type("Response", (), {"headers": {"Retry-After": "12"}})()
+    assert retry_after(error) == 12.0
+
+    assert retry_after(QuotaError("429 RESOURCE_EXHAUSTED, retry in 3.5s")) == 3.5
+    assert retry_after(QuotaError("429 Quota exceeded")) is None
+
+
+def test_call_retries_with_exponential_backoff(sleeps):
+    limiter = AdaptiveRateLimiter("test", 60_000, 10_000_000)
+    fn, calls = throttled_then("ok", failures=2)
+    assert limiter.call(fn) == "ok"
+    assert len(calls) == 3
+    assert [s for s in sleeps if s >= 1] == [4.0, 8.0]
+    snapshot = limiter.snapshot()
+    assert snapshot["throttled"] == 2
+    assert snapshot["seconds_backed_off"] == 12.0
+    assert snapshot["fraction"] < 1.0
+
+
+def test_call_waits_at_least_retry_after(sleeps):
+    limiter = AdaptiveRateLimiter("test", 60_000, 10_000_000)
+    fn, calls = throttled_then("ok", failures=1, message="429 Quota exceeded; retry after 30 seconds")
+    assert limiter.call(fn) == "ok"
+    assert [s for s in sleeps if s >= 1] == [30.0]
+
+
+def test_call_gives_up_past_the_deadline(sleeps, monkeypatch):
+    monkeypatch.setattr(rate_limiter, "RETRY_DEADLINE", 10.0)
+    limiter = AdaptiveRateLimiter("test", 60_000, 10_000_000)
+    fn, calls = throttled_then("ok", failures=10)
+    with pytest.raises(QuotaError):
+        limiter.call(fn)
+    assert len(calls) == 3  # 4s and 8s of backoff fit, the next 16s would end past the deadline
+
+
+def test_call_gives_up_after_max_attempts(sleeps):
+    limiter = AdaptiveRateLimiter("test", 60_000, 10_000_000)
+    fn, calls = throttled_then("ok", failures=10)
+    with pytest.raises(QuotaError):
+        limiter.call(fn, max_attempts=3)
+    assert len(calls) == 3
+
+
+def test_other_errors_are_not_retried(sleeps):
+    limiter = AdaptiveRateLimiter("test", 60_000, 10_000_000)
+    fn, calls = throttled_then("ok", failures=1, message="400 invalid argument")
+    with pytest.raises(QuotaError):
+        limiter.call(fn)
+    assert len(calls) == 1
+    assert limiter.snapshot()["throttled"] == 0
+
+
+def test_urgent_reservation_skips_waiting_bulk_reservations():
+    limiter = AdaptiveRateLimiter("test", 60, 10_000_000)  # one request per second
+    waits = [limiter._reserve(1) for _ in range(5)]
+    assert waits[-1] == pytest.approx(4.0, abs=0.1)
+    with urgent():
+        assert limiter._reserve(1) <= 1.0 + 1e-6
+    assert limiter._reserve(1) == pytest.approx(6.0, abs=0.1)  # the bulk queue absorbed the urgent call
+    assert limiter.snapshot()["urgent_calls"] == 1
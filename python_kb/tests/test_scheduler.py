@@ -0,0 +1,75 @@
+"""Priorities, reserved workers and fair sharing of the work scheduler."""
+import asyncio
+import threading
+import time
+
+import pytest
+
+from scheduler import WorkScheduler, INTERACTIVE, ASK, BULK
+
+
+def blocker(scheduler: WorkScheduler, priority: int = BULK, job: str = "blocker"):
+    """Occupy one worker until the returned event is set."""
+    started, release = threading.Event(), threading.Event()
+
+    def hold():
+        started.set()
+        assert release.wait(5)
+    future = scheduler.submit(hold, priority=priority, job=job)
+    assert started.wait(5)
+    return release, future
+
+
+def test_interactive_work_runs_ahead_of_queued_bulk_work():
+    scheduler = WorkScheduler(workers=1, reserved=0)
+    release, _ = blocker(scheduler)
+    order = []
+    futures = [scheduler.submit(order.append, "bulk"),
+               scheduler.submit(order.append, "ask", priority=ASK),
+               scheduler.submit(order.append, "interactive", priority=INTERACTIVE)]
+    release.set()
+    for future in futures:
+        future.result(5)
+    assert order == ["interactive", "ask", "bulk"]
+
+
+def test_bulk_work_leaves_the_reserved_workers_free():
+    scheduler = WorkScheduler(workers=3, reserved=1)
+    releases = [blocker(scheduler, job=f"job{i}")[0] for i in range(2)]
+    queued = scheduler.submit(lambda: "bulk")
+    assert scheduler.submit(lambda: "interactive", priority=INTERACTIVE).result(5) == "interactive"
+    assert not queued.done()
+    assert scheduler.stats()["classes"]["bulk"]["queued"] == 1
+    for release in releases:
+        release.set()
+    assert queued.result(5) == "bulk"
+
+
+def test_bulk_jobs_are_served_round_robin():
+    scheduler = WorkScheduler(workers=1, reserved=0)
+    release, _ = blocker(scheduler)
+    order = []
+    futures = [scheduler.submit(order.append, (job, i), job=job) for job in ("a", "b") for i in range(3)]
+    assert scheduler.stats()["bulk_jobs"] == {"a": 3, "b": 3}
+    release.set()
+    for future in futures:
+        future.result(5)
+    assert order == [("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2), ("b", 2)]
+
+
+def test_results_failures_and_stats():
+    scheduler = WorkScheduler(workers=2, reserved=1)
+
+    def fail():
+        raise RuntimeError("upstream error")
+    with pytest.raises(RuntimeError):
+        scheduler.submit(fail, priority=ASK).result(5)
+    assert asyncio.run(scheduler.run(lambda x: x * 2, 21, priority=INTERACTIVE)) == 42
+    deadline = time.monotonic() + 5
+    while scheduler.stats()["classes"]["interactive"]["running"] + scheduler.stats()["classes"]["ask"]["running"] \
+            and time.monotonic() < deadline:
+        time.sleep(0.01)  # counters are updated just after the result is set
+    stats = scheduler.stats()
+    assert stats["bulk_limit"] == 1
+    assert stats["classes"]["ask"]["failed"] == 1
+    assert stats["classes"]["interactive"]["completed"] == 1
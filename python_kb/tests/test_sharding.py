@@ -0,0 +1,87 @@
+"""The sharded index stands in for one hnswlib graph."""
+import hnswlib
+import numpy as np
+import pytest
+
+from sharding import ShardedIndex, grow_index, has_room
+
+
+def unit_vectors(n: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def sharded():
+    index = ShardedIndex.create(3, 16, 300, ef_construction=200, M=16)
+    index.set_ef(200)
+    yield index
+    index.close()
+
+
+def test_queries_merge_the_shards_like_exact_search(sharded):
+    vectors = unit_vectors(300)
+    sharded.add_items(vectors, np.arange(300))
+    assert len(sharded.get_ids_list()) == sharded.get_current_count() == 300
+    assert np.allclose(sharded.get_items([5, 7, 299]), vectors[[5, 7, 299]], atol=1e-6)
+
+    queries = unit_vectors(20, seed=1)
+    labels, distances = sharded.knn_query(queries, k=10)
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :10]
+    assert labels.shape == (20, 10)
+    assert np.mean([len(set(l) & set(e)) / 10 for l, e in zip(labels.tolist(), exact.tolist())]) >= 0.95
+    assert np.all(np.diff(distances, axis=1) >= 0)  # merged in distance order
+
+
+def test_deletes_and_filters(sharded):
+    vectors = unit_vectors(60)
+    sharded.add_items(vectors, np.arange(60))
+    sharded.take_dirty()
+    sharded.mark_deleted(4)
+    assert sharded.take_dirty() == {4 % 3}
+    labels, _ = sharded.knn_query(vectors[4], k=5)
+    assert 4 not in labels[0].tolist()
+
+    labels, _ = sharded.knn_query(vectors[9], k=5, filter=lambda label: label % 2 == 1)
+    assert labels[0, 0] == 9 and all(label % 2 == 1 for label in labels[0].tolist())
+
+
+def test_capacity_grows_per_shard(sharded):
+    assert sharded.get_max_elements() == 300
+    labels = list(range(330))
+    assert not has_room(sharded, labels)
+    capacity = grow_index(sharded, labels)
+    assert has_room(sharded, labels)
+    assert capacity == sharded.get_max_elements() == 600  # every shard doubled
+    sharded.add_items(unit_vectors(330), labels)
+    assert sharded.get_current_count() == 330
+
+
+def test_grow_index_on_a_single_graph():
+    index = hnswlib.Index(space="cosine", dim=16)
+    index.init_index(max_elements=10, ef_construction=50, M=8)
+    assert has_room(index, list(range(10))) and not has_room(index, list(range(11)))
+    assert grow_index(index, list(range(10))) == 10
+    assert grow_index(index, list(range(11))) >= 20
+    assert index.get_max_elements() >= 20
+
+
+def test_sharded_indexer_searches_and_reloads(make_indexer, add_file, monkeypatch):
+    indexing = pytest.importorskip("indexing", reason="needs the service dependencies in requirements.txt")
+    import search
+    monkeypatch.setattr(indexing, "INDEX_SHARDS", 3)
+    monkeypatch.setattr(search, "EXACT_SEARCH_MAX", 0)  # search the shards' graphs
+    indexer = make_indexer("sharded")
+    assert isinstance(indexer.index, ShardedIndex)
+    _, vectors = add_file(indexer, "a.txt", 5)
+    add_file(indexer, "b.txt", 4)
+    assert indexer.search_strategy() == "hnsw"
+    label = next(iter(vectors))
+    query = indexer.mapping.field(label, "content")
+    assert indexer.search_similar(query, limit=1)[0]["content"] == query
+
+    indexer._persist(snapshot=True)
+    restarted = make_indexer("sharded")
+    assert isinstance(restarted.index, ShardedIndex) and len(restarted.index) == 3
+    assert np.allclose(restarted._get_vectors(list(vectors)), indexer._get_vectors(list(vectors)))
+    assert restarted.search_similar(query, limit=1)[0]["content"] == query
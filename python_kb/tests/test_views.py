@@ -0,0 +1,49 @@
+"""A search reads the view it pinned, whatever deletes and compactions happen meanwhile."""
+import os
+
+
+def files_found(indexer, view, vector, limit=20):
+    results = indexer._rank(view, "", vector, limit, None, "vector")
+    assert all(r["content"] for r in results)
+    return {os.path.basename(r["file_path"]) for r in results}
+
+
+def test_pinned_view_keeps_deleted_file_until_released(make_indexer, add_file):
+    indexer = make_indexer()
+    path, deleted = add_file(indexer, "a.txt", 5)
+    add_file(indexer, "b.txt", 5)
+    label, vector = next(iter(deleted.items()))
+
+    with indexer._reading() as view:
+        indexer.delete_index(path)
+        assert "a.txt" in files_found(indexer, view, vector)
+        assert view.mapping.field(label, "content")
+        assert not indexer.tombstones & deleted.keys()
+        with indexer._reading() as current:
+            assert "a.txt" not in files_found(indexer, current, vector)
+
+    indexer._persist()
+    assert deleted.keys() <= indexer.tombstones
+    with indexer._reading() as view:
+        assert files_found(indexer, view, vector) == {"b.txt"}
+
+
+def test_pinned_view_survives_compaction(make_indexer, add_file):
+    indexer = make_indexer()
+    path, deleted = add_file(indexer, "a.txt", 5)
+    _, kept = add_file(indexer, "b.txt", 5)
+    vector = next(iter(deleted.values()))
+
+    with indexer._reading() as view:
+        indexer.delete_index(path)
+        assert indexer.compact(background=False)
+        assert indexer.view.index is not view.index
+        assert "a.txt" in files_found(indexer, view, vector)
+        assert len(indexer._get_vectors(list(deleted), view.index)) == len(deleted)
+
+    indexer._persist()
+    assert indexer.compact(background=False)
+    with indexer._reading() as view:
+        assert files_found(indexer, view, vector) == {"b.txt"}
+        label, kept_vector = next(iter(kept.items()))
+        assert indexer._rank(view, "", kept_vector, 1, None, "vector")[0]["content"] == view.mapping.field(label, "content")
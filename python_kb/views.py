@@ -0,0 +1,168 @@
+"""
+Published views of an index and their publication.
+
+Searches never lock the live index: writers change the graph and chunk
+store, then publish a ``SearchView`` (a snapshot of the chunk store plus the
+graph) that searches pin while they run. Vectors retired by a change are
+tombstoned only once no pinned view can still return them. ``ResizeGate``
+keeps graph readers clear of resizes and ef tuning trials.
+"""
+import contextlib
+import threading
+import time
+from typing import Dict, Optional
+
+import numpy as np
+
+from chunk_store import ChunkStore
+from lexical import LexicalIndex
+
+
+class ResizeGate:
+    """
+    Lets graph readers run concurrently while keeping them clear of exclusive
+    users: resize_index, which reallocates the graph, and ef tuning trials,
+    which change the ef every search of the graph runs at.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._resizing = False
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._resizing:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._cond:
+            while self._resizing:
+                self._cond.wait()
+            self._resizing = True
+            while self._readers:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._resizing = False
+                self._cond.notify_all()
+
+
+class SearchView:
+    def __init__(self, generation: int, index, mapping: ChunkStore, duplicates: Dict[int, tuple],
+                 source: ChunkStore, lexical: Optional[LexicalIndex] = None):
+        """
+        One published state of an index, which searches read without taking locks.
+
+        Args:
+            generation: Publication counter
+            index: Graph (or ShardedIndex) at publication; it may also hold vectors
+                added or retired since, which ``visible`` filters out
+            mapping: Read-only chunk store snapshot (see ChunkStore.snapshot)
+            duplicates: Owner label -> labels of the chunks sharing its vector
+            source: Live chunk store the snapshot was taken from
+            lexical: BM25 index over ``source``, if built yet
+        """
+        self.generation = generation
+        self.index = index
+        self.mapping = mapping
+        self.duplicates = duplicates
+        self.source = source
+        self.lexical = lexical
+        self.vectors = mapping.owner_count()
+        self.published_at = time.time()
+
+    def visible(self, labels, scores, limit: int):
+        """The first ``limit`` results whose label owns a vector in this view."""
+        labels = np.asarray(labels, dtype=np.int64)
+        keep = self.mapping.is_owner(labels)
+        return labels[keep][:limit], np.asarray(scores)[keep][:limit], int(keep.sum())
+
+
+class ViewPublisher:
+    """
+    Publication of views for DocumentIndexer: ``_publish`` after a complete
+    change, ``_reading`` around a search and ``_reclaim`` of retired vectors.
+    """
+
+    def _publish(self, same_chunks: bool = False):
+        """
+        Make the live index, chunk store and duplicate links what searches see.
+
+        Writers call this once a change is complete, holding the write lock: a
+        file (or a pipeline batch of files) finalized, a delete or clear done, a
+        load swapped in; the compaction swap calls it with ``same_chunks``.
+        Chunks of files still being indexed stay hidden. Vectors retired by the
+        change are tombstoned only when no search reads an older view that
+        still shows them. The chunk store snapshot copies only the pages of its
+        label index written since the last one, and the duplicate links are
+        copied by the next writer that changes them.
+
+        Args:
+            same_chunks: Only the graph was swapped; keep the published chunk store.
+                Pending deletes stay pending, as the kept store still shows them.
+        """
+        with self._index_lock:
+            previous = self.view
+            if same_chunks and previous is not None:
+                mapping, duplicates = previous.mapping, previous.duplicates
+            else:
+                mapping, duplicates = self.mapping.snapshot(exclude=frozenset(self._unpublished)), self.duplicates
+            view = SearchView((previous.generation if previous else 0) + 1, self.index, mapping, duplicates,
+                              self.mapping, self._lexical)
+            with self._view_lock:
+                self.view = view
+                if self._pending_deletes and not same_chunks:
+                    self._retiring.append((previous.generation if previous else 0, self.mapping, self._pending_deletes))
+                    self._pending_deletes = []
+            self._reclaim()
+
+    def _reclaim(self):
+        """Tombstone retired vectors that no search in flight can still return."""
+        with self._view_lock:
+            oldest = min((g for g, n in self._readers.items() if n), default=None)
+            done = [r for r in self._retiring if oldest is None or r[0] < oldest]
+            self._retiring = [r for r in self._retiring if not (oldest is None or r[0] < oldest)]
+        with self._index_lock:
+            for _, mapping, labels in done:
+                if mapping is not self.mapping:
+                    continue  # cleared or reloaded since; the labels may name new chunks
+                for label in labels:
+                    try:
+                        self.index.mark_deleted(label)
+                        self.tombstones.add(label)
+                    except RuntimeError:
+                        pass  # Already deleted or never added
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """Pin the published view for one search."""
+        with self._view_lock:
+            view = self.view
+            self._readers[view.generation] += 1
+        try:
+            yield view
+        finally:
+            with self._view_lock:
+                self._readers[view.generation] -= 1
+                if not self._readers[view.generation]:
+                    del self._readers[view.generation]
+
+    def _writable_duplicates(self) -> Dict[int, tuple]:
+        """The live duplicate links, copied first if the published view shares them."""
+        view = self.view
+        if view is not None and view.duplicates is self.duplicates:
+            self.duplicates = dict(self.duplicates)
+        return self.duplicates